@@ -0,0 +1,510 @@
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 批量任务目录：pending/下是等待提交的生成请求（每个任务一个文件），其余为提交的批量输入文件和执行状态
+BATCH_DIR = os.path.join('.wucai', 'batches')
+PENDING_DIR = os.path.join(BATCH_DIR, 'pending')
+
+# 子进程写出生成请求后以该退出码退出（需与pdf_to_knowledge_md.py保持一致）
+DEFERRED_EXIT_CODE = 4
+
+# 批量接口的请求地址（OpenAI兼容格式）
+CHAT_COMPLETIONS_URL = '/v1/chat/completions'
+
+# 默认批量执行参数，可通过配置项batch_mode覆盖其中任意一项
+DEFAULT_BATCH_MODE = {
+    'backend': 'dashscope',  # dashscope: 百炼批量推理接口; local: 在本进程中逐个调用（用于测试和没有批量接口的环境）
+    'max_requests': 100,  # 每个批量文件最多包含的请求数，积累到该数量时立即提交
+    'max_wait_seconds': 600,  # 最早的请求等待超过该时间时提交，不再等待凑满
+    'poll_interval_seconds': 60,  # 检查批量任务状态的间隔
+    'completion_window': '24h'  # 批量任务的完成时限
+}
+
+# 已结束的批量任务状态
+FINISHED_BATCH_STATUSES = ('completed', 'failed')
+# state.json中最多保留的已结束批量任务数
+MAX_FINISHED_BATCHES = 100
+
+
+def load_batch_mode(config):
+    """
+    合并配置中的批量执行参数和默认值
+    """
+    options = DEFAULT_BATCH_MODE.copy()
+    options.update({k: v for k, v in (config.get('batch_mode') or {}).items() if k in DEFAULT_BATCH_MODE})
+    return options
+
+
+def get_request_file(task_id):
+    """
+    任务的生成请求文件路径（由处理子进程写入）
+    """
+    return os.path.join(PENDING_DIR, f"{task_id}.json")
+
+
+def write_request(request_file, model, messages):
+    """
+    写出一次文本生成请求（子进程调用），先写临时文件再替换，执行器不会读到不完整的请求
+    """
+    os.makedirs(os.path.dirname(request_file) or '.', exist_ok=True)
+    temp_file = f"{request_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump({'model': model, 'messages': messages}, f, ensure_ascii=False)
+    os.replace(temp_file, request_file)
+
+
+def build_batch_line(custom_id, body):
+    """
+    生成批量输入文件中的一行
+    """
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': CHAT_COMPLETIONS_URL, 'body': body}, ensure_ascii=False)
+
+
+def parse_result_line(line):
+    """
+    解析批量输出文件中的一行
+
+    Returns:
+        {'custom_id', 'content', 'input_tokens', 'output_tokens', 'error'}，无法解析时返回None
+    """
+    try:
+        item = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(item, dict) or not item.get('custom_id'):
+        return None
+    result = {'custom_id': item['custom_id'], 'content': None, 'input_tokens': 0, 'output_tokens': 0, 'error': None}
+    response = item.get('response') or {}
+    body = response.get('body') or {}
+    error = item.get('error') or body.get('error')
+    if error or response.get('status_code') != 200:
+        result['error'] = (error or {}).get('message') if isinstance(error, dict) else str(error or f"HTTP {response.get('status_code')}")
+        return result
+    try:
+        result['content'] = body['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        result['error'] = '批量输出中没有生成内容'
+    usage = body.get('usage') or {}
+    result['input_tokens'] = usage.get('prompt_tokens', 0)
+    result['output_tokens'] = usage.get('completion_tokens', 0)
+    return result
+
+
+class BatchBackend:
+    """
+    批量执行后端接口
+
+    submit()提交一个批量输入文件（JSONL），返回批量任务ID；poll()查询状态，结束后一并返回解析后的结果
+    """
+
+    def submit(self, input_file):
+        raise NotImplementedError
+
+    def poll(self, batch_id):
+        """
+        Returns:
+            {'status': 'running' | 'completed' | 'failed', 'results': [parse_result_line的结果], 'error': 失败原因}
+        """
+        raise NotImplementedError
+
+
+class DashScopeBatchBackend(BatchBackend):
+    """
+    百炼批量推理接口（OpenAI兼容的Files和Batches接口），按批量价格计费
+    """
+
+    BASE_URL = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
+
+    def __init__(self, api_key, completion_window='24h', base_url=BASE_URL, timeout=60):
+        self.api_key = api_key
+        self.completion_window = completion_window
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, **kwargs):
+        # 依赖requests，首次使用时再导入，不拖慢启动
+        import requests
+        response = requests.request(
+            method, f"{self.base_url}{path}",
+            headers={'Authorization': f"Bearer {self.api_key}"},
+            timeout=self.timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def submit(self, input_file):
+        with open(input_file, 'rb') as f:
+            uploaded = self.request('POST', '/files', files={'file': (os.path.basename(input_file), f)}, data={'purpose': 'batch'}).json()
+        batch = self.request('POST', '/batches', json={
+            'input_file_id': uploaded['id'],
+            'endpoint': CHAT_COMPLETIONS_URL,
+            'completion_window': self.completion_window
+        }).json()
+        return batch['id']
+
+    def poll(self, batch_id):
+        batch = self.request('GET', f"/batches/{batch_id}").json()
+        status = batch.get('status')
+        if status not in ('completed', 'failed', 'expired', 'cancelled'):
+            return {'status': 'running', 'results': [], 'error': None}
+        # 超时或失败的批量任务也可能已有部分结果
+        results = []
+        for key in ('output_file_id', 'error_file_id'):
+            if batch.get(key):
+                content = self.request('GET', f"/files/{batch[key]}/content").text
+                results.extend(filter(None, map(parse_result_line, content.splitlines())))
+        error = None
+        if status != 'completed':
+            errors = (batch.get('errors') or {}).get('data') or []
+            error = errors[0].get('message') if errors else f"批量任务{status}"
+        return {'status': 'completed' if status == 'completed' else 'failed', 'results': results, 'error': error}
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    本地批量执行后端：提交时在当前线程中逐个执行请求并写出输出文件，格式与批量接口一致
+
+    Args:
+        complete: complete(body)执行一个请求体，返回 {'content', 'input_tokens', 'output_tokens'}；
+                  不传时使用DashScope的非流式调用
+    """
+
+    def __init__(self, api_key=None, complete=None, batch_dir=BATCH_DIR):
+        self.api_key = api_key
+        self.complete = complete or self.call_dashscope
+        self.batch_dir = batch_dir
+
+    def call_dashscope(self, body):
+        import dashscope
+        response = dashscope.Generation.call(
+            model=body['model'], messages=body['messages'], result_format='message', api_key=self.api_key
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.code} - {response.message}")
+        usage = response.usage or {}
+        return {
+            'content': response.output.choices[0].message.content,
+            'input_tokens': usage.get('input_tokens', 0),
+            'output_tokens': usage.get('output_tokens', 0)
+        }
+
+    def get_output_file(self, batch_id):
+        return os.path.join(self.batch_dir, f"{batch_id}.output.jsonl")
+
+    def submit(self, input_file):
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        lines = []
+        with open(input_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                request = json.loads(line)
+                item = {'custom_id': request['custom_id'], 'response': None, 'error': None}
+                try:
+                    result = self.complete(request['body'])
+                    item['response'] = {'status_code': 200, 'body': {
+                        'choices': [{'message': {'role': 'assistant', 'content': result['content']}}],
+                        'usage': {'prompt_tokens': result.get('input_tokens', 0), 'completion_tokens': result.get('output_tokens', 0)}
+                    }}
+                except Exception as e:
+                    item['error'] = {'message': str(e)}
+                lines.append(json.dumps(item, ensure_ascii=False))
+        output_file = self.get_output_file(batch_id)
+        with open(f"{output_file}.tmp", 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f"{output_file}.tmp", output_file)
+        return batch_id
+
+    def poll(self, batch_id):
+        output_file = self.get_output_file(batch_id)
+        if not os.path.exists(output_file):
+            return {'status': 'failed', 'results': [], 'error': '本地批量输出文件不存在'}
+        with open(output_file, 'r', encoding='utf-8') as f:
+            results = list(filter(None, map(parse_result_line, f)))
+        os.remove(output_file)
+        return {'status': 'completed', 'results': results, 'error': None}
+
+
+# 批量执行后端 {名称: factory(api_key, options)}，可通过register_backend扩展
+BACKENDS = {
+    'dashscope': lambda api_key, options: DashScopeBatchBackend(api_key, options['completion_window']),
+    'local': lambda api_key, options: LocalBatchBackend(api_key)
+}
+
+
+def register_backend(name, factory):
+    BACKENDS[name] = factory
+
+
+class BatchExecutor:
+    """
+    延迟批量执行器
+
+    低优先级任务的生成请求写入pending目录后由执行器收集：积累到max_requests个或最早的请求等待超过
+    max_wait_seconds时合并为一个JSONL批量文件提交给后端，之后定期查询状态，结果按任务ID交给on_result。
+    已提交的批量任务记录在state.json中，服务重启后继续查询。
+    """
+
+    def __init__(self, load_config, on_result, on_submit=None, batch_dir=BATCH_DIR):
+        """
+        Args:
+            load_config: 返回当前配置的函数（读取batch_mode和api_key）
+            on_result: on_result(task_id, result)处理一个任务的结果，result格式见parse_result_line
+            on_submit: on_submit(batch_id, task_ids)在批量任务提交后调用，可选
+            batch_dir: 批量任务目录
+        """
+        self.load_config = load_config
+        self.on_result = on_result
+        self.on_submit = on_submit
+        self.batch_dir = batch_dir
+        self.pending_dir = os.path.join(batch_dir, 'pending')
+        self.state_file = os.path.join(batch_dir, 'state.json')
+        self.lock = threading.RLock()  # 保护batches、pending目录和submitting，不在持有时调用后端
+        self.run_lock = threading.Lock()  # 串行执行run_once，避免重复提交或重复分发结果
+        self.submitting = set()  # 已读取、正在提交的任务ID
+        self.wake_event = threading.Event()
+        self.backends = {}  # 测试时可直接注入 {名称: 后端实例}
+        os.makedirs(self.pending_dir, exist_ok=True)
+        self.batches = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"读取批量任务状态时出错: {str(e)}")
+            return {}
+
+    def save_state(self):
+        temp_file = f"{self.state_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.batches, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.state_file)
+
+    def get_backend(self, name, config, options):
+        if name in self.backends:
+            return self.backends[name]
+        if name not in BACKENDS:
+            raise ValueError(f"未知的批量执行后端: {name}")
+        return BACKENDS[name](config.get('api_key', '') or config.get('app_key', ''), options)
+
+    def list_pending(self):
+        """
+        按写入时间返回等待提交的 [(task_id, 请求文件, 写入时间)]
+        """
+        pending = []
+        for name in os.listdir(self.pending_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.pending_dir, name)
+            try:
+                pending.append((name[:-len('.json')], path, os.path.getmtime(path)))
+            except OSError:
+                continue
+        return sorted(pending, key=lambda item: item[2])
+
+    def discard(self, task_id):
+        """
+        取消任务：删除尚未提交的请求；已提交的请求结果到达后由on_result按任务状态忽略
+
+        Returns:
+            请求是否尚未提交
+        """
+        with self.lock:
+            if task_id in self.submitting:
+                return False
+            try:
+                os.remove(os.path.join(self.pending_dir, f"{task_id}.json"))
+                return True
+            except FileNotFoundError:
+                return False
+
+    def submit_pending(self, options, config, force=False):
+        """
+        把等待中的请求按max_requests分组提交
+
+        Returns:
+            提交的批量任务数
+        """
+        submitted = 0
+        while True:
+            with self.lock:
+                pending = self.list_pending()
+                if not pending:
+                    break
+                if not force and len(pending) < options['max_requests'] and time.time() - pending[0][2] < options['max_wait_seconds']:
+                    break
+                group = pending[:options['max_requests']]
+                input_file, task_ids = self.write_input_file(group)
+                self.submitting.update(task_id for task_id, _, _ in group)
+            try:
+                if not task_ids:
+                    continue
+                backend_name = options['backend']
+                try:
+                    batch_id = self.get_backend(backend_name, config, options).submit(input_file)
+                except Exception:
+                    # 提交失败时请求文件仍在pending目录中，下一轮重新生成批量文件
+                    os.remove(input_file)
+                    raise
+                with self.lock:
+                    self.batches[batch_id] = {
+                        'backend': backend_name,
+                        'input_file': input_file,
+                        'task_ids': task_ids,
+                        'status': 'running',
+                        'submitted_at': time.time(),
+                        'finished_at': None,
+                        'error': None
+                    }
+                    self.save_state()
+                    # 状态保存后再删除请求文件；提交后、保存前进程退出时请求会被重复提交，但不会丢失
+                    for task_id, path, _ in group:
+                        if os.path.exists(path):
+                            os.remove(path)
+            finally:
+                with self.lock:
+                    self.submitting.difference_update(task_id for task_id, _, _ in group)
+            submitted += 1
+            if self.on_submit:
+                self.on_submit(batch_id, task_ids)
+            logger.info(f"已提交批量任务 {batch_id}（{backend_name}），包含 {len(task_ids)} 个请求")
+        return submitted
+
+    def write_input_file(self, group):
+        """
+        把一组请求写入JSONL批量文件，无法读取的请求文件直接删除
+
+        Returns:
+            (批量文件路径, 写入的任务ID列表)；没有可提交的请求时批量文件路径为None
+        """
+        input_file = os.path.join(self.batch_dir, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.jsonl")
+        task_ids = []
+        with open(input_file, 'w', encoding='utf-8') as f:
+            for task_id, path, _ in group:
+                try:
+                    with open(path, 'r', encoding='utf-8') as request_file:
+                        body = json.load(request_file)
+                except (json.JSONDecodeError, IOError) as e:
+                    logger.error(f"读取任务 {task_id} 的生成请求时出错: {str(e)}")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                f.write(build_batch_line(task_id, body) + '\n')
+                task_ids.append(task_id)
+        if not task_ids:
+            os.remove(input_file)
+            return None, []
+        return input_file, task_ids
+
+    def poll_batches(self, config, options):
+        """
+        查询运行中的批量任务，结束的任务把结果分发给各任务
+
+        Returns:
+            本次结束的批量任务数
+        """
+        finished = 0
+        with self.lock:
+            running = [(batch_id, dict(batch)) for batch_id, batch in self.batches.items() if batch['status'] not in FINISHED_BATCH_STATUSES]
+        for batch_id, batch in running:
+            try:
+                state = self.get_backend(batch['backend'], config, options).poll(batch_id)
+            except Exception as e:
+                logger.error(f"查询批量任务 {batch_id} 状态时出错: {str(e)}")
+                continue
+            if state['status'] == 'running':
+                continue
+            received = set()
+            for result in state['results']:
+                if result['custom_id'] in batch['task_ids']:
+                    received.add(result['custom_id'])
+                    self.dispatch(result['custom_id'], result)
+            # 批量任务失败或部分请求没有结果时，对应的任务按失败处理
+            for task_id in batch['task_ids']:
+                if task_id not in received:
+                    self.dispatch(task_id, {
+                        'custom_id': task_id, 'content': None, 'input_tokens': 0, 'output_tokens': 0,
+                        'error': state['error'] or '批量输出中没有该请求的结果'
+                    })
+            with self.lock:
+                if batch_id in self.batches:
+                    self.batches[batch_id].update(status=state['status'], finished_at=time.time(), error=state['error'])
+                if os.path.exists(batch['input_file']):
+                    os.remove(batch['input_file'])
+                self.prune_finished()
+                self.save_state()
+            finished += 1
+            logger.info(f"批量任务 {batch_id} 已结束: {state['status']}，收到 {len(received)}/{len(batch['task_ids'])} 个结果")
+        return finished
+
+    def prune_finished(self):
+        finished = sorted(
+            (batch['finished_at'], batch_id) for batch_id, batch in self.batches.items()
+            if batch['status'] in FINISHED_BATCH_STATUSES
+        )
+        for _, batch_id in finished[:-MAX_FINISHED_BATCHES]:
+            del self.batches[batch_id]
+
+    def dispatch(self, task_id, result):
+        try:
+            self.on_result(task_id, result)
+        except Exception as e:
+            logger.error(f"处理任务 {task_id} 的批量结果时出错: {str(e)}")
+
+    def run_once(self, force=False):
+        """
+        执行一轮：提交到期的请求并查询运行中的批量任务
+
+        Args:
+            force: 立即提交全部等待中的请求，不等待凑满或到期
+        """
+        with self.run_lock:
+            config = self.load_config()
+            options = load_batch_mode(config)
+            try:
+                submitted = self.submit_pending(options, config, force)
+            except Exception as e:
+                logger.error(f"提交批量任务时出错: {str(e)}")
+                submitted = 0
+            finished = self.poll_batches(config, options)
+            return {'submitted': submitted, 'finished': finished}
+
+    def wake(self):
+        """
+        有新的请求写入时唤醒执行器，检查是否已凑满
+        """
+        self.wake_event.set()
+
+    def status(self):
+        """
+        返回等待提交的任务和最近的批量任务
+        """
+        with self.lock:
+            pending = self.list_pending()
+            return {
+                'pending': [{'task_id': task_id, 'queued_at': queued_at} for task_id, _, queued_at in pending],
+                'batches': {batch_id: {k: v for k, v in batch.items() if k != 'input_file'} for batch_id, batch in self.batches.items()}
+            }
+
+    def loop(self):
+        while True:
+            options = load_batch_mode(self.load_config())
+            self.wake_event.wait(options['poll_interval_seconds'])
+            self.wake_event.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"执行批量任务时出错: {str(e)}")
+
+    def start(self):
+        thread = threading.Thread(target=self.loop, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 检查点目录，每个任务一个文件，任务成功后由web_app.py删除
+CHECKPOINT_DIR = os.path.join('.wucai', 'checkpoints')
+
+# 两次写入检查点之间的最小间隔（秒）
+SAVE_INTERVAL = 1.0
+
+
+def get_checkpoint_file(task_id):
+    """
+    获取任务的检查点文件路径
+    """
+    return os.path.join(CHECKPOINT_DIR, f"{task_id}.json")
+
+
+class Checkpoint:
+    """
+    处理检查点
+
+    保存已完成的工作（提取的文本、已识别的图片描述、图片增强后的内容和生成结果），
+    任务超时或取消后重试时从检查点继续，而不是从头开始。
+    path为None时不做任何持久化。
+    """
+
+    def __init__(self, path, source_file, file_hash=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.last_save = 0.0
+        self.dirty = False
+        # 源文件内容变化后检查点失效；有内容哈希时以哈希为准，不受修改时间影响
+        if file_hash:
+            self.source_signature = f"sha256:{file_hash}"
+        else:
+            stat = os.stat(source_file)
+            self.source_signature = f"{stat.st_size}:{int(stat.st_mtime)}"
+        self.data = self.load()
+
+    def load(self):
+        """
+        读取检查点，源文件不一致或文件损坏时返回空检查点
+        """
+        empty = {'source': self.source_signature, 'image_descriptions': {}}
+        if not self.path or not os.path.exists(self.path):
+            return empty
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"加载检查点时出错: {str(e)}")
+            return empty
+        if data.get('source') != self.source_signature:
+            logger.info("源文件已变化，忽略旧检查点")
+            return empty
+        data.setdefault('image_descriptions', {})
+        logger.info(f"已加载检查点: {self.path}")
+        return data
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def update(self, **values):
+        """
+        更新检查点并立即写入（用于阶段边界）
+        """
+        with self.lock:
+            self.data.update(values)
+            self.dirty = True
+        self.save(force=True)
+
+    def get_image_description(self, image_path):
+        with self.lock:
+            return self.data['image_descriptions'].get(image_path)
+
+    def record_image(self, image_path, description):
+        """
+        记录一张图片的识别结果，写入按间隔节流
+        """
+        with self.lock:
+            self.data['image_descriptions'][image_path] = description
+            self.dirty = True
+        self.save()
+
+    def save(self, force=False):
+        """
+        将检查点写入文件（先写临时文件再替换，避免中途退出导致文件损坏）
+        """
+        if not self.path:
+            return
+        now = time.time()
+        # 写文件锁在外层，保证后生成的内容不会被先生成的内容覆盖
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty or (not force and now - self.last_save < SAVE_INTERVAL):
+                    return
+                payload = json.dumps(self.data, ensure_ascii=False)
+                self.dirty = False
+                self.last_save = now
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_file = f"{self.path}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                os.replace(tmp_file, self.path)
+            except (IOError, OSError) as e:
+                logger.error(f"保存检查点时出错: {str(e)}")
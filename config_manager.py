@@ -1,5 +1,8 @@
 import os
+import copy
 import json
+import time
+import threading
 import logging
 from datetime import datetime
 
@@ -71,9 +74,31 @@ RECOMMENDED_SCENARIOS = [
     {'scenario': '多模态+大模型开源可控', 'recommended_model': 'qwen2-vl-72b-instruct（适合私有部署参考）'}
 ]
 
-def load_config():
+# 配置缓存：按配置文件的修改时间和大小判断是否过期，两次检查之间至少间隔CHECK_INTERVAL秒，
+# 处理路径上（每张图片、每次请求）读取配置不再打开和解析文件
+CHECK_INTERVAL = 1.0
+
+_cache_lock = threading.RLock()
+_cached_config = None
+_cached_signature = None
+_last_check = 0.0
+
+# 配置变更监听器：callback(new_config, old_config)
+_listeners = []
+
+def get_config_signature():
+    """
+    获取配置文件的修改时间和大小，文件不存在时返回None
     """
-    从文件加载配置
+    try:
+        stat = os.stat(CONFIG_FILE)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def read_config_file():
+    """
+    从文件读取配置并合并默认配置
     """
     try:
         if os.path.exists(CONFIG_FILE):
@@ -88,9 +113,51 @@ def load_config():
         logger.error(f"加载配置文件时出错: {str(e)}")
         return DEFAULT_CONFIG.copy()
 
+def add_listener(callback):
+    """
+    注册配置变更监听器，配置被保存或配置文件在外部被修改后调用 callback(new_config, old_config)
+    """
+    with _cache_lock:
+        _listeners.append(callback)
+
+def remove_listener(callback):
+    with _cache_lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+def _set_cache(config, signature):
+    """
+    更新缓存，配置内容发生变化时通知监听器
+    """
+    global _cached_config, _cached_signature, _last_check
+    old_config = _cached_config
+    _cached_config = config
+    _cached_signature = signature
+    _last_check = time.monotonic()
+    if old_config is not None and old_config != config:
+        for callback in list(_listeners):
+            try:
+                callback(copy.deepcopy(config), copy.deepcopy(old_config))
+            except Exception as e:
+                logger.error(f"执行配置变更监听器时出错: {str(e)}")
+
+def load_config():
+    """
+    加载配置（返回缓存的副本，配置文件修改后自动重新读取）
+    """
+    global _last_check
+    with _cache_lock:
+        if _cached_config is None or time.monotonic() - _last_check >= CHECK_INTERVAL:
+            signature = get_config_signature()
+            if _cached_config is None or signature != _cached_signature:
+                _set_cache(read_config_file(), signature)
+            else:
+                _last_check = time.monotonic()
+        return copy.deepcopy(_cached_config)
+
 def save_config(config):
     """
-    保存配置到文件
+    保存配置到文件（先写临时文件再替换，读取方不会读到写了一半的文件）
     """
     try:
         # 确保目录存在
@@ -100,8 +167,12 @@ def save_config(config):
         config['last_updated'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         # 保存配置
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+        with _cache_lock:
+            tmp_file = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, CONFIG_FILE)
+            _set_cache({**DEFAULT_CONFIG, **copy.deepcopy(config)}, get_config_signature())
         
         logger.info("配置已成功保存")
         return True
@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import mmap
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 标题偏移索引目录，每个输出文档一个JSON文件
+SECTIONS_DIR = os.path.join('.wucai', 'sections')
+
+# 单个小节的最大字节数，没有标题的超长内容按行边界继续切分，保证每次分页读取的数据量有上限
+MAX_SECTION_BYTES = 256 * 1024
+
+# 匹配代码块标记和markdown标题行（在字节内容上按行匹配）
+LINE_PATTERN = re.compile(rb'^(```.*|(#{1,6})[ \t]+(.*?)[ \t#]*)\r?$', re.M)
+
+
+def get_sections_file(filename):
+    """
+    获取输出文档的标题偏移索引文件路径
+    """
+    return os.path.join(SECTIONS_DIR, f"{filename}.json")
+
+
+def open_mmap(file_path):
+    """
+    以只读方式内存映射文件，空文件返回None
+    """
+    if os.path.getsize(file_path) == 0:
+        return None
+    with open(file_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def split_oversized(data, start, end, max_bytes=MAX_SECTION_BYTES):
+    """
+    将超过max_bytes的区间按换行符切分为多个区间
+    """
+    ranges = []
+    while end - start > max_bytes:
+        cut = data.rfind(b'\n', start, start + max_bytes)
+        if cut <= start:
+            # 没有换行符时按字节切分，并退到UTF-8字符边界
+            cut = start + max_bytes
+            while cut > start + 1 and data[cut] & 0xC0 == 0x80:
+                cut -= 1
+        else:
+            cut += 1
+        ranges.append((start, cut))
+        start = cut
+    ranges.append((start, end))
+    return ranges
+
+
+def build_section_index(file_path):
+    """
+    扫描文档中的标题行，生成按字节偏移划分的小节列表（代码块中的#不视为标题）
+
+    Returns:
+        [{'index': 序号, 'level': 标题级别（0为首个标题前的内容）, 'title': 标题, 'start': 起始字节, 'end': 结束字节}]
+    """
+    data = open_mmap(file_path)
+    if data is None:
+        return []
+    try:
+        size = len(data)
+        headings = [(0, 0, '')]  # (起始字节, 级别, 标题)
+        in_code_block = False
+        for match in LINE_PATTERN.finditer(data):
+            if match.group(1).startswith(b'```'):
+                in_code_block = not in_code_block
+            elif not in_code_block:
+                title = match.group(3).decode('utf-8', errors='replace')
+                headings.append((match.start(), len(match.group(2)), title))
+
+        sections = []
+        for i, (start, level, title) in enumerate(headings):
+            end = headings[i + 1][0] if i + 1 < len(headings) else size
+            if end <= start:
+                continue
+            for part, (part_start, part_end) in enumerate(split_oversized(data, start, end)):
+                sections.append({
+                    'index': len(sections),
+                    'level': level,
+                    'title': title if part == 0 else f"{title}（续{part}）",
+                    'start': part_start,
+                    'end': part_end
+                })
+        return sections
+    finally:
+        data.close()
+
+
+def get_section_index(file_path):
+    """
+    获取文档的标题偏移索引，优先读取与文件大小和修改时间一致的缓存
+    """
+    stat = os.stat(file_path)
+    signature = f"{stat.st_size}:{stat.st_mtime}"
+    sections_file = get_sections_file(os.path.basename(file_path))
+    if os.path.exists(sections_file):
+        try:
+            with open(sections_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('source') == signature:
+                return cached
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"读取标题偏移索引时出错: {str(e)}")
+
+    index = {'source': signature, 'size': stat.st_size, 'sections': build_section_index(file_path)}
+    try:
+        os.makedirs(SECTIONS_DIR, exist_ok=True)
+        tmp_file = f"{sections_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_file, sections_file)
+    except (IOError, OSError) as e:
+        logger.error(f"保存标题偏移索引时出错: {str(e)}")
+    return index
+
+
+def read_range(file_path, start, end):
+    """
+    通过内存映射读取文件的一个字节区间并解码为文本
+    """
+    data = open_mmap(file_path)
+    if data is None:
+        return ''
+    try:
+        return data[start:end].decode('utf-8', errors='replace')
+    finally:
+        data.close()
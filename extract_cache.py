@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 提取结果缓存目录，每个条目一个子目录（content.json和可选的images/）
+EXTRACT_CACHE_DIR = os.path.join('.wucai', 'extract_cache')
+
+# 提取器版本：修改文本提取、PPT格式化或图片识别的逻辑后递增，旧缓存随即失效
+EXTRACTOR_VERSION = 2
+
+CONTENT_FILE = 'content.json'
+IMAGES_DIR = 'images'
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    计算文件内容的SHA-256
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractCache:
+    """
+    文档提取结果缓存，与生成结果分开保存
+
+    按文件内容哈希、提取器版本和影响结果的参数（如图像模型）区分条目，分为几层：
+    pdf_text（PDF逐页文本）、ppt_text（PPT格式化后的markdown及其图片）、enhanced（图片描述整合后的内容）。
+    只修改提示词或文本模型时直接从enhanced层开始生成，不再重新解析文档和识别图片。
+    条目先写入临时目录再整体替换，命中时刷新修改时间，保留策略按最近使用时间清理。
+    """
+
+    def __init__(self, cache_dir=EXTRACT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def key(self, layer, file_hash, **params):
+        raw = json.dumps([layer, file_hash, EXTRACTOR_VERSION, params], sort_keys=True, ensure_ascii=False)
+        return f"{layer}_{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]}"
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def images_dir(self, key):
+        return os.path.join(self.entry_dir(key), IMAGES_DIR)
+
+    def get(self, key):
+        """
+        读取缓存条目，不存在或损坏时返回None
+        """
+        path = os.path.join(self.entry_dir(key), CONTENT_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"读取提取缓存 {key} 时出错: {str(e)}")
+            return None
+        try:
+            now = time.time()
+            os.utime(self.entry_dir(key), (now, now))
+        except OSError:
+            pass
+        return data
+
+    def staging_dir(self, key):
+        """
+        条目的临时目录：需要随条目保存的文件（如PPT图片）先写入这里，put时整体替换为正式目录
+        """
+        path = os.path.join(self.cache_dir, f"{key}.tmp-{os.getpid()}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def put(self, key, data):
+        """
+        写入缓存条目；staging_dir中已有的文件一并移入。其他进程已写入相同条目时保留已有条目
+
+        Returns:
+            是否写入成功
+        """
+        staging = self.staging_dir(key)
+        try:
+            with open(os.path.join(staging, CONTENT_FILE), 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            if os.path.exists(self.entry_dir(key)):
+                shutil.rmtree(staging, ignore_errors=True)
+                return False
+            os.replace(staging, self.entry_dir(key))
+            return True
+        except OSError as e:
+            logger.error(f"写入提取缓存 {key} 时出错: {str(e)}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
@@ -0,0 +1,152 @@
+import os
+import gzip
+import hashlib
+import logging
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # 未安装brotli时只使用gzip
+
+logger = logging.getLogger(__name__)
+
+# 预压缩文件目录：已完成的输出文档在这里保存.gz/.br副本，按修改时间判断是否过期
+COMPRESSED_DIR = os.path.join('.wucai', 'compressed')
+
+# 需要压缩的响应类型
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'text/plain',
+    'text/html',
+    'text/markdown',
+    'text/css',
+    'application/javascript'
+}
+
+# 小于该字节数的响应不压缩（压缩收益抵不过开销）
+MIN_COMPRESS_SIZE = 1024
+
+# 动态响应使用较低的压缩级别以节省CPU，预压缩文件使用最高级别
+DYNAMIC_GZIP_LEVEL = 5
+DYNAMIC_BROTLI_QUALITY = 4
+
+SIDECAR_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    """
+    服务端支持的压缩编码，按优先级排列
+    """
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def choose_encoding():
+    """
+    根据请求的Accept-Encoding选择压缩编码，不接受压缩时返回None
+    """
+    for encoding in available_encodings():
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    """
+    压缩动态响应内容
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=DYNAMIC_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=DYNAMIC_GZIP_LEVEL)
+
+
+def get_sidecar_file(file_path, encoding):
+    return os.path.join(COMPRESSED_DIR, os.path.basename(file_path) + SIDECAR_SUFFIXES[encoding])
+
+
+def find_sidecar(file_path, encoding):
+    """
+    查找与源文件一致的预压缩文件，不存在或已过期时返回None
+    """
+    sidecar = get_sidecar_file(file_path, encoding)
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(file_path):
+            return sidecar
+    except OSError:
+        pass
+    return None
+
+
+def write_sidecars(file_path):
+    """
+    为输出文档生成预压缩文件（已是最新的跳过）
+
+    Returns:
+        新生成的预压缩文件数
+    """
+    os.makedirs(COMPRESSED_DIR, exist_ok=True)
+    written = 0
+    with open(file_path, 'rb') as f:
+        data = None
+        for encoding in available_encodings():
+            if find_sidecar(file_path, encoding):
+                continue
+            if data is None:
+                data = f.read()
+            if encoding == 'br':
+                compressed = brotli.compress(data, quality=11)
+            else:
+                compressed = gzip.compress(data, compresslevel=9)
+            sidecar = get_sidecar_file(file_path, encoding)
+            tmp_file = f"{sidecar}.tmp"
+            with open(tmp_file, 'wb') as out:
+                out.write(compressed)
+            os.replace(tmp_file, sidecar)
+            written += 1
+    return written
+
+
+def remove_sidecars(file_path):
+    """
+    删除输出文档的预压缩文件
+    """
+    for encoding in SIDECAR_SUFFIXES:
+        sidecar = get_sidecar_file(file_path, encoding)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def compress_response(response):
+    """
+    after_request钩子：为JSON响应添加ETag并处理If-None-Match（未变化时返回304），
+    并按Accept-Encoding压缩文本类响应。文件响应（send_file）由路由自行选择预压缩文件。
+    """
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    data = response.get_data()
+    encoding = choose_encoding() if len(data) >= MIN_COMPRESS_SIZE else None
+    if len(data) >= MIN_COMPRESS_SIZE:
+        response.vary.add('Accept-Encoding')
+
+    if response.mimetype == 'application/json' and request.method in ('GET', 'HEAD') and not response.get_etag()[0]:
+        # 同一内容的不同压缩编码使用不同的ETag
+        etag = hashlib.md5(data).hexdigest() + (f'-{encoding}' if encoding else '')
+        response.set_etag(etag)
+        # 轮询接口每次都向服务端确认，内容未变化时只返回304
+        response.cache_control.no_cache = True
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            response.set_data(b'')
+            response.headers.pop('Content-Length', None)
+            return response
+
+    if encoding:
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,93 @@
+import os
+import re
+
+from image_refs import is_remote
+
+# 视觉识别批量请求的默认参数，可通过配置项image_batch覆盖
+DEFAULT_IMAGE_BATCH = {
+    'enabled': True,
+    'max_images': 6,  # 每个请求最多包含的图片数
+    'max_bytes': 2 * 1024 * 1024,  # 每个请求中图片的总字节数上限
+    'small_image_bytes': 512 * 1024  # 只合并小于该字节数的图片，大图（整页扫描、高清图表）仍单独识别
+}
+
+# 批量识别结果中每张图片的标题，如 【图片3】；位于行首，模型常在同一行紧接着输出描述
+SECTION_PATTERN = re.compile(r'^[ \t#*]*[【\[]\s*图片\s*(\d+)\s*[】\]][ \t*:：]*', re.MULTILINE)
+
+
+def load_batch_config(config):
+    """
+    合并配置中的批量识别参数和默认值
+    """
+    return {**DEFAULT_IMAGE_BATCH, **{k: v for k, v in (config.get('image_batch') or {}).items() if k in DEFAULT_IMAGE_BATCH}}
+
+
+def get_image_size(image_path):
+    """
+    返回本地图片的字节数，远程图片或无法读取时返回None
+    """
+    if is_remote(image_path):
+        return None
+    try:
+        return os.path.getsize(image_path)
+    except OSError:
+        return None
+
+
+def plan_batches(image_paths, options):
+    """
+    按图片数量和总字节数上限把图片分组，每组在一个请求中识别
+
+    远程图片、大图和无法读取大小的图片单独成组；未启用批量识别时每张图片一组
+
+    Returns:
+        [[图片路径, ...], ...]，保持原有顺序
+    """
+    if not options['enabled'] or options['max_images'] <= 1:
+        return [[path] for path in image_paths]
+
+    batches = []
+    current = []
+    current_bytes = 0
+    for path in image_paths:
+        size = get_image_size(path)
+        if size is None or size >= options['small_image_bytes']:
+            batches.append([path])
+            continue
+        if current and (len(current) >= options['max_images'] or current_bytes + size > options['max_bytes']):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(path)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(custom_prompt, count):
+    """
+    在原提示词后要求模型按图片顺序分段输出，便于拆分回每张图片
+    """
+    return (
+        f"{custom_prompt}\n\n"
+        f"以上共有{count}张图片，请按顺序分别识别。每张图片的结果单独成段，"
+        f"以单独一行的【图片1】、【图片2】……【图片{count}】开头，不要合并描述，也不要输出其他内容。"
+    )
+
+
+def parse_batch_response(text, count):
+    """
+    按【图片N】标题拆分批量识别的结果
+
+    Returns:
+        长度为count的列表，缺失或为空的图片对应None（由调用方单独重新识别）
+    """
+    descriptions = [None] * count
+    matches = list(SECTION_PATTERN.finditer(text or ''))
+    for i, match in enumerate(matches):
+        index = int(match.group(1)) - 1
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        description = text[match.end():end].strip()
+        if 0 <= index < count and description and descriptions[index] is None:
+            descriptions[index] = description
+    return descriptions
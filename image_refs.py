@@ -0,0 +1,75 @@
+import re
+from collections import namedtuple
+from pathlib import Path
+
+# markdown图片引用 ![alt](target)
+IMAGE_REF_PATTERN = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+# 图片地址后的可选标题 ![alt](path "title")
+TITLE_PATTERN = re.compile(r'\s+(?:"[^"]*"|\'[^\']*\')\s*$')
+
+# 一个图片引用：在文档中的起止位置、替代文本、原始地址和解析后的图片路径（远程图片为URL）
+ImageRef = namedtuple('ImageRef', ['start', 'end', 'alt', 'target', 'path'])
+
+
+def is_remote(target):
+    return target.startswith('http://') or target.startswith('https://')
+
+
+def clean_target(target):
+    """
+    去掉图片地址两侧的空白、尖括号和可选标题
+    """
+    target = TITLE_PATTERN.sub('', target.strip())
+    if target.startswith('<') and target.endswith('>'):
+        target = target[1:-1]
+    return target
+
+
+def find_image_refs(content, base_path):
+    """
+    扫描一次文档，找出全部图片引用及其位置
+
+    Args:
+        content: markdown内容
+        base_path: 文档路径，本地图片地址相对于其所在目录解析
+
+    Returns:
+        按位置排列的ImageRef列表
+    """
+    base_dir = Path(base_path).parent
+    resolved = {}
+    refs = []
+    for match in IMAGE_REF_PATTERN.finditer(content):
+        target = clean_target(match.group(2))
+        if not target:
+            continue
+        if target not in resolved:
+            resolved[target] = target if is_remote(target) else str((base_dir / target).resolve())
+        refs.append(ImageRef(match.start(), match.end(), match.group(1), target, resolved[target]))
+    return refs
+
+
+def rewrite_image_refs(content, refs, render):
+    """
+    按位置顺序一次拼接出替换后的文档，每个引用只替换一次，替换文本不会被再次匹配
+
+    Args:
+        content: 原始内容
+        refs: find_image_refs返回的引用列表
+        render: render(ref)返回替换文本，返回None时保留原引用
+
+    Returns:
+        替换后的内容
+    """
+    parts = []
+    last = 0
+    for ref in refs:
+        replacement = render(ref)
+        if replacement is None:
+            continue
+        parts.append(content[last:ref.start])
+        parts.append(replacement)
+        last = ref.end
+    parts.append(content[last:])
+    return ''.join(parts)
@@ -0,0 +1,154 @@
+import json
+import logging
+
+import config_manager
+
+logger = logging.getLogger(__name__)
+
+# 子进程上报路由结果的输出前缀，格式: MODEL_ROUTE:<JSON>
+MODEL_ROUTE_PREFIX = 'MODEL_ROUTE:'
+
+# 未配置文本模型时使用的模型
+DEFAULT_TEXT_MODEL = 'qwen-plus'
+
+# 输入和输出token合计不超过上下文长度的该比例时才认为能放下（token数是估算值，留出余量）
+CONTEXT_SAFETY = 0.9
+
+# 默认路由策略，可通过配置项model_routing覆盖其中任意一项
+DEFAULT_ROUTING = {
+    # fixed: 使用配置的text_model，只在文档超出其上下文长度时换用能放下的模型
+    # auto: 在候选模型中按质量、成本和延迟打分选择
+    'strategy': 'fixed',
+    # 候选模型，为空时使用SUPPORTED_MODELS中的全部文本模型
+    'candidates': ['qwen-turbo', 'qwen-plus', 'qwen-max', 'qwen-max-longcontext'],
+    'min_rating': 0,  # 候选模型的最低评分
+    'small_doc_tokens': 4000,  # 输入和输出合计不超过该token数的文档视为小文档
+    # 打分权重：质量按评分，成本按估算费用，延迟按限制器统计的平均延迟，后两者在候选模型间归一化
+    'weights': {'quality': 1.0, 'cost': 0.3, 'latency': 0.3},
+    'small_doc_weights': {'quality': 0.4, 'cost': 0.5, 'latency': 0.6},
+    # 显式规则，按顺序匹配第一条：[{'max_tokens': 8000, 'model': 'qwen-turbo'}, {'min_tokens': 100000, 'model': '...'}]
+    'rules': []
+}
+
+def load_routing(config):
+    """
+    合并配置中的路由策略和默认值
+    """
+    routing = {**DEFAULT_ROUTING, **{k: v for k, v in (config.get('model_routing') or {}).items() if k in DEFAULT_ROUTING}}
+    for key in ('weights', 'small_doc_weights'):
+        routing[key] = {**DEFAULT_ROUTING[key], **(routing.get(key) or {})}
+    return routing
+
+
+def fits(model_info, needed_tokens):
+    """
+    判断模型上下文是否能放下所需的token数，未知模型视为能放下
+    """
+    if not model_info or not model_info.get('context_length'):
+        return True
+    return needed_tokens <= model_info['context_length'] * CONTEXT_SAFETY
+
+
+def estimate_cost(model_info, input_tokens, output_tokens):
+    """
+    估算一次调用的费用（价格为每千token）
+    """
+    return (model_info.get('input_price', 0) * input_tokens + model_info.get('output_price', 0) * output_tokens) / 1000
+
+
+def score_models(candidates, input_tokens, output_tokens, weights, get_latency=None):
+    """
+    为候选模型打分，返回 [(分数, 模型信息)]，分数越高越优先
+    """
+    costs = [estimate_cost(info, input_tokens, output_tokens) for info in candidates]
+    latencies = [get_latency(info['id']) if get_latency else None for info in candidates]
+    known = [latency for latency in latencies if latency]
+    # 没有延迟统计的模型按已知模型的平均延迟计
+    average_latency = sum(known) / len(known) if known else 0
+    latencies = [latency or average_latency for latency in latencies]
+    max_cost = max(costs) or 1
+    max_latency = max(latencies) or 1
+
+    scored = []
+    for info, cost, latency in zip(candidates, costs, latencies):
+        score = (
+            weights['quality'] * info.get('rating', 0) / 5
+            - weights['cost'] * cost / max_cost
+            - weights['latency'] * latency / max_latency
+        )
+        scored.append((round(score, 4), info))
+    return scored
+
+
+def route_text_model(config, input_tokens, output_tokens, get_latency=None):
+    """
+    为一次文本生成选择模型
+
+    Args:
+        config: 当前配置
+        input_tokens: 估算的输入token数（含提示词）
+        output_tokens: 估算的输出token数
+        get_latency: 返回模型平均延迟（秒）的函数，没有数据时返回None
+
+    Returns:
+        {'model': 模型ID, 'reason': 选择原因, 'strategy': 路由策略, 'configured_model': 配置的文本模型, 'input_tokens': ..., 'output_tokens': ...}
+    """
+    routing = load_routing(config)
+    models = {info['id']: info for info in config_manager.SUPPORTED_MODELS['text_models']}
+    configured = config.get('text_model') or DEFAULT_TEXT_MODEL
+    needed = input_tokens + output_tokens
+    route = {'strategy': routing['strategy'], 'configured_model': configured, 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+
+    for rule in routing['rules']:
+        if needed < rule.get('min_tokens', 0) or needed > rule.get('max_tokens', float('inf')):
+            continue
+        if rule.get('model') and fits(models.get(rule['model']), needed):
+            return {**route, 'model': rule['model'], 'reason': 'rule'}
+
+    if routing['strategy'] != 'auto' and fits(models.get(configured), needed):
+        return {**route, 'model': configured, 'reason': 'configured'}
+
+    candidates = [
+        models[model_id] for model_id in (routing['candidates'] or list(models))
+        if model_id in models and models[model_id].get('rating', 0) >= routing['min_rating']
+    ]
+    fitting = [info for info in candidates if fits(info, needed)]
+    if not fitting:
+        # 没有能放下的模型时选择上下文最长的，由调用方决定是否截断
+        fitting = sorted(candidates or list(models.values()), key=lambda info: info.get('context_length', 0))[-1:]
+        reason = 'no_model_fits'
+    elif routing['strategy'] != 'auto':
+        reason = 'context_overflow'
+    else:
+        reason = 'auto'
+
+    if routing['strategy'] != 'auto':
+        # 超出上下文时换用能放下的模型中评分最高、价格最低的
+        best = sorted(fitting, key=lambda info: (-info.get('rating', 0), estimate_cost(info, input_tokens, output_tokens)))[0]
+        logger.info(f"文档约{needed}个token，超出模型 {configured} 的上下文长度，改用 {best['id']}")
+        return {**route, 'model': best['id'], 'reason': reason}
+
+    weights = routing['small_doc_weights'] if needed <= routing['small_doc_tokens'] else routing['weights']
+    scored = score_models(fitting, input_tokens, output_tokens, weights, get_latency)
+    score, best = max(scored, key=lambda item: item[0])
+    return {**route, 'model': best['id'], 'reason': reason, 'score': score}
+
+
+def format_route_marker(route):
+    """
+    生成上报给web_app.py的路由结果输出行
+    """
+    return MODEL_ROUTE_PREFIX + json.dumps(route, ensure_ascii=False)
+
+
+def parse_route_line(line):
+    """
+    解析子进程输出的路由结果行，不是路由结果行时返回None
+    """
+    if not line.startswith(MODEL_ROUTE_PREFIX):
+        return None
+    try:
+        route = json.loads(line[len(MODEL_ROUTE_PREFIX):])
+    except ValueError:
+        return None
+    return route if isinstance(route, dict) and route.get('model') else None
@@ -0,0 +1,340 @@
+import os
+import re
+import json
+import time
+import importlib.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 各提取后端在本机的测速结果（每页平均秒数的指数滑动平均），多个任务进程共享
+BENCHMARK_FILE = os.path.join('.wucai', 'pdf_extractors.json')
+EWMA_ALPHA = 0.3
+
+# 默认参数，可通过配置项pdf_extractor覆盖其中任意一项
+DEFAULT_EXTRACTOR_OPTIONS = {
+    'backend': 'auto',  # auto: 按测速和质量自动选择；也可指定pypdfium2、pymupdf、pypdf、pypdf2、pdfminer
+    'sample_pages': 3,  # 自动选择时每个后端试提取的页数
+    'min_quality': 0.8,  # 文本质量低于该值的页面视为乱码，换用其他后端重新提取
+    'quality_margin': 0.05  # 质量不低于最佳后端减去该值的后端中选择最快的
+}
+
+# 乱码特征：替换字符、私用区字符、控制字符，以及pdfminer无法映射字形时输出的(cid:N)
+GARBAGE_PATTERN = re.compile(r'[\ufffd\ue000-\uf8ff\x00-\x08\x0b\x0c\x0e-\x1f]|\(cid:\d+\)')
+# 按字符计数时忽略空白
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# 质量检查只对有一定长度的文本有意义，过短的页面（如空白页、只有页码）不判为乱码
+MIN_CHECK_CHARS = 20
+
+
+def text_quality(text):
+    """
+    估算提取文本的质量（0~1）：1减去乱码字符所占的比例，空文本为1
+    """
+    visible = WHITESPACE_PATTERN.sub('', text or '')
+    if len(visible) < MIN_CHECK_CHARS:
+        return 1.0
+    garbage = sum(len(match) for match in GARBAGE_PATTERN.findall(visible))
+    return max(0.0, 1 - garbage / len(visible))
+
+
+class PdfExtractor:
+    """
+    PDF文本提取后端接口：open()打开文档，返回的句柄交给page_count()和extract_page()使用
+    """
+
+    name = ''
+    module = ''  # 依赖的模块，未安装时该后端不可用
+
+    def available(self):
+        return importlib.util.find_spec(self.module) is not None
+
+    def open(self, file_path):
+        raise NotImplementedError
+
+    def page_count(self, document):
+        raise NotImplementedError
+
+    def extract_page(self, document, index):
+        raise NotImplementedError
+
+    def close(self, document):
+        pass
+
+
+class PyPDF2Extractor(PdfExtractor):
+    name = 'pypdf2'
+    module = 'PyPDF2'
+
+    def open(self, file_path):
+        from PyPDF2 import PdfReader
+        return PdfReader(file_path)
+
+    def page_count(self, document):
+        return len(document.pages)
+
+    def extract_page(self, document, index):
+        return document.pages[index].extract_text() or ''
+
+
+class PypdfExtractor(PyPDF2Extractor):
+    name = 'pypdf'
+    module = 'pypdf'
+
+    def open(self, file_path):
+        from pypdf import PdfReader
+        return PdfReader(file_path)
+
+
+class Pypdfium2Extractor(PdfExtractor):
+    name = 'pypdfium2'
+    module = 'pypdfium2'
+
+    def open(self, file_path):
+        import pypdfium2
+        return pypdfium2.PdfDocument(file_path)
+
+    def page_count(self, document):
+        return len(document)
+
+    def extract_page(self, document, index):
+        page = document[index]
+        try:
+            return page.get_textpage().get_text_range()
+        finally:
+            page.close()
+
+    def close(self, document):
+        document.close()
+
+
+class PyMuPDFExtractor(PdfExtractor):
+    name = 'pymupdf'
+    module = 'fitz'
+
+    def open(self, file_path):
+        import fitz
+        return fitz.open(file_path)
+
+    def page_count(self, document):
+        return len(document)
+
+    def extract_page(self, document, index):
+        return document[index].get_text()
+
+    def close(self, document):
+        document.close()
+
+
+class PdfminerExtractor(PdfExtractor):
+    name = 'pdfminer'
+    module = 'pdfminer'
+
+    def open(self, file_path):
+        from pdfminer.pdfpage import PDFPage
+        with open(file_path, 'rb') as f:
+            count = sum(1 for _ in PDFPage.get_pages(f))
+        return {'path': file_path, 'pages': count}
+
+    def page_count(self, document):
+        return document['pages']
+
+    def extract_page(self, document, index):
+        from pdfminer.high_level import extract_text
+        return extract_text(document['path'], page_numbers=[index])
+
+
+# 已注册的后端，按名称查找；可通过register_extractor扩展
+EXTRACTORS = {}
+
+
+def register_extractor(extractor):
+    EXTRACTORS[extractor.name] = extractor
+
+
+for _extractor in (Pypdfium2Extractor(), PyMuPDFExtractor(), PypdfExtractor(), PyPDF2Extractor(), PdfminerExtractor()):
+    register_extractor(_extractor)
+
+
+def load_extractor_options(config):
+    """
+    合并配置中的PDF提取参数和默认值
+    """
+    options = DEFAULT_EXTRACTOR_OPTIONS.copy()
+    options.update({k: v for k, v in (config.get('pdf_extractor') or {}).items() if k in DEFAULT_EXTRACTOR_OPTIONS})
+    return options
+
+
+def available_extractors():
+    return [extractor for extractor in EXTRACTORS.values() if extractor.available()]
+
+
+def load_benchmarks(benchmark_file=BENCHMARK_FILE):
+    try:
+        with open(benchmark_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, IOError) as e:
+        logger.error(f"读取PDF提取后端测速结果时出错: {str(e)}")
+        return {}
+
+
+def save_benchmarks(benchmarks, benchmark_file=BENCHMARK_FILE):
+    try:
+        os.makedirs(os.path.dirname(benchmark_file) or '.', exist_ok=True)
+        temp_file = f"{benchmark_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(benchmarks, f, indent=2)
+        os.replace(temp_file, benchmark_file)
+    except OSError as e:
+        logger.error(f"保存PDF提取后端测速结果时出错: {str(e)}")
+
+
+def sample_indexes(total, count):
+    """
+    在文档中均匀选取count页用于试提取
+    """
+    if total <= count:
+        return list(range(total))
+    step = total / count
+    return sorted({int(i * step + step / 2) for i in range(count)})
+
+
+class OpenDocuments:
+    """
+    按需打开文档，同一后端只打开一次，结束时统一关闭
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.documents = {}
+
+    def get(self, extractor):
+        if extractor.name not in self.documents:
+            self.documents[extractor.name] = extractor.open(self.file_path)
+        return self.documents[extractor.name]
+
+    def close(self):
+        for name, document in self.documents.items():
+            try:
+                EXTRACTORS[name].close(document)
+            except Exception as e:
+                logger.error(f"关闭PDF文档（{name}）时出错: {str(e)}")
+
+
+def benchmark(file_path, extractors, documents, options, benchmark_file=BENCHMARK_FILE):
+    """
+    在文档的几个样本页上试用各后端，更新本机的测速结果，并返回各后端在本文档上的文本质量
+
+    Returns:
+        ({后端名称: 平均质量}, {后端名称: {页码: 文本}}, 更新后的测速结果)
+    """
+    benchmarks = load_benchmarks(benchmark_file)
+    qualities = {}
+    samples = {}
+    total = None
+    for extractor in extractors:
+        try:
+            document = documents.get(extractor)
+            total = extractor.page_count(document) if total is None else total
+            indexes = sample_indexes(total, options['sample_pages'])
+            # 只统计逐页提取的耗时；打开文档的开销（pdfminer打开时会解析全部页面）与页数无关
+            started = time.perf_counter()
+            texts = {index: extractor.extract_page(document, index) for index in indexes}
+            elapsed = (time.perf_counter() - started) / max(len(indexes), 1)
+        except Exception as e:
+            logger.info(f"PDF提取后端 {extractor.name} 无法处理该文档: {str(e)}")
+            continue
+        samples[extractor.name] = texts
+        qualities[extractor.name] = sum(text_quality(text) for text in texts.values()) / max(len(texts), 1)
+        stats = benchmarks.get(extractor.name)
+        seconds = elapsed if not stats else stats['seconds_per_page'] * (1 - EWMA_ALPHA) + elapsed * EWMA_ALPHA
+        benchmarks[extractor.name] = {'seconds_per_page': round(seconds, 6), 'samples': (stats or {}).get('samples', 0) + 1}
+    save_benchmarks(benchmarks, benchmark_file)
+    return qualities, samples, benchmarks
+
+
+def choose_extractor(qualities, benchmarks, options):
+    """
+    在质量可接受的后端中选择本机最快的
+    """
+    if not qualities:
+        return None
+    best_quality = max(qualities.values())
+    acceptable = [
+        name for name, quality in qualities.items()
+        if quality >= min(options['min_quality'], best_quality - options['quality_margin'])
+    ]
+    return min(acceptable, key=lambda name: benchmarks.get(name, {}).get('seconds_per_page', float('inf')))
+
+
+def extract_pages(file_path, config, on_page=None):
+    """
+    逐页提取PDF文本
+
+    自动模式下先在样本页上试用全部已安装的后端，选出质量可接受且本机最快的后端提取全文；
+    之后检查每页的文本质量，疑似乱码的页面依次换用其他后端重新提取，保留质量最好的结果。
+
+    Args:
+        config: 当前配置（读取pdf_extractor）
+        on_page: on_page(完成页数, 总页数)，每提取一页调用一次（可在其中检查取消）
+
+    Returns:
+        (每页文本的列表, 使用的后端名称)
+    """
+    options = load_extractor_options(config)
+    extractors = available_extractors()
+    if not extractors:
+        raise RuntimeError("没有可用的PDF文本提取库，请安装PyPDF2: pip install PyPDF2")
+    documents = OpenDocuments(file_path)
+    try:
+        samples = {}
+        if options['backend'] != 'auto':
+            if options['backend'] not in EXTRACTORS or not EXTRACTORS[options['backend']].available():
+                raise RuntimeError(f"PDF提取后端 {options['backend']} 不存在或未安装")
+            chosen = options['backend']
+        elif len(extractors) == 1:
+            chosen = extractors[0].name
+        else:
+            qualities, samples, benchmarks = benchmark(file_path, extractors, documents, options)
+            chosen = choose_extractor(qualities, benchmarks, options) or extractors[0].name
+            logger.info(f"PDF提取后端试用结果: 质量 {qualities}，选择 {chosen}")
+
+        primary = EXTRACTORS[chosen]
+        document = documents.get(primary)
+        total = primary.page_count(document)
+        reused = samples.get(chosen, {})
+        pages = []
+        for index in range(total):
+            pages.append(reused[index] if index in reused else primary.extract_page(document, index))
+            if on_page:
+                on_page(index + 1, total)
+
+        # 逐页质量检查，疑似乱码的页面换用其他后端
+        fallbacks = [extractor for extractor in extractors if extractor.name != chosen]
+        for index, text in enumerate(pages):
+            quality = text_quality(text)
+            if quality >= options['min_quality'] or not fallbacks:
+                continue
+            best_text, best_quality, best_name = text, quality, chosen
+            for extractor in fallbacks:
+                try:
+                    candidate = samples.get(extractor.name, {}).get(index)
+                    if candidate is None:
+                        candidate = extractor.extract_page(documents.get(extractor), index)
+                except Exception as e:
+                    logger.info(f"PDF提取后端 {extractor.name} 提取第 {index + 1} 页时出错: {str(e)}")
+                    continue
+                candidate_quality = text_quality(candidate)
+                if candidate_quality > best_quality:
+                    best_text, best_quality, best_name = candidate, candidate_quality, extractor.name
+                if best_quality >= options['min_quality']:
+                    break
+            if best_name != chosen:
+                logger.info(f"第 {index + 1} 页文本质量 {quality:.2f}，改用 {best_name} 的提取结果（质量 {best_quality:.2f}）")
+                pages[index] = best_text
+        return pages, chosen
+    finally:
+        documents.close()
+
@@ -1,47 +1,45 @@
 import os
 import json
-import dashscope
-from dashscope.api_entities.dashscope_response import Role
-from PyPDF2 import PdfReader
 import argparse
 import sys
 from pathlib import Path
-import re
-from dashscope import MultiModalConversation
 import tempfile
+import hashlib
+import shutil
 from datetime import datetime
 import traceback
 import logging
+import time
+import threading
+import signal
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 
 # 导入配置管理器
 import config_manager
+# 文本与视觉调用共享的自适应并发限制器
+from rate_limiter import get_limiter
+# 处理检查点，超时或取消后重试时从已完成的工作继续
+from checkpoint import Checkpoint
+# 按文档规模、成本和延迟选择文本模型
+from model_router import route_text_model, format_route_marker, DEFAULT_TEXT_MODEL
+# 本地token估算，API返回的实际用量作为校准样本上报
+from token_estimator import estimate_tokens, estimate_output_tokens, format_sample_marker
+# markdown图片引用的扫描和一次性替换
+from image_refs import find_image_refs, rewrite_image_refs, is_remote
+# 小图片合并到一个请求中识别
+from image_batch import load_batch_config, plan_batches, build_batch_prompt, parse_batch_response
+# 低优先级任务的生成请求写出后交给批量执行器
+from batch_executor import write_request, DEFERRED_EXIT_CODE
+# 文档提取结果缓存（与生成结果分开），修改提示词或文本模型时不再重新解析文档和识别图片
+from extract_cache import ExtractCache, hash_file
+# 可替换的PDF文本提取后端，按本机测速和文本质量自动选择
+from pdf_extractors import extract_pages, load_extractor_options
+# 退出前上报峰值内存，供工作池记录每个任务的内存占用
+from worker_pool import format_peak_marker
 
 # 修复：确保所有配置都从小球配置中心读取，不再使用环境变量
 
-# 创建运行日志目录 - 按日期创建日志文件
-today = datetime.now().strftime('%Y%m%d')
-log_dir = "run-log"
-os.makedirs(log_dir, exist_ok=True)
-
-# 配置日志 - 按天记录到同一天的日志文件
-log_filename = f"{log_dir}/{today}.log"
-
-# 为Windows系统设置控制台编码
-try:
-    if sys.platform.startswith('win'):
-        # 设置控制台编码为UTF-8
-        import ctypes
-        kernel32 = ctypes.windll.kernel32
-        kernel32.SetConsoleCP(65001)  # 设置控制台输入编码为UTF-8
-        kernel32.SetConsoleOutputCP(65001)  # 设置控制台输出编码为UTF-8
-        
-        # 同时设置标准输出和标准错误的编码
-        import io
-        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
-        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
-except Exception as e:
-    print(f"设置控制台编码时出错: {str(e)}")
-
 # 自定义StreamHandler类来处理编码问题
 class UnicodeStreamHandler(logging.StreamHandler):
     def __init__(self, stream=None):
@@ -64,16 +62,59 @@ class UnicodeStreamHandler(logging.StreamHandler):
         except Exception:
             self.handleError(record)
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        UnicodeStreamHandler()  # 使用自定义的StreamHandler
-    ],
-    force=True  # 强制重新配置日志系统
-)
+def setup_logging():
+    """
+    配置控制台编码和日志输出（按天记录到run-log目录）
+
+    只在作为脚本运行时调用，导入本模块不会改动调用方的日志配置
+    """
+    # 创建运行日志目录 - 按日期创建日志文件
+    today = datetime.now().strftime('%Y%m%d')
+    log_dir = "run-log"
+    os.makedirs(log_dir, exist_ok=True)
+    
+    # 配置日志 - 按天记录到同一天的日志文件
+    log_filename = f"{log_dir}/{today}.log"
+    
+    # 为Windows系统设置控制台编码
+    try:
+        if sys.platform.startswith('win'):
+            # 设置控制台编码为UTF-8
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetConsoleCP(65001)  # 设置控制台输入编码为UTF-8
+            kernel32.SetConsoleOutputCP(65001)  # 设置控制台输出编码为UTF-8
+            
+            # 同时设置标准输出和标准错误的编码
+            import io
+            sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+            sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+    except Exception as e:
+        print(f"设置控制台编码时出错: {str(e)}")
+    
+    # 配置日志
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_filename, encoding='utf-8'),
+            UnicodeStreamHandler()  # 使用自定义的StreamHandler
+        ],
+        force=True  # 强制重新配置日志系统
+    )
+
+def preload_sdk():
+    """
+    在后台线程中预先导入DashScope SDK（导入耗时较长），与文件解析并行进行；
+    首次调用API时如果导入尚未完成，会等待导入锁而不会重复导入
+    """
+    def load():
+        try:
+            importlib.import_module('dashscope')
+        except Exception as e:
+            log_error(f"预加载DashScope SDK时出错: {str(e)}")
+    
+    threading.Thread(target=load, daemon=True).start()
 
 logger = logging.getLogger(__name__)
 
@@ -89,17 +130,193 @@ def log_debug(message):
     """记录调试日志"""
     logger.debug(message)
 
-def read_pdf(file_path):
+# 单次API请求的默认超时时间（秒），可通过配置项api_request_timeout调整
+DEFAULT_REQUEST_TIMEOUT = 180
+
+# 任务被取消时的退出码，需与web_app.py中的CANCELLED_EXIT_CODE保持一致
+CANCELLED_EXIT_CODE = 3
+
+# PPT图片和PDF页面图片的临时目录前缀（需与retention.py保持一致），处理成功后删除，残留目录由保留策略按时间清理
+PPT_TEMP_PREFIX = 'wucai_ppt_'
+
+# PDF视觉补充识别的默认参数，可通过配置项pdf_vision覆盖
+DEFAULT_PDF_VISION = {
+    'enabled': True,
+    'min_chars_per_page': 50,  # 提取到的非空白字符少于该值的页面视为扫描页或图片页，交给视觉模型识别
+    'max_pages': 200,  # 单个文档最多识别的页数，超出的页面只保留本地提取的文本
+    'min_image_bytes': 4096  # 忽略小于该字节数的嵌入图片（图标、装饰线等）
+}
+
+# 扫描页/图片页的识别提示词
+PDF_PAGE_PROMPT = "这是PDF文档中的一页（或页面中的图片）。请完整识别其中的全部文字，保持原有的标题、段落、列表和表格结构；如果包含图表或示意图，简要描述其内容和关键数据。只输出识别结果。"
+
+def get_task_image_dir(task_key):
+    """
+    获取PPT图片和PDF页面图片的临时目录：每个任务独立，避免并发任务的同名图片互相覆盖；
+    同一任务重试时目录不变，检查点中按路径记录的图片描述仍然有效
+    """
+    digest = hashlib.sha1(os.path.abspath(task_key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"{PPT_TEMP_PREFIX}{digest}")
+
+# 取消标记文件路径，由--cancel-file参数指定；文件存在即表示任务已被取消
+_cancel_file = None
+
+# 本次运行中识别失败的图片数，有失败时不写入提取缓存，避免缓存不完整的内容
+_image_failures = 0
+
+class TaskCancelled(BaseException):
+    """
+    任务被取消。继承BaseException，避免被各处理函数中的except Exception吞掉
+    """
+    pass
+
+def check_cancelled():
+    """
+    在页、图片、输出分片等工作单元的边界检查任务是否已被取消
+    """
+    if _cancel_file and os.path.exists(_cancel_file):
+        raise TaskCancelled()
+
+# 多线程识别图片时保护标准输出，避免标记行交错
+_output_lock = threading.Lock()
+
+def emit_marker(marker):
+    """
+    输出一行供web_app.py解析的标记
+    """
+    with _output_lock:
+        print(marker, flush=True)
+
+def report_progress(stage, done, total):
+    """
+    输出阶段进度标记，以便web_app.py根据实际完成的工作单元计算进度
+    """
+    emit_marker(f"PROGRESS:{stage}:{done}:{total}")
+
+def log_config_change(new_config, old_config):
+    """
+    处理过程中在配置中心切换了模型时记录日志，后续的API调用使用新模型
+    """
+    for key in ('text_model', 'image_model'):
+        if new_config.get(key) != old_config.get(key):
+            log_info(f"检测到配置变更: {key} {old_config.get(key)} -> {new_config.get(key)}")
+
+def load_pdf_vision_config(config):
+    """
+    合并配置中的PDF视觉识别参数和默认值
+    """
+    return {**DEFAULT_PDF_VISION, **{k: v for k, v in (config.get('pdf_vision') or {}).items() if k in DEFAULT_PDF_VISION}}
+
+def count_visible_chars(text):
+    return len(''.join(text.split()))
+
+def render_pdf_page(file_path, page_index, output_path):
+    """
+    将PDF页面渲染为图片（需要安装PyMuPDF），未安装时返回False
+    """
+    try:
+        import fitz
+    except ImportError:
+        return False
+    with fitz.open(file_path) as document:
+        document[page_index].get_pixmap(dpi=150).save(output_path)
+    return True
+
+def extract_page_images(file_path, page, page_index, image_dir, min_image_bytes):
+    """
+    获取低文字页面需要识别的图片：安装了PyMuPDF时渲染整页，否则提取页面中的嵌入图片
+
+    Returns:
+        图片路径列表
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    rendered = os.path.join(image_dir, f"page{page_index + 1:04d}.png")
+    if os.path.exists(rendered) or render_pdf_page(file_path, page_index, rendered):
+        return [rendered]
+    
+    image_paths = []
+    for n, image in enumerate(page.images):
+        if len(image.data) < min_image_bytes:
+            continue
+        ext = os.path.splitext(image.name)[1] or '.png'
+        image_path = os.path.join(image_dir, f"page{page_index + 1:04d}_{n + 1}{ext}")
+        if not os.path.exists(image_path):
+            with open(image_path, 'wb') as f:
+                f.write(image.data)
+        image_paths.append(image_path)
+    return image_paths
+
+def extract_pdf_pages(file_path, config, cache=None, file_hash=None):
+    """
+    逐页提取PDF文本；提供提取缓存时按文件哈希复用之前的提取结果
+
+    Returns:
+        每页文本的列表
+    """
+    if cache and file_hash:
+        cache_key = cache.key('pdf_text', file_hash, backend=load_extractor_options(config)['backend'])
+        cached = cache.get(cache_key)
+        if cached:
+            log_info(f"从提取缓存恢复PDF文本，共 {len(cached['pages'])} 页")
+            report_progress('extract', len(cached['pages']), len(cached['pages']))
+            return cached['pages']
+    
+    def on_page(done, total):
+        check_cancelled()
+        report_progress('extract', done, total)
+    
+    page_texts, backend = extract_pages(file_path, config, on_page)
+    log_info(f"使用 {backend} 提取PDF文本，共 {len(page_texts)} 页")
+    if cache and file_hash:
+        cache.put(cache_key, {'pages': page_texts, 'backend': backend})
+    return page_texts
+
+def read_pdf_with_vision(api_key, file_path, image_dir, config, checkpoint=None, cache=None, file_hash=None):
     """
-    读取PDF文件内容
+    读取PDF文件内容：逐页本地提取文本，文字密度低于阈值的页面（扫描页、图片页）
+    渲染或提取页面图片后并行交给视觉模型识别，识别结果按页码合并回文档
     """
+    options = load_pdf_vision_config(config)
     try:
         log_info(f"开始读取PDF文件: {file_path}")
+        page_texts = extract_pdf_pages(file_path, config, cache, file_hash)
+        total_pages = len(page_texts)
+        
+        low_text_pages = [
+            i for i, text in enumerate(page_texts)
+            if count_visible_chars(text) < options['min_chars_per_page']
+        ]
+        if not options['enabled'] or not low_text_pages:
+            report_progress('image', 0, 0)
+            text_content = "\n".join(page_texts) + "\n"
+            log_info(f"PDF文件读取完成，总字符数: {len(text_content)}")
+            return text_content
+        
+        if len(low_text_pages) > options['max_pages']:
+            log_info(f"文字较少的页面共 {len(low_text_pages)} 页，只识别前 {options['max_pages']} 页")
+            low_text_pages = low_text_pages[:options['max_pages']]
+        log_info(f"共 {total_pages} 页，其中 {len(low_text_pages)} 页文字较少，交给视觉模型识别")
+        
+        from PyPDF2 import PdfReader
         reader = PdfReader(file_path)
-        text_content = ""
-        for page in reader.pages:
-            text_content += page.extract_text() + "\n"
-        log_info(f"PDF文件读取完成，总字符数: {len(text_content)}")
+        page_images = {}
+        for i in low_text_pages:
+            check_cancelled()
+            try:
+                page_images[i] = extract_page_images(file_path, reader.pages[i], i, image_dir, options['min_image_bytes'])
+            except Exception as e:
+                log_error(f"提取第 {i + 1} 页的图片时出错: {str(e)}")
+                page_images[i] = []
+        
+        image_paths = [path for i in low_text_pages for path in page_images[i]]
+        image_descriptions = recognize_images(api_key, image_paths, PDF_PAGE_PROMPT, checkpoint, batch=False)
+        
+        parts = []
+        for i, text in enumerate(page_texts):
+            recognized = [image_descriptions[path] for path in page_images.get(i, []) if path in image_descriptions]
+            parts.append("\n\n".join([text] + recognized) if text.strip() else "\n\n".join(recognized))
+        text_content = "\n".join(parts) + "\n"
+        log_info(f"PDF文件读取完成，视觉识别 {len(image_descriptions)}/{len(image_paths)} 张图片，总字符数: {len(text_content)}")
         return text_content
     except Exception as e:
         error_msg = f"读取PDF文件时出错: {str(e)}"
@@ -115,6 +332,7 @@ def read_markdown(file_path):
         log_info(f"开始读取markdown文件: {file_path}")
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
+        report_progress('extract', 1, 1)
         log_info(f"markdown文件读取完成，总字符数: {len(content)}")
         return content
     except Exception as e:
@@ -123,9 +341,9 @@ def read_markdown(file_path):
         log_error(f"详细错误信息: {traceback.format_exc()}")
         return None
 
-def read_ppt(file_path):
+def read_ppt(file_path, image_dir=None):
     """
-    读取PPT文件内容，提取文本和图片
+    读取PPT文件内容，提取文本和图片（图片保存到image_dir，默认为系统临时目录）
     """
     try:
         log_info(f"开始读取PPT文件: {file_path}")
@@ -152,8 +370,12 @@ def read_ppt(file_path):
         
         prs = Presentation(file_path)
         content = {"slides": [], "images": []}
+        image_dir = image_dir or tempfile.gettempdir()
+        os.makedirs(image_dir, exist_ok=True)
+        total_slides = len(prs.slides)
         
         for i, slide in enumerate(prs.slides):
+            check_cancelled()
             slide_content = {
                 "slide_number": i + 1,
                 "text": [],
@@ -178,13 +400,14 @@ def read_ppt(file_path):
                     image = shape.image
                     # 保存图片到临时文件
                     image_filename = f"slide_{i+1}_image_{len(slide_content['images'])+1}.png"
-                    image_path = os.path.join(tempfile.gettempdir(), image_filename)
+                    image_path = os.path.join(image_dir, image_filename)
                     with open(image_path, "wb") as f:
                         f.write(image.blob)
                     slide_content["images"].append(image_path)
                     content["images"].append(image_path)
             
             content["slides"].append(slide_content)
+            report_progress('extract', i + 1, total_slides)
         
         log_info(f"PPT文件读取完成，共 {len(content['slides'])} 张幻灯片")
         return content
@@ -200,6 +423,33 @@ def read_ppt(file_path):
         log_error(f"详细错误信息: {traceback.format_exc()}")
         raise Exception(error_msg) from e  # 重新抛出异常以确保被外层捕获
 
+def read_ppt_markdown(file_path, image_dir, cache=None, file_hash=None):
+    """
+    读取PPT并格式化为markdown；提供提取缓存时图片随缓存条目保存，之后的任务直接复用
+
+    Returns:
+        markdown内容（图片以绝对路径引用）
+    """
+    if not (cache and file_hash):
+        return format_ppt_content_for_markdown(read_ppt(file_path, image_dir))
+    
+    cache_key = cache.key('ppt_text', file_hash)
+    cached = cache.get(cache_key)
+    if cached:
+        log_info("从提取缓存恢复PPT内容和图片")
+        report_progress('extract', cached['slides'], cached['slides'])
+        return cached['content']
+    
+    # 图片先写入缓存条目的临时目录，写入完成后连同内容整体移入正式目录，引用路径随之改写
+    staging_images = os.path.abspath(os.path.join(cache.staging_dir(cache_key), 'images'))
+    final_images = os.path.abspath(cache.images_dir(cache_key))
+    ppt_content = read_ppt(file_path, staging_images)
+    content = format_ppt_content_for_markdown(ppt_content).replace(staging_images, final_images)
+    if cache.put(cache_key, {'content': content, 'slides': len(ppt_content['slides'])}) or os.path.isdir(final_images):
+        return content
+    # 缓存写入失败时仍使用任务自己的图片目录
+    return format_ppt_content_for_markdown(read_ppt(file_path, image_dir))
+
 def format_ppt_content_for_markdown(ppt_content):
     """
     将PPT内容格式化为markdown格式
@@ -222,77 +472,102 @@ def format_ppt_content_for_markdown(ppt_content):
     log_info(f"PPT内容格式化完成，总字符数: {len(md_content)}")
     return md_content
 
-def extract_images_from_markdown(markdown_content, base_path):
+def extract_images_from_markdown(markdown_content, base_path, refs=None):
     """
-    从markdown内容中提取图片路径
+    从markdown内容中提取图片路径（去重，保持出现顺序）
+
+    Args:
+        refs: 已扫描出的图片引用，不传时重新扫描
     """
     log_info("开始从markdown内容中提取图片路径")
-    # 匹配markdown中的图片语法 ![alt text](image_path)
-    image_pattern = r'!\[.*?\]\((.*?)\)'
-    matches = re.findall(image_pattern, markdown_content)
+    if refs is None:
+        refs = find_image_refs(markdown_content, base_path)
     
     image_paths = []
-    for match in matches:
-        # 处理相对路径和绝对路径
-        if match.startswith('http://') or match.startswith('https://'):
-            # 远程图片URL
-            image_paths.append(match)
+    seen = set()
+    for ref in refs:
+        if ref.path in seen:
+            continue
+        seen.add(ref.path)
+        # 远程图片URL直接识别，本地图片需要存在
+        if is_remote(ref.path) or os.path.exists(ref.path):
+            image_paths.append(ref.path)
         else:
-            # 本地图片路径，转换为绝对路径
-            img_path = Path(base_path).parent / match
-            if img_path.exists():
-                image_paths.append(str(img_path.resolve()))
-            else:
-                warning_msg = f"警告: 图片文件不存在 - {img_path}"
-                log_info(warning_msg)
+            warning_msg = f"警告: 图片文件不存在 - {ref.path}"
+            log_info(warning_msg)
     
     log_info(f"提取到 {len(image_paths)} 个图片路径")
     return image_paths
 
+def merge_image_descriptions(content, refs, image_descriptions):
+    """
+    将图片描述一次性写入文档：每个识别成功的图片引用替换为图片和描述，按解析后的完整路径匹配
+    """
+    def render(ref):
+        description = image_descriptions.get(ref.path)
+        if not description:
+            return None
+        return f'![图示]({ref.path})\n\n**图片描述**: {description}\n\n'
+    
+    return rewrite_image_refs(content, refs, render)
+
 def recognize_image_with_dashscope(api_key, image_path, custom_prompt="请详细描述这张图片的内容"):
     """
     使用DashScope视觉模型识别图片
     """
     log_info(f"开始识别图片: {image_path}")
+    return call_vision_model(api_key, [image_path], custom_prompt)
+
+def recognize_image_batch(api_key, image_paths, custom_prompt):
+    """
+    在一个请求中识别多张图片，按【图片N】标题拆分结果
+
+    Returns:
+        与image_paths对应的描述列表，未能拆分出结果的图片为None
+    """
+    log_info(f"开始批量识别 {len(image_paths)} 张图片: {image_paths}")
+    result = call_vision_model(api_key, image_paths, build_batch_prompt(custom_prompt, len(image_paths)))
+    return parse_batch_response(result, len(image_paths))
+
+def call_vision_model(api_key, image_paths, custom_prompt):
+    """
+    调用DashScope视觉模型，一条消息中可以包含多张图片
+
+    Returns:
+        模型返回的文本，失败时返回None
+    """
     log_info(f"使用提示词: {custom_prompt}")
+    import dashscope
+    from dashscope import MultiModalConversation
     dashscope.api_key = api_key
     
-    # 加载配置以获取图像模型名称
+    # 加载配置以获取图像模型名称（读取内存缓存，配置文件修改后自动更新）
     config = config_manager.load_config()
     image_model = config.get('image_model', 'qwen-vl-plus')
     
     try:
-        # 构建消息，包含图片和描述请求
-        if image_path.startswith('http://') or image_path.startswith('https://'):
-            # 远程图片URL
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"image": image_path},
-                        {"text": custom_prompt}
-                    ]
-                }
-            ]
-        else:
-            # 本地图片文件
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"image": f"file://{image_path}"},
-                        {"text": custom_prompt}
-                    ]
-                }
-            ]
+        # 构建消息，包含图片和描述请求（远程图片使用URL，本地图片使用file://路径）
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"image": image_path if is_remote(image_path) else f"file://{image_path}"}
+                    for image_path in image_paths
+                ] + [{"text": custom_prompt}]
+            }
+        ]
         
         log_info(f"调用DashScope视觉模型API...")
         log_info(f"使用图像模型: {image_model}")
         
-        # 使用从配置管理器获取的图像模型
-        response = MultiModalConversation.call(
-            model=image_model,
-            messages=messages
+        # 使用从配置管理器获取的图像模型，经自适应限制器调用，限流时带抖动重试
+        response = get_limiter().call(
+            image_model,
+            lambda: MultiModalConversation.call(
+                model=image_model,
+                messages=messages,
+                request_timeout=config.get('api_request_timeout', DEFAULT_REQUEST_TIMEOUT)
+            )
         )
         
         log_info(f"API响应状态码: {response.status_code}")
@@ -314,7 +589,7 @@ def recognize_image_with_dashscope(api_key, image_path, custom_prompt="请详细
                 log_info("未在图像识别API响应中找到token用量信息")
             
             # 输出图片识别的token用量，以便累加统计
-            print(f"IMAGE_TOKEN_USAGE:{image_tokens}")
+            emit_marker(f"IMAGE_TOKEN_USAGE:{image_tokens}")
             
             # 处理返回的多模态内容
             if isinstance(result, list):
@@ -339,55 +614,100 @@ def recognize_image_with_dashscope(api_key, image_path, custom_prompt="请详细
         log_error(f"详细错误信息: {traceback.format_exc()}")
         return None
 
-def process_markdown_with_images(api_key, markdown_content, base_path, user_prompt, config):
+def recognize_images(api_key, image_paths, custom_prompt="请详细描述这张图片的内容，包括其中的关键信息、文字、数据或其他重要元素。", checkpoint=None, batch=True):
     """
-    处理包含图片的markdown文件，对图片进行识别并整合内容
+    并行识别多张图片，实际并发数由自适应限制器控制
+    检查点中已有描述的图片直接复用，新的识别结果写入检查点
+    小图片按配置项image_batch分组，每组在一个请求中识别，减少请求次数
+
+    Args:
+        batch: 是否允许合并请求（整页OCR等需要完整输出的场景应关闭）
+
+    Returns:
+        {图片路径: 描述}，识别失败的图片不包含在内
     """
-    log_info("开始处理markdown文件中的图片...")
-    log_info(f"用户提示词: {user_prompt}")
+    image_descriptions = {}
+    if not image_paths:
+        report_progress('image', 0, 0)
+        return image_descriptions
     
-    # 提取图片路径
-    image_paths = extract_images_from_markdown(markdown_content, base_path)
+    report_progress('image', 0, len(image_paths))
+    completed = 0
+    progress_lock = threading.Lock()
     
-    # 存储图片识别结果
-    image_descriptions = {}
+    def advance(count):
+        nonlocal completed
+        with progress_lock:
+            completed += count
+            report_progress('image', completed, len(image_paths))
     
-    # 对每张图片进行识别
+    pending = []
     for img_path in image_paths:
-        log_info(f"正在识别图片: {img_path}")
-        description = recognize_image_with_dashscope(
-            api_key, 
-            img_path, 
-            "请详细描述这张图片的内容，包括其中的关键信息、文字、数据或其他重要元素。"
-        )
+        description = checkpoint.get_image_description(img_path) if checkpoint else None
         if description:
+            log_info(f"从检查点恢复图片描述: {img_path}")
             image_descriptions[img_path] = description
-            log_info(f"图片识别完成: {img_path}")
+            advance(1)
         else:
-            log_error(f"图片识别失败: {img_path}")
-    
-    # 将图片描述整合到原始markdown内容中
-    enhanced_content = markdown_content
-    
-    for img_path, description in image_descriptions.items():
-        # 在图片下方添加描述
-        image_ref = f"!["
-        # 找到图片引用的位置并添加描述
-        if img_path.startswith('http'):
-            # 处理URL图片
-            image_tag = f"!["
-            pattern = r'!\[.*?\]\(' + re.escape(img_path) + r'\)'
+            pending.append(img_path)
+    
+    options = load_batch_config(config_manager.load_config())
+    if not batch:
+        options['enabled'] = False
+    batches = plan_batches(pending, options)
+    if len(batches) < len(pending):
+        log_info(f"{len(pending)} 张图片合并为 {len(batches)} 个识别请求")
+    
+    def recognize(batch_paths):
+        check_cancelled()
+        if len(batch_paths) == 1:
+            log_info(f"正在识别图片: {batch_paths[0]}")
+            descriptions = [recognize_image_with_dashscope(api_key, batch_paths[0], custom_prompt)]
         else:
-            # 处理本地图片
-            original_img_path = Path(img_path).name
-            pattern = r'!\[.*?\][^)]*' + re.escape(original_img_path) + r'[^)]*\)'
-        
-        # 替换markdown，添加图片描述
-        enhanced_content = re.sub(
-            pattern, 
-            f'![图示]({img_path})\n\n**图片描述**: {description}\n\n', 
-            enhanced_content
-        )
+            descriptions = recognize_image_batch(api_key, batch_paths, custom_prompt)
+            # 批量结果中缺失的图片单独重新识别
+            for i, img_path in enumerate(batch_paths):
+                if descriptions[i] is None:
+                    check_cancelled()
+                    log_info(f"批量识别结果中缺少该图片，单独识别: {img_path}")
+                    descriptions[i] = recognize_image_with_dashscope(api_key, img_path, custom_prompt)
+        for img_path, description in zip(batch_paths, descriptions):
+            if description and checkpoint:
+                checkpoint.record_image(img_path, description)
+        advance(len(batch_paths))
+        return descriptions
+    
+    # 线程数取限制器的上限，实际在途请求数由限制器按模型动态调整
+    with ThreadPoolExecutor(max_workers=get_limiter().max_limit) as executor:
+        results = executor.map(recognize, batches)
+        for batch_paths, descriptions in zip(batches, results):
+            for img_path, description in zip(batch_paths, descriptions):
+                if description:
+                    image_descriptions[img_path] = description
+                    log_info(f"图片识别完成: {img_path}")
+                else:
+                    log_error(f"图片识别失败: {img_path}")
+    
+    global _image_failures
+    _image_failures += len(image_paths) - len(image_descriptions)
+    return image_descriptions
+
+def process_markdown_with_images(api_key, markdown_content, base_path, user_prompt, config, checkpoint=None):
+    """
+    处理包含图片的markdown文件，对图片进行识别并整合内容
+    """
+    log_info("开始处理markdown文件中的图片...")
+    log_info(f"用户提示词: {user_prompt}")
+    
+    # 扫描一次图片引用，提取图片路径
+    refs = find_image_refs(markdown_content, base_path)
+    image_paths = extract_images_from_markdown(markdown_content, base_path, refs)
+    
+    # 并行识别图片，存储识别结果
+    image_descriptions = recognize_images(api_key, image_paths, checkpoint=checkpoint)
+    
+    # 将图片描述整合到原始markdown内容中（在图片位置替换为图片和描述）
+    enhanced_content = merge_image_descriptions(markdown_content, refs, image_descriptions)
     
     # 如果没有图片，直接返回原始内容
     if not image_paths:
@@ -398,19 +718,10 @@ def process_markdown_with_images(api_key, markdown_content, base_path, user_prom
         log_info("markdown图片处理完成")
         return enhanced_content
 
-def call_dashscope_api(api_key, content, user_prompt, config, file_type="pdf"):
+def build_full_prompt(content, user_prompt, config, file_type="pdf"):
     """
-    调用DashScope API处理内容
+    根据文件类型构建发送给文本模型的完整提示词
     """
-    log_info(f"开始调用DashScope API处理{file_type}内容...")
-    log_info(f"内容长度: {len(content)} 字符")
-    log_info(f"用户提示词: {user_prompt}")
-    
-    # 修复：使用传入的api_key参数，而不是从环境变量获取
-    dashscope.api_key = api_key
-    
-    # 修复：使用传入的config参数，确保与config_manager保持一致
-    
     # 根据文件类型调整提示词
     if file_type == "markdown":
         default_prompt = config.get("default_markdown_prompt", "")
@@ -422,33 +733,104 @@ def call_dashscope_api(api_key, content, user_prompt, config, file_type="pdf"):
     # 如果没有配置提示词，使用空字符串
     default_prompt = default_prompt or ""
     
-    full_prompt = f"{default_prompt}\n\n额外要求: {user_prompt}\n\n内容如下:\n\n{content}"
+    return f"{default_prompt}\n\n额外要求: {user_prompt}\n\n内容如下:\n\n{content}"
+
+def choose_text_model(content, user_prompt, config, file_type="pdf"):
+    """
+    按估算的输入输出token数、模型上下文长度、价格和观测到的延迟为本次生成选择文本模型
+    """
+    input_tokens = estimate_tokens(build_full_prompt(content, user_prompt, config, file_type))
+    route = route_text_model(config, input_tokens, estimate_output_tokens(estimate_tokens(content)), get_limiter().get_latency)
+    log_info(f"选择文本模型: {route['model']} (原因: {route['reason']}, 估算输入{input_tokens} token)")
+    return route
+
+def build_messages(content, user_prompt, config, file_type="pdf"):
+    """
+    构建文本生成请求的消息列表（实时调用和批量请求共用）
+    """
+    full_prompt = build_full_prompt(content, user_prompt, config, file_type)
     
     log_info(f"构建的完整提示词长度: {len(full_prompt)} 字符")
     log_debug(f"完整提示词内容: {full_prompt[:500]}...")  # 只记录前500个字符
     
-    messages = [
+    return [
         {"role": "system", "content": "你是一个专业的文档处理助手，擅长将各种内容整理成结构化markdown格式文档"},
         {"role": "user", "content": full_prompt}
     ]
+
+def call_dashscope_api(api_key, content, user_prompt, config, file_type="pdf", model=None):
+    """
+    调用DashScope API处理内容
+
+    Args:
+        model: 使用的文本模型，不传时使用配置的text_model
+    """
+    log_info(f"开始调用DashScope API处理{file_type}内容...")
+    log_info(f"内容长度: {len(content)} 字符")
+    log_info(f"用户提示词: {user_prompt}")
+    
+    # 修复：使用传入的api_key参数，而不是从环境变量获取
+    import dashscope
+    dashscope.api_key = api_key
+    
+    # 修复：使用传入的config参数，确保与config_manager保持一致
+    messages = build_messages(content, user_prompt, config, file_type)
     
     # 初始化token用量
     total_tokens = 0
     
     try:
-        # 从配置中获取模型名称，如果未配置则使用默认值
-        text_model = config.get('text_model', 'qwen-plus')
+        # 使用路由选择的模型，未指定时从配置中获取模型名称，如果未配置则使用默认值
+        text_model = model or config.get('text_model', 'qwen-plus')
         
-        response = dashscope.Generation.call(
-            model=text_model,
-            messages=messages,
-            result_format='message'
-        )
+        expected_tokens = estimate_output_tokens(estimate_tokens(content))
+        result_parts = []
+        
+        def stream_generation():
+            """
+            执行一次流式生成，返回最后一个响应；失败重试时从头开始
+            """
+            nonlocal expected_tokens
+            result_parts.clear()
+            report_progress('generate', 0, expected_tokens)
+            last_report = time.time()
+            response = None
+            # 使用流式输出，按已生成的token数上报进度
+            for response in dashscope.Generation.call(
+                model=text_model,
+                messages=messages,
+                result_format='message',
+                stream=True,
+                incremental_output=True,
+                request_timeout=config.get('api_request_timeout', DEFAULT_REQUEST_TIMEOUT)
+            ):
+                check_cancelled()
+                if response.status_code != 200:
+                    break
+                # 以首个分片的等待时间作为延迟，不随输出长度变化
+                get_limiter().mark_first_chunk()
+                chunk = response.output.choices[0].message.content
+                if chunk:
+                    result_parts.append(chunk)
+                # 节流上报，避免每个分片都输出一行
+                if response.usage and time.time() - last_report >= 0.5:
+                    output_tokens = response.usage.get('output_tokens', 0)
+                    expected_tokens = max(expected_tokens, output_tokens + 1)
+                    report_progress('generate', output_tokens, expected_tokens)
+                    last_report = time.time()
+            return response
+        
+        # 经自适应限制器调用，限流时带抖动重试
+        response = get_limiter().call(text_model, stream_generation)
+        
+        if response is None:
+            log_error("API调用失败: 未收到任何响应")
+            return None
         
         log_info(f"API响应状态码: {response.status_code}")
         
         if response.status_code == 200:
-            result = response.output.choices[0].message.content
+            result = "".join(result_parts)
             log_info(f"API调用成功，返回内容长度: {len(result) if result else 0} 字符")
             log_debug(f"API返回内容: {result[:500] if result else 'None'}...")  # 只记录前500个字符
             
@@ -458,11 +840,14 @@ def call_dashscope_api(api_key, content, user_prompt, config, file_type="pdf"):
                 output_tokens = response.usage.get('output_tokens', 0)
                 total_tokens = input_tokens + output_tokens
                 log_info(f"Token用量统计: 输入{input_tokens} + 输出{output_tokens} = 总计{total_tokens}")
+                if input_tokens:
+                    emit_marker(format_sample_marker('\n'.join(message['content'] for message in messages), input_tokens))
+                report_progress('generate', output_tokens, output_tokens)
             else:
                 log_info("未在API响应中找到token用量信息")
                 
             # 输出token用量，以便web_app.py捕获
-            print(f"TOKEN_USAGE:{total_tokens}")
+            emit_marker(f"TOKEN_USAGE:{total_tokens}")
             
             return result
         else:
@@ -475,7 +860,7 @@ def call_dashscope_api(api_key, content, user_prompt, config, file_type="pdf"):
         log_error(f"详细错误信息: {traceback.format_exc()}")
         return None
 
-def process_ppt_with_images(api_key, content, base_path, user_prompt, config):
+def process_ppt_with_images(api_key, content, base_path, user_prompt, config, checkpoint=None):
     """
     处理PPT中的图片，对图片进行识别并整合内容
     """
@@ -483,39 +868,14 @@ def process_ppt_with_images(api_key, content, base_path, user_prompt, config):
     log_info(f"用户提示词: {user_prompt}")
     
     # 提取图片路径（从markdown格式的图片语法中提取）
-    image_paths = extract_images_from_markdown(content, base_path)
-    
-    # 存储图片识别结果
-    image_descriptions = {}
+    refs = find_image_refs(content, base_path)
+    image_paths = extract_images_from_markdown(content, base_path, refs)
     
-    # 对每张图片进行识别
-    for img_path in image_paths:
-        log_info(f"正在识别图片: {img_path}")
-        description = recognize_image_with_dashscope(
-            api_key, 
-            img_path, 
-            "请详细描述这张图片的内容，包括其中的关键信息、文字、数据或其他重要元素。"
-        )
-        if description:
-            image_descriptions[img_path] = description
-            log_info(f"图片识别完成: {img_path}")
-        else:
-            log_error(f"图片识别失败: {img_path}")
+    # 并行识别图片，存储识别结果
+    image_descriptions = recognize_images(api_key, image_paths, checkpoint=checkpoint)
     
     # 将图片描述整合到原始内容中
-    enhanced_content = content
-    
-    for img_path, description in image_descriptions.items():
-        # 使用正则表达式找到图片引用并添加描述
-        original_img_path = Path(img_path).name
-        pattern = r'!\[.*?\][^)]*' + re.escape(original_img_path) + r'[^)]*\)'
-        
-        # 替换markdown，添加图片描述
-        enhanced_content = re.sub(
-            pattern, 
-            f'![图示]({img_path})\n\n**图片描述**: {description}\n\n', 
-            enhanced_content
-        )
+    enhanced_content = merge_image_descriptions(content, refs, image_descriptions)
     
     # 如果没有图片，直接返回原始内容
     if not image_paths:
@@ -542,18 +902,37 @@ def save_markdown(content, output_path):
 
 # 使用config_manager模块加载配置，不再使用自定义load_config函数
 
+def handle_sigterm(signum, frame):
+    """
+    收到终止信号（如web_app.py判定任务超时）时退出，使finally中的检查点得以保存
+    """
+    log_error("收到终止信号，保存检查点后退出")
+    sys.exit(1)
+
 def main():
+    checkpoint = None
+    image_dir = None
+    setup_logging()
+    preload_sdk()
     try:
         log_info("开始执行PDF转知识库程序")
+        signal.signal(signal.SIGTERM, handle_sigterm)
         
         parser = argparse.ArgumentParser(description='将PDF、PPT或markdown文件通过大模型API转换为格式化的知识库文档')
         parser.add_argument('input_path', help='输入文件路径(PDF、PPT或markdown)')
         parser.add_argument('--prompt', '-p', default='', help='额外的个性化提示词')
         parser.add_argument('--output', '-o', help='输出文件路径')
         parser.add_argument('--api-key', help='DashScope API Key')
+        parser.add_argument('--cancel-file', help='取消标记文件路径，文件存在时在下一个工作单元边界停止处理')
+        parser.add_argument('--checkpoint-file', help='检查点文件路径，重试时从已完成的工作继续')
+        parser.add_argument('--file-hash', help='输入文件内容的SHA-256，不传时自动计算（用作提取缓存的键）')
+        parser.add_argument('--defer-request', help='批量模式：不实时调用文本模型，将生成请求写入该文件后退出，由批量执行器提交')
         
         args = parser.parse_args()
         
+        global _cancel_file
+        _cancel_file = args.cancel_file
+        
         log_info(f"输入参数: input_path={args.input_path}, prompt={args.prompt}, output={args.output}")
         
         # 检查输入文件是否存在
@@ -573,6 +952,7 @@ def main():
         
         # 加载配置
         config = config_manager.load_config()
+        config_manager.add_listener(log_config_change)
         
         # 获取API KEY，优先级：命令行参数 > 配置管理器
         # 注意：虽然保留了命令行参数支持，但优先使用配置管理器中的配置
@@ -585,11 +965,42 @@ def main():
         
         log_info("API KEY已验证")
         
+        # 加载检查点，跳过之前已完成的工作
+        file_hash = args.file_hash or hash_file(args.input_path)
+        checkpoint = Checkpoint(args.checkpoint_file, args.input_path, file_hash)
+        content = checkpoint.get('enhanced_content')
+        if file_ext in ['.ppt', '.pptx', '.pdf']:
+            image_dir = get_task_image_dir(args.checkpoint_file or args.input_path)
+        
+        # 提取缓存：图片增强后的内容与图像模型和PDF视觉识别参数有关，与提示词和文本模型无关
+        extract_cache = ExtractCache()
+        enhanced_key = extract_cache.key(
+            'enhanced', file_hash,
+            image_model=config.get('image_model', 'qwen-vl-plus'),
+            pdf_vision=load_pdf_vision_config(config) if file_ext == '.pdf' else None,
+            pdf_extractor=load_extractor_options(config)['backend'] if file_ext == '.pdf' else None
+        )
+        cached = None if content else extract_cache.get(enhanced_key)
+        # 本次运行中重新提取的内容才写入缓存
+        extracted = not content and not cached
+        
         # 根据文件类型处理内容
-        if file_ext in ['.pdf']:
+        if content:
+            log_info("从检查点恢复已处理的内容，跳过文件读取和图片识别")
+            report_progress('extract', 1, 1)
+            report_progress('image', 0, 0)
+            file_type = checkpoint.get('file_type')
+        elif cached:
+            log_info("从提取缓存恢复图片增强后的内容，跳过文件读取和图片识别")
+            report_progress('extract', 1, 1)
+            report_progress('image', 0, 0)
+            content = cached['content']
+            file_type = cached['file_type']
+        elif file_ext in ['.pdf']:
             # PDF处理
             log_info("开始处理PDF文件...")
-            content = read_pdf(args.input_path)
+            # 文字较少的页面（扫描页、图片页）交给视觉模型识别，其余页面使用本地提取的文本
+            content = read_pdf_with_vision(api_key, args.input_path, image_dir, config, checkpoint, extract_cache, file_hash)
             file_type = "pdf"
         elif file_ext in ['.md', '.markdown']:
             # Markdown处理
@@ -598,18 +1009,17 @@ def main():
             if content:
                 # 处理markdown中的图片
                 log_info("处理markdown中的图片...")
-                content = process_markdown_with_images(api_key, content, args.input_path, args.prompt, config)
+                content = process_markdown_with_images(api_key, content, args.input_path, args.prompt, config, checkpoint)
             file_type = "markdown"
         elif file_ext in ['.ppt', '.pptx']:
             # PPT处理
             log_info("开始处理PPT文件...")
-            content = read_ppt(args.input_path)
+            # 读取PPT并格式化为markdown（图片随提取缓存保存）
+            content = read_ppt_markdown(args.input_path, image_dir, extract_cache, file_hash)
             if content:
-                # 格式化PPT内容为markdown
-                content = format_ppt_content_for_markdown(content)
                 # 处理PPT中的图片
                 log_info("处理PPT中的图片...")
-                content = process_ppt_with_images(api_key, content, args.input_path, args.prompt, config)
+                content = process_ppt_with_images(api_key, content, args.input_path, args.prompt, config, checkpoint)
             file_type = "ppt"
         
         if not content:
@@ -618,14 +1028,42 @@ def main():
             sys.exit(1)
         
         log_info(f"文件内容读取成功，总字符数: {len(content)}")
+        checkpoint.update(enhanced_content=content, file_type=file_type)
+        if extracted and not _image_failures:
+            extract_cache.put(enhanced_key, {'content': content, 'file_type': file_type})
         
         # 如果内容过长，进行分段处理提示
         if len(content) > 30000:  # 模型输入限制调整
             log_info("警告: 内容较长，可能超出API限制，正在发送请求...")
         
-        # 调用API处理内容
-        log_info("正在调用大模型API处理内容...")
-        result = call_dashscope_api(api_key, content, args.prompt, config, file_type)
+        # 选择文本模型；重试时沿用检查点中记录的选择（配置的模型未变时），避免延迟统计变化导致已有的生成结果失效
+        check_cancelled()
+        route = checkpoint.get('model_route')
+        if not route or route.get('configured_model') != (config.get('text_model') or DEFAULT_TEXT_MODEL):
+            route = choose_text_model(content, args.prompt, config, file_type)
+        checkpoint.update(model_route=route)
+        emit_marker(format_route_marker(route))
+        
+        # 调用API处理内容，检查点中已有相同模型和提示词的生成结果时直接复用
+        result_key = f"{route['model']}|{args.prompt}"
+        result = checkpoint.get('result') if checkpoint.get('result_key') == result_key else None
+        if result:
+            log_info("从检查点恢复生成结果，跳过大模型API调用")
+            report_progress('generate', 1, 1)
+        elif args.defer_request:
+            # 批量模式：文档读取和图片识别已完成（保存在检查点中），生成请求交给批量执行器
+            write_request(args.defer_request, route['model'], build_messages(content, args.prompt, config, file_type))
+            log_info(f"生成请求已写入 {args.defer_request}，等待批量执行")
+            if image_dir:
+                shutil.rmtree(image_dir, ignore_errors=True)
+            sys.exit(DEFERRED_EXIT_CODE)
+        else:
+            log_info("正在调用大模型API处理内容...")
+            result = call_dashscope_api(api_key, content, args.prompt, config, file_type, model=route['model'])
+            # 保存本次学习到的并发上限，供后续任务进程沿用
+            get_limiter().save_state(force=True)
+            if result:
+                checkpoint.update(result=result, result_key=result_key)
         
         if not result:
             error_msg = "错误: API调用失败，无法生成markdown文档"
@@ -648,15 +1086,28 @@ def main():
         # 保存结果
         if save_markdown(result, output_path):
             log_info("处理完成！")
+            # 处理成功后删除图片临时目录（失败时保留，重试可复用）
+            if image_dir:
+                shutil.rmtree(image_dir, ignore_errors=True)
         else:
             error_msg = "保存文件失败"
             log_error(error_msg)
             sys.exit(1)
+    except TaskCancelled:
+        log_info("任务已被取消，停止处理")
+        sys.exit(CANCELLED_EXIT_CODE)
     except Exception as e:
         error_msg = f"处理过程中发生未捕获的异常: {str(e)}"
         log_error(error_msg)
         log_error(f"详细错误信息: {traceback.format_exc()}")
         sys.exit(1)
+    finally:
+        # 无论成功、失败、取消还是超时，都保存已完成的工作
+        if checkpoint:
+            checkpoint.save(force=True)
+        peak_marker = format_peak_marker()
+        if peak_marker:
+            emit_marker(peak_marker)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
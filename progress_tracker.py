@@ -0,0 +1,139 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 子进程上报进度的输出前缀，格式: PROGRESS:<阶段>:<已完成单元数>:<总单元数>
+PROGRESS_PREFIX = 'PROGRESS:'
+
+# 各处理阶段在总进度中的权重
+# extract: 页/幻灯片提取；image: 图片识别；generate: 大模型输出token
+STAGE_WEIGHTS = {
+    'extract': 0.15,
+    'image': 0.35,
+    'generate': 0.5
+}
+
+# 进度在处理过程中映射到的区间，100%只在任务真正完成时设置
+PROGRESS_START = 5
+PROGRESS_END = 95
+
+# 两次持久化之间的最小间隔（秒），避免进度上报成为瓶颈
+DEFAULT_PERSIST_INTERVAL = 2.0
+
+
+def parse_progress_line(line):
+    """
+    解析子进程输出的进度行，返回 (stage, done, total)，不是进度行时返回None
+    """
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    parts = line[len(PROGRESS_PREFIX):].strip().split(':')
+    if len(parts) != 3 or parts[0] not in STAGE_WEIGHTS:
+        return None
+    try:
+        return parts[0], int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+
+
+class ProgressTracker:
+    """
+    任务进度跟踪器
+
+    根据子进程上报的实际工作单元（页数、图片数、输出token数）计算总进度和基于速率的预计剩余时间。
+    计数器只在内存中更新，持久化按时间间隔节流。
+    """
+
+    def __init__(self, task_info, persist, persist_interval=DEFAULT_PERSIST_INTERVAL):
+        """
+        Args:
+            task_info: 任务状态字典（task_status[task_id]），进度字段会直接写入其中
+            persist: 持久化回调函数
+            persist_interval: 两次持久化之间的最小间隔（秒）
+        """
+        self.task_info = task_info
+        self.persist = persist
+        self.persist_interval = persist_interval
+        self.stages = {}  # {stage: [done, total]}
+        self.stage_started = {}  # {stage: 首次上报时间}
+        self.stage_seconds = {}  # {stage: 阶段耗时（秒）}，用于统计历史吞吐量
+        self.started_at = time.time()
+        self.last_persist = 0.0
+        self.dirty = False
+
+    def feed_line(self, line):
+        """
+        处理一行子进程输出，是进度行时更新进度并返回True
+        """
+        parsed = parse_progress_line(line)
+        if parsed is None:
+            return False
+        self.update(*parsed)
+        return True
+
+    def update(self, stage, done, total):
+        """
+        更新某个阶段的完成单元数，total为0表示该阶段不适用
+        """
+        now = time.time()
+        self.stage_started.setdefault(stage, now)
+        self.stages[stage] = [max(done, 0), max(total, 0)]
+        if total > 0 and done >= total:
+            self.stage_seconds[stage] = round(now - self.stage_started[stage], 3)
+        fraction = self.fraction()
+        self.task_info['progress'] = round(PROGRESS_START + (PROGRESS_END - PROGRESS_START) * fraction, 1)
+        self.task_info['eta_seconds'] = self.eta_seconds(fraction)
+        self.task_info['progress_detail'] = {
+            name: {'done': counts[0], 'total': counts[1]} for name, counts in self.stages.items()
+        }
+        self.dirty = True
+        self.maybe_persist()
+
+    def fraction(self):
+        """
+        计算加权后的总完成比例（0~1）
+        """
+        # 已知不适用的阶段（total为0）不参与权重计算，其余未开始的阶段按0计
+        weights = {
+            stage: weight for stage, weight in STAGE_WEIGHTS.items()
+            if self.stages.get(stage, [0, 1])[1] > 0
+        }
+        total_weight = sum(weights.values())
+        if total_weight <= 0:
+            return 0.0
+        completed = 0.0
+        for stage, weight in weights.items():
+            done, total = self.stages.get(stage, [0, 1])
+            completed += weight * min(done / total, 1.0)
+        return completed / total_weight
+
+    def eta_seconds(self, fraction):
+        """
+        根据已完成比例和耗时估算剩余时间（秒），无法估算时返回None
+        """
+        if fraction <= 0:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed * (1 - fraction) / fraction, 1)
+
+    def maybe_persist(self):
+        """
+        距离上次持久化超过间隔时才写入文件
+        """
+        now = time.time()
+        if now - self.last_persist >= self.persist_interval:
+            self.last_persist = now
+            self.dirty = False
+            try:
+                self.persist()
+            except Exception as e:
+                logger.error(f"持久化任务进度时出错: {str(e)}")
+
+    def flush(self):
+        """
+        立即持久化尚未写入的进度
+        """
+        if self.dirty:
+            self.last_persist = 0.0
+            self.maybe_persist()
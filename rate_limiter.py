@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import random
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 限流状态文件路径，用于在各个处理进程之间延续已学习到的并发上限
+RATE_LIMIT_FILE = os.path.join('.wucai', 'rate_limits.json')
+
+# DashScope限流相关的错误码
+THROTTLING_CODES = {'Throttling', 'Throttling.RateQuota', 'Throttling.AllocationQuota', 'Throttling.User'}
+
+# 默认参数
+DEFAULT_INITIAL_LIMIT = 2
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 16
+DEFAULT_DECREASE_FACTOR = 0.5  # 被限流时并发上限乘以该系数
+LATENCY_TOLERANCE = 2.0  # 延迟超过基线的倍数时停止增加并发
+EWMA_ALPHA = 0.2  # 延迟与成功率的指数滑动平均系数
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+SAVE_INTERVAL = 5.0
+
+
+def is_throttled(response):
+    """
+    判断API响应是否为限流
+    """
+    status_code = getattr(response, 'status_code', None)
+    code = getattr(response, 'code', None) or ''
+    return status_code == 429 or code in THROTTLING_CODES
+
+
+def get_output_tokens(response):
+    """
+    读取响应中的输出token数，没有用量信息时返回0
+    """
+    try:
+        return int((getattr(response, 'usage', None) or {}).get('output_tokens') or 0)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def is_retryable(response):
+    """
+    判断API响应是否值得重试（限流或服务端错误）
+    """
+    status_code = getattr(response, 'status_code', None)
+    return is_throttled(response) or (isinstance(status_code, int) and status_code >= 500)
+
+
+class ModelStats:
+    """
+    单个模型的限流状态
+    """
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.latency_baseline = None
+        self.success_rate = 1.0
+        self.last_decrease = 0.0  # 上次乘性减少的时间，在此之前发出的请求被限流时不再重复减少
+        self.condition = threading.Condition()
+
+    def to_dict(self):
+        return {
+            'limit': round(self.limit, 2),
+            'latency_ewma': self.latency_ewma,
+            'latency_baseline': self.latency_baseline,
+            'success_rate': round(self.success_rate, 4)
+        }
+
+
+class AdaptiveLimiter:
+    """
+    AIMD自适应并发限制器
+
+    按模型统计成功率和延迟：请求健康时线性增加允许的在途请求数，
+    遇到限流时按比例快速回退（同一次拥塞只回退一次），并配合带抖动的指数退避重试。
+    延迟取流式调用首个分片的等待时间（见mark_first_chunk），非流式调用按输出token数归一化，不受输出长度影响。
+
+    状态按模型保存在状态文件中：新进程启动时继承之前进程学习到的上限，被限流时重新读取状态文件，
+    采用同时运行的其他处理进程已经降低的上限；其余时间各进程独立调整。
+    """
+
+    def __init__(self, initial_limit=DEFAULT_INITIAL_LIMIT, min_limit=DEFAULT_MIN_LIMIT,
+                 max_limit=DEFAULT_MAX_LIMIT, state_file=RATE_LIMIT_FILE):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.state_file = state_file
+        self.models = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()  # 当前线程正在进行的调用的开始时间和首个分片的等待时间
+        self.last_save = 0.0
+        self.saved_state = self.load_state()
+
+    def load_state(self):
+        """
+        读取之前进程学习到的限流状态
+        """
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"加载限流状态文件时出错: {str(e)}")
+            return {}
+
+    def save_state(self, force=False):
+        """
+        保存各模型的限流状态，按间隔节流
+        """
+        now = time.time()
+        if not self.state_file or (not force and now - self.last_save < SAVE_INTERVAL):
+            return
+        self.last_save = now
+        with self.lock:
+            state = dict(self.saved_state)
+            state.update({model: stats.to_dict() for model, stats in self.models.items()})
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_file, self.state_file)
+        except (IOError, OSError) as e:
+            logger.error(f"保存限流状态文件时出错: {str(e)}")
+
+    def get_stats(self, model):
+        """
+        获取模型的限流状态，不存在时根据已保存的状态初始化
+        """
+        with self.lock:
+            stats = self.models.get(model)
+            if stats is None:
+                saved = self.saved_state.get(model, {})
+                limit = min(max(saved.get('limit', self.initial_limit), self.min_limit), self.max_limit)
+                stats = ModelStats(limit)
+                stats.latency_ewma = saved.get('latency_ewma')
+                stats.latency_baseline = saved.get('latency_baseline')
+                stats.success_rate = saved.get('success_rate', 1.0)
+                self.models[model] = stats
+            return stats
+
+    def get_latency(self, model):
+        """
+        获取模型的平均延迟（秒，流式调用为首个分片的等待时间），本进程还没有调用过时使用之前进程保存的统计，都没有时返回None
+        """
+        with self.lock:
+            stats = self.models.get(model)
+            if stats is not None and stats.latency_ewma is not None:
+                return stats.latency_ewma
+        return self.saved_state.get(model, {}).get('latency_ewma')
+
+    def snapshot(self):
+        """
+        返回各模型当前的限流状态，供日志和统计使用
+        """
+        with self.lock:
+            return {model: stats.to_dict() for model, stats in self.models.items()}
+
+    @contextmanager
+    def slot(self, model):
+        """
+        占用一个在途请求名额，超出当前上限时阻塞等待
+        """
+        stats = self.get_stats(model)
+        with stats.condition:
+            while stats.in_flight >= int(stats.limit):
+                stats.condition.wait()
+            stats.in_flight += 1
+        try:
+            yield stats
+        finally:
+            with stats.condition:
+                stats.in_flight -= 1
+                stats.condition.notify_all()
+
+    def mark_first_chunk(self):
+        """
+        流式调用收到第一个分片时调用：以首个分片的等待时间作为本次调用的延迟，不受输出长度影响
+        """
+        started = getattr(self.local, 'started', None)
+        if started is not None and self.local.first_chunk is None:
+            self.local.first_chunk = time.time() - started
+
+    def record(self, model, success, latency=None, throttled=False, started=None):
+        """
+        记录一次请求结果并调整并发上限
+
+        Args:
+            started: 请求的开始时间；上次减少之前发出的请求被限流时属于同一次拥塞，不再重复减少
+        """
+        stats = self.get_stats(model)
+        # 被限流时读取其他处理进程保存的上限
+        shared_limit = self.load_state().get(model, {}).get('limit') if throttled else None
+        decreased = False
+        with stats.condition:
+            stats.success_rate = (1 - EWMA_ALPHA) * stats.success_rate + EWMA_ALPHA * (1.0 if success else 0.0)
+            if latency is not None and success:
+                stats.latency_ewma = latency if stats.latency_ewma is None else \
+                    (1 - EWMA_ALPHA) * stats.latency_ewma + EWMA_ALPHA * latency
+                if stats.latency_baseline is None or latency < stats.latency_baseline:
+                    stats.latency_baseline = latency
+            if throttled:
+                if started is None or started >= stats.last_decrease:
+                    # 乘性减少
+                    stats.limit = max(self.min_limit, stats.limit * DEFAULT_DECREASE_FACTOR)
+                    stats.last_decrease = time.time()
+                    decreased = True
+                if shared_limit is not None and shared_limit < stats.limit:
+                    stats.limit = max(self.min_limit, shared_limit)
+            elif success:
+                congested = (
+                    stats.latency_baseline is not None and stats.latency_ewma is not None
+                    and stats.latency_ewma > stats.latency_baseline * LATENCY_TOLERANCE
+                )
+                if not congested:
+                    # 加性增加：每个窗口（约limit次成功）增加1
+                    stats.limit = min(self.max_limit, stats.limit + 1.0 / stats.limit)
+            stats.condition.notify_all()
+        # 减少后立即保存，同时运行的其他处理进程被限流时可以采用
+        self.save_state(force=decreased)
+
+    def call(self, model, func, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY,
+             max_delay=DEFAULT_MAX_DELAY):
+        """
+        在限流控制下调用func，限流或服务端错误时带抖动重试
+
+        Args:
+            model: 模型名称，用于区分限流状态
+            func: 无参调用，返回带status_code的API响应
+            max_retries: 最大重试次数
+
+        Returns:
+            最后一次调用的响应（func返回None且重试用尽时返回None）；网络异常在重试用尽后重新抛出
+        """
+        attempt = 0
+        while True:
+            with self.slot(model):
+                started = time.time()
+                self.local.started, self.local.first_chunk = started, None
+                try:
+                    response = func()
+                except Exception:
+                    self.record(model, success=False)
+                    if attempt >= max_retries:
+                        raise
+                    response = None
+                else:
+                    if response is None:
+                        # 调用方自行处理了异常并返回None，同样按失败计入重试次数
+                        self.record(model, success=False)
+                        if attempt >= max_retries:
+                            return None
+                finally:
+                    self.local.started = None
+                latency = self.local.first_chunk
+                if latency is None:
+                    # 非流式调用的耗时随输出长度增长，按输出token数归一化
+                    latency = (time.time() - started) / max(get_output_tokens(response), 1)
+
+            if response is not None:
+                throttled = is_throttled(response)
+                success = getattr(response, 'status_code', None) == 200
+                self.record(model, success=success, latency=latency, throttled=throttled, started=started)
+                if success or not is_retryable(response) or attempt >= max_retries:
+                    return response
+                logger.info(f"模型 {model} 请求被限流或服务端出错({response.status_code})，准备重试")
+
+            # 指数退避 + 全抖动
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            attempt += 1
+            time.sleep(delay)
+
+
+# 文本和视觉调用路径共享的限制器实例
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """
+    获取进程内共享的限制器实例
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = AdaptiveLimiter()
+        return _limiter
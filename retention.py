@@ -0,0 +1,315 @@
+import os
+import glob
+import gzip
+import json
+import time
+import shutil
+import tempfile
+import threading
+import logging
+from datetime import datetime
+
+from extract_cache import EXTRACT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# 归档的任务记录目录，每次压缩生成一个.jsonl.gz分段
+ARCHIVE_DIR = os.path.join('.wucai', 'archive')
+
+# 默认保留策略，可通过配置项retention覆盖其中任意一项（0表示不限制）
+DEFAULT_POLICY = {
+    'task_max_age_days': 30,  # 已结束的任务记录保留天数，超过后归档
+    'task_max_count': 1000,  # task_status中最多保留的已结束任务数，超出的最早记录归档
+    'upload_max_age_days': 7,  # 上传文件在引用它的任务全部成功后保留的天数（0为成功后即删除）
+    'upload_max_bytes': 5 * 1024 * 1024 * 1024,  # 上传目录总大小上限，超出时从最早的文件开始删除
+    'temp_max_age_hours': 24,  # PPT和PDF图片临时目录等临时文件的保留小时数
+    'extract_cache_max_age_days': 30,  # 提取缓存条目在最近一次使用后保留的天数
+    'interval_seconds': 3600  # 两次执行之间的间隔
+}
+
+# 未完成上传的临时文件（.part）超过该时间未更新视为残留
+PART_MAX_AGE_SECONDS = 3600
+
+# 首次执行前的等待时间，避免与启动时的索引同步争抢磁盘
+INITIAL_DELAY_SECONDS = 60
+
+# PPT和PDF图片临时目录前缀（需与pdf_to_knowledge_md.py保持一致）
+PPT_TEMP_PREFIX = 'wucai_ppt_'
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+ACTIVE_STATUSES = ('pending', 'processing')
+
+
+def load_policy(config):
+    """
+    合并配置中的保留策略和默认值
+    """
+    policy = DEFAULT_POLICY.copy()
+    policy.update({k: v for k, v in (config.get('retention') or {}).items() if k in DEFAULT_POLICY})
+    return policy
+
+
+def remove_path(path):
+    """
+    删除文件或目录，返回释放的字节数
+    """
+    try:
+        if os.path.isdir(path):
+            size = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            return size
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError as e:
+        logger.error(f"删除 {path} 时出错: {str(e)}")
+        return 0
+
+
+class RetentionManager:
+    """
+    保留策略执行器
+
+    按时间、数量和总大小清理任务记录、上传文件和临时文件：已结束的旧任务记录归档为压缩分段后从
+    任务状态中移除；上传文件在引用它的任务全部成功并超过保留期后删除；清理残留的上传临时文件、
+    PPT和PDF图片临时目录、长时间未使用的提取缓存、检查点和失效的输出缓存。在后台线程中定期执行，不阻塞请求。
+    """
+
+    def __init__(self, get_tasks, remove_tasks, load_config, upload_dir, output_dir, cache_dirs=(), resolve_upload=None):
+        """
+        Args:
+            get_tasks: 返回任务状态快照 {task_id: info} 的函数
+            remove_tasks: 从任务状态中移除一组任务ID并持久化的函数
+            load_config: 返回当前配置的函数
+            upload_dir: 上传目录
+            output_dir: 输出目录
+            cache_dirs: 按输出文件名保存派生文件的目录（如预压缩文件、标题偏移索引），输出删除后一并清理
+            resolve_upload: resolve_upload(task_id, info)返回任务引用的上传文件路径（任务记录中不保存路径）
+        """
+        self.get_tasks = get_tasks
+        self.remove_tasks = remove_tasks
+        self.load_config = load_config
+        self.upload_dir = upload_dir
+        self.output_dir = output_dir
+        self.cache_dirs = cache_dirs
+        self.resolve_upload = resolve_upload
+        self.lock = threading.Lock()
+        self.last_report = None
+
+    def run_once(self):
+        """
+        执行一次保留策略
+
+        Returns:
+            执行报告（各项清理数量和释放的字节数）
+        """
+        with self.lock:
+            started = time.time()
+            policy = load_policy(self.load_config())
+            report = {'archived_tasks': 0, 'deleted_uploads': 0, 'deleted_temp': 0, 'deleted_cache': 0, 'freed_bytes': 0}
+            archived = self.archive_tasks(policy, report)
+            tasks = self.get_tasks()
+            self.clean_uploads(tasks, policy, report)
+            self.clean_temp(policy, report)
+            self.clean_extract_cache(policy, report)
+            self.clean_checkpoints(tasks, archived, report)
+            self.clean_caches(report)
+            report['duration_seconds'] = round(time.time() - started, 3)
+            report['finished_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self.last_report = report
+            logger.info(f"保留策略执行完成: {report}")
+            return report
+
+    def archive_tasks(self, policy, report):
+        """
+        将超过保留期或超出数量上限的已结束任务写入归档分段，并从任务状态中移除
+
+        Returns:
+            已归档的任务ID集合
+        """
+        tasks = self.get_tasks()
+        finished = sorted(
+            (info.get('end_time') or info.get('start_time') or 0, task_id)
+            for task_id, info in tasks.items() if info.get('status') in FINISHED_STATUSES
+        )
+        selected = set()
+        if policy['task_max_age_days']:
+            cutoff = time.time() - policy['task_max_age_days'] * 86400
+            selected.update(task_id for ended, task_id in finished if ended < cutoff)
+        if policy['task_max_count'] and len(finished) > policy['task_max_count']:
+            selected.update(task_id for _, task_id in finished[:len(finished) - policy['task_max_count']])
+        if not selected:
+            return set()
+
+        # 先写归档再移除，中途退出时最多重复归档，不会丢失记录
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        segment = os.path.join(ARCHIVE_DIR, f"tasks-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl.gz")
+        tmp_file = f"{segment}.tmp"
+        with gzip.open(tmp_file, 'wt', encoding='utf-8') as f:
+            for _, task_id in finished:
+                if task_id in selected:
+                    f.write(json.dumps({'task_id': task_id, **tasks[task_id]}, ensure_ascii=False) + '\n')
+        os.replace(tmp_file, segment)
+        self.remove_tasks(selected)
+        report['archived_tasks'] = len(selected)
+        logger.info(f"已归档 {len(selected)} 条任务记录到 {segment}")
+        return selected
+
+    def clean_uploads(self, tasks, policy, report):
+        """
+        删除不再需要的上传文件：引用它的任务全部成功且超过保留期，或没有任务引用且超过保留期；
+        总大小超过上限时再从最早的文件开始删除（排队中和处理中的任务引用的文件除外）
+        """
+        references = {}
+        for task_id, info in tasks.items():
+            try:
+                path = self.resolve_upload(task_id, info) if self.resolve_upload else info.get('file_path')
+            except (KeyError, TypeError, ValueError):
+                path = None
+            if path:
+                references.setdefault(os.path.abspath(path), []).append(info)
+
+        now = time.time()
+        max_age = policy['upload_max_age_days'] * 86400
+        files = []
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            if not os.path.isfile(path):
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.endswith('.part'):
+                if now - mtime > PART_MAX_AGE_SECONDS:
+                    report['freed_bytes'] += remove_path(path)
+                    report['deleted_temp'] += 1
+                continue
+
+            refs = references.get(os.path.abspath(path), [])
+            if any(info.get('status') in ACTIVE_STATUSES for info in refs):
+                continue
+            if refs and all(info.get('status') == 'completed' for info in refs):
+                # 重复上传相同内容时复用同一文件，以引用它的任务最近一次开始或结束的时间为准
+                last_used = max([mtime] + [max(info.get('start_time') or 0, info.get('end_time') or 0) for info in refs])
+                if now - last_used >= max_age:
+                    report['freed_bytes'] += remove_path(path)
+                    report['deleted_uploads'] += 1
+                    continue
+            elif not refs and now - mtime >= max(max_age, PART_MAX_AGE_SECONDS):
+                report['freed_bytes'] += remove_path(path)
+                report['deleted_uploads'] += 1
+                continue
+            files.append((mtime, path))
+
+        if policy['upload_max_bytes']:
+            total = sum(os.path.getsize(path) for _, path in files)
+            for _, path in sorted(files):
+                if total <= policy['upload_max_bytes']:
+                    break
+                freed = remove_path(path)
+                total -= freed
+                report['freed_bytes'] += freed
+                report['deleted_uploads'] += 1
+
+    def clean_temp(self, policy, report):
+        """
+        清理超过保留时间的PPT和PDF图片临时目录
+        """
+        cutoff = time.time() - policy['temp_max_age_hours'] * 3600
+        for path in glob.glob(os.path.join(tempfile.gettempdir(), f"{PPT_TEMP_PREFIX}*")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    report['freed_bytes'] += remove_path(path)
+                    report['deleted_temp'] += 1
+            except OSError:
+                continue
+
+    def clean_extract_cache(self, policy, report):
+        """
+        清理长时间未使用的提取缓存条目和残留的临时目录
+        """
+        if not os.path.isdir(EXTRACT_CACHE_DIR):
+            return
+        now = time.time()
+        for name in os.listdir(EXTRACT_CACHE_DIR):
+            path = os.path.join(EXTRACT_CACHE_DIR, name)
+            if '.tmp-' in name:
+                max_age = policy['temp_max_age_hours'] * 3600
+            else:
+                max_age = policy['extract_cache_max_age_days'] * 86400
+            try:
+                if max_age and os.path.getmtime(path) < now - max_age:
+                    report['freed_bytes'] += remove_path(path)
+                    report['deleted_cache'] += 1
+            except OSError:
+                continue
+
+    def clean_checkpoints(self, tasks, archived, report):
+        """
+        清理已归档、已成功或不存在的任务的检查点和取消标记
+        """
+        for directory, suffix in ((os.path.join('.wucai', 'checkpoints'), '.json'), (os.path.join('.wucai', 'cancel'), '')):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                task_id = name[:-len(suffix)] if suffix and name.endswith(suffix) else name
+                info = tasks.get(task_id)
+                stale = task_id in archived or info is None or info.get('status') == 'completed'
+                if directory.endswith('cancel'):
+                    stale = stale or info.get('status') not in ACTIVE_STATUSES
+                if stale:
+                    report['freed_bytes'] += remove_path(os.path.join(directory, name))
+                    report['deleted_cache'] += 1
+
+    def clean_caches(self, report):
+        """
+        清理对应输出文件已不存在的派生文件
+        """
+        for directory in self.cache_dirs:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                output_name = name
+                for suffix in ('.json', '.gz', '.br', '.tmp'):
+                    if output_name.endswith(suffix):
+                        output_name = output_name[:-len(suffix)]
+                if not os.path.exists(os.path.join(self.output_dir, output_name)):
+                    report['freed_bytes'] += remove_path(os.path.join(directory, name))
+                    report['deleted_cache'] += 1
+
+    def run_in_background(self):
+        """
+        在后台线程中立即执行一次
+        """
+        def run():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"执行保留策略时出错: {str(e)}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def start(self):
+        """
+        启动后台线程定期执行
+        """
+        def loop():
+            time.sleep(INITIAL_DELAY_SECONDS)
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"执行保留策略时出错: {str(e)}")
+                try:
+                    interval = load_policy(self.load_config())['interval_seconds']
+                except Exception:
+                    interval = DEFAULT_POLICY['interval_seconds']
+                time.sleep(max(interval, 60))
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,280 @@
+import os
+import re
+import html
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 全文索引数据库路径
+SEARCH_DB_FILE = os.path.join('.wucai', 'search_index.db')
+
+# 中日韩字符（汉字、假名、韩文），这些文字没有空格分词，按字二元组（bigram）建立索引
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+
+# 标题在排序中的权重（bm25按列加权）
+TITLE_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+# 摘要长度（字符）
+SNIPPET_RADIUS = 60
+
+
+def cjk_tokens(run):
+    """
+    将一段连续的中日韩文字切分为二元组，并追加最后一个字，使单字查询也能命中
+    """
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)] + [run[-1]]
+
+
+def tokenize_for_index(text):
+    """
+    将文本转换为FTS5 unicode61分词器可以处理的形式：中日韩文字转为空格分隔的二元组，其余文本保持不变
+    """
+    parts = []
+    last = 0
+    for match in CJK_PATTERN.finditer(text):
+        parts.append(text[last:match.start()])
+        parts.append(' ' + ' '.join(cjk_tokens(match.group())) + ' ')
+        last = match.end()
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+def build_match_query(query):
+    """
+    将用户输入转换为FTS5查询表达式，各个词之间为AND关系
+
+    Returns:
+        (FTS5查询表达式, 用于生成摘要高亮的原始词列表)
+    """
+    clauses = []
+    terms = []
+    for term in query.split():
+        pieces = []
+        last = 0
+        for match in CJK_PATTERN.finditer(term):
+            pieces.append(('text', term[last:match.start()]))
+            pieces.append(('cjk', match.group()))
+            last = match.end()
+        pieces.append(('text', term[last:]))
+        for kind, piece in pieces:
+            if kind == 'cjk':
+                terms.append(piece)
+                if len(piece) == 1:
+                    # 单字：匹配以该字开头的二元组或结尾单字
+                    clauses.append(f'"{piece}"*')
+                else:
+                    # 多字：相邻二元组组成短语，保证字序一致
+                    bigrams = [piece[i:i + 2] for i in range(len(piece) - 1)]
+                    clauses.append('"' + ' '.join(bigrams) + '"')
+            else:
+                for word in re.findall(r'\w+', piece):
+                    terms.append(word)
+                    clauses.append('"' + word.replace('"', '""') + '"*')
+    return ' AND '.join(clauses), terms
+
+
+def format_snippet(excerpt, terms, truncated_start=False, truncated_end=False):
+    """
+    将摘要片段中的命中词用<mark>标记（已做HTML转义），被截断的一侧加省略号
+    """
+    snippet = html.escape(excerpt.replace('\n', ' '))
+    for term in sorted(set(terms), key=len, reverse=True):
+        escaped = html.escape(term)
+        snippet = re.sub(re.escape(escaped), lambda m: f'<mark>{m.group()}</mark>', snippet, flags=re.IGNORECASE)
+    return ('...' if truncated_start else '') + snippet + ('...' if truncated_end else '')
+
+
+class SearchIndex:
+    """
+    基于SQLite FTS5的知识库全文索引
+
+    documents表保存原文和文件元数据，doc_fts是只保存倒排索引的无内容表（content=''），按二元组化后的
+    标题和正文建立索引，两表通过rowid关联，正文只保存一份。摘要在SQLite中按命中位置截取，不读取全文。
+    按文件修改时间和大小增量更新。
+    """
+
+    def __init__(self, db_file=SEARCH_DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    doc_id TEXT UNIQUE NOT NULL,
+                    title TEXT,
+                    task_id TEXT,
+                    mtime REAL,
+                    size INTEGER,
+                    indexed_at REAL,
+                    content TEXT
+                )
+            ''')
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'doc_fts'").fetchone()
+            if row and "content=''" not in row[0]:
+                # 旧版本的doc_fts另存了一份二元组化的正文，改为无内容表后按documents中的原文重建
+                conn.execute('DROP TABLE doc_fts')
+                row = None
+            if row is None:
+                conn.execute('''
+                    CREATE VIRTUAL TABLE doc_fts USING fts5(
+                        title, body, content='', tokenize='unicode61 remove_diacritics 2'
+                    )
+                ''')
+                for rowid, title, content in conn.execute('SELECT id, title, content FROM documents').fetchall():
+                    self.insert_fts(conn, rowid, title, content)
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def insert_fts(self, conn, rowid, title, content):
+        conn.execute(
+            'INSERT INTO doc_fts (rowid, title, body) VALUES (?, ?, ?)',
+            (rowid, tokenize_for_index(title or ''), tokenize_for_index(content or ''))
+        )
+
+    def delete_fts(self, conn, rowid):
+        """
+        从无内容表中删除文档：需要提供建立索引时的原值，由documents中保存的原文重新生成
+        """
+        row = conn.execute('SELECT title, content FROM documents WHERE id = ?', (rowid,)).fetchone()
+        if row:
+            conn.execute(
+                "INSERT INTO doc_fts (doc_fts, rowid, title, body) VALUES ('delete', ?, ?, ?)",
+                (rowid, tokenize_for_index(row[0] or ''), tokenize_for_index(row[1] or ''))
+            )
+
+    def index_document(self, doc_id, file_path, title=None, task_id=None):
+        """
+        索引（或更新）一个输出文档，文件未变化时跳过
+
+        Returns:
+            True表示重新建立了索引
+        """
+        stat = os.stat(file_path)
+        with self.lock, self.connect() as conn:
+            row = conn.execute('SELECT id, mtime, size FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+            if row and row[1] == stat.st_mtime and row[2] == stat.st_size:
+                return False
+            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+                content = f.read()
+            title = title or os.path.splitext(doc_id)[0]
+            if row:
+                self.delete_fts(conn, row[0])
+                conn.execute(
+                    'UPDATE documents SET title = ?, task_id = COALESCE(?, task_id), mtime = ?, size = ?, indexed_at = ?, content = ? WHERE id = ?',
+                    (title, task_id, stat.st_mtime, stat.st_size, time.time(), content, row[0])
+                )
+                rowid = row[0]
+            else:
+                cursor = conn.execute(
+                    'INSERT INTO documents (doc_id, title, task_id, mtime, size, indexed_at, content) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (doc_id, title, task_id, stat.st_mtime, stat.st_size, time.time(), content)
+                )
+                rowid = cursor.lastrowid
+            self.insert_fts(conn, rowid, title, content)
+        logger.info(f"已更新全文索引: {doc_id}")
+        return True
+
+    def remove_document(self, doc_id):
+        """
+        从索引中删除文档
+        """
+        with self.lock, self.connect() as conn:
+            row = conn.execute('SELECT id FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+            if row:
+                self.delete_fts(conn, row[0])
+                conn.execute('DELETE FROM documents WHERE id = ?', (row[0],))
+
+    def sync_directory(self, directory, pattern='_processed.md'):
+        """
+        增量同步输出目录：索引新增或修改的文档，删除已不存在的文档
+
+        Returns:
+            (更新数, 删除数)
+        """
+        existing = {}
+        for name in os.listdir(directory):
+            if name.endswith(pattern):
+                existing[name] = os.path.join(directory, name)
+
+        updated = 0
+        for doc_id, path in existing.items():
+            try:
+                if self.index_document(doc_id, path):
+                    updated += 1
+            except (IOError, OSError) as e:
+                logger.error(f"索引文档 {doc_id} 时出错: {str(e)}")
+
+        with self.connect() as conn:
+            indexed = [row[0] for row in conn.execute('SELECT doc_id FROM documents')]
+        removed = 0
+        for doc_id in indexed:
+            if doc_id not in existing:
+                self.remove_document(doc_id)
+                removed += 1
+        return updated, removed
+
+    def search(self, query, limit=20, offset=0):
+        """
+        全文检索，按bm25相关度排序，返回带高亮摘要的结果列表
+        """
+        match_query, terms = build_match_query(query)
+        if not match_query:
+            return []
+        # 在SQLite中按第一个命中词的位置截取摘要，只取回摘要片段而不是全文
+        positions = ', '.join(['COALESCE(NULLIF(instr(lower(d.content), lower(?)), 0), 9e18)'] * len(terms))
+        with self.connect() as conn:
+            rows = conn.execute(
+                f'''
+                SELECT doc_id, title, task_id, score, substr(content, start, ?), start > 1, start + ? <= length(content)
+                FROM (
+                    SELECT *, CASE WHEN pos >= 9e18 THEN 1 ELSE max(pos - ?, 1) END AS start
+                    FROM (
+                        SELECT d.doc_id, d.title, d.task_id, d.content, hits.score, min(9e18, {positions}) AS pos
+                        FROM (
+                            SELECT rowid, bm25(doc_fts, {TITLE_WEIGHT}, {BODY_WEIGHT}) AS score
+                            FROM doc_fts WHERE doc_fts MATCH ?
+                            ORDER BY score
+                            LIMIT ? OFFSET ?
+                        ) hits JOIN documents d ON d.id = hits.rowid
+                    )
+                )
+                ORDER BY score
+                ''',
+                (SNIPPET_RADIUS * 3, SNIPPET_RADIUS * 3, SNIPPET_RADIUS, *terms, match_query, limit, offset)
+            ).fetchall()
+        return [
+            {
+                'doc_id': doc_id,
+                'output_file': doc_id,
+                'title': title,
+                'task_id': task_id,
+                'score': round(-score, 4),  # bm25越小越相关，取反后越大越相关
+                'snippet': format_snippet(excerpt or '', terms, bool(truncated_start), bool(truncated_end))
+            }
+            for doc_id, title, task_id, score, excerpt, truncated_start, truncated_end in rows
+        ]
+
+
+# 进程内共享的索引实例
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """
+    获取进程内共享的全文索引实例
+    """
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex()
+        return _search_index
@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import signal
+import socket
+import secrets
+import argparse
+import subprocess
+import logging
+
+from server_roles import ROLE_ENV, SCHEDULER_URL_ENV, INTERNAL_TOKEN_ENV
+from worker_pool import SUPERVISED_ENV, RECYCLE_EXIT_CODE
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# 子进程异常退出后重新启动的等待时间（秒），连续失败时翻倍；运行超过STABLE_SECONDS后重置
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+STABLE_SECONDS = 60.0
+# 停止服务时等待子进程退出的时间（秒）
+SHUTDOWN_TIMEOUT = 10.0
+# 使用waitress时空闲连接的超时时间（秒），慢速或挂起的客户端不会一直占用处理线程
+CHANNEL_TIMEOUT = 120
+
+
+def create_listener(host, port):
+    """
+    在主进程中创建监听端口，文件描述符传给各子进程共享
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+class ChildProcess:
+    """
+    由主进程管理的子进程：退出后按退出码决定立即重启（回收）或延迟重启（异常退出）
+    """
+
+    def __init__(self, name, role, sock, host, env, threads):
+        self.name = name
+        self.role = role
+        self.sock = sock
+        self.host = host
+        self.env = env
+        self.threads = threads
+        self.process = None
+        self.started_at = 0
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = 0
+
+    def start(self):
+        port = self.sock.getsockname()[1]
+        cmd = [
+            sys.executable, os.path.abspath(__file__),
+            '--child-fd', str(self.sock.fileno()), '--host', self.host, '--port', str(port), '--threads', str(self.threads)
+        ]
+        self.process = subprocess.Popen(cmd, env={**os.environ, **self.env, ROLE_ENV: self.role}, pass_fds=(self.sock.fileno(),))
+        self.started_at = time.time()
+        logger.info(f"{self.name} 已启动 (pid {self.process.pid})")
+
+    def check(self):
+        """
+        检查子进程是否退出，需要时重新启动
+        """
+        if self.process is None:
+            if time.time() >= self.restart_at:
+                self.start()
+            return
+        returncode = self.process.poll()
+        if returncode is None:
+            return
+        self.process = None
+        if returncode == RECYCLE_EXIT_CODE:
+            logger.info(f"{self.name} 已回收，重新启动")
+            self.restart_delay = RESTART_DELAY
+            self.start()
+            return
+        if time.time() - self.started_at > STABLE_SECONDS:
+            self.restart_delay = RESTART_DELAY
+        logger.error(f"{self.name} 异常退出 (退出码 {returncode})，{self.restart_delay:.0f}秒后重新启动")
+        self.restart_at = time.time() + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if not self.process:
+            return
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def run_supervisor(args):
+    """
+    主进程：创建对外端口和调度进程的内部端口，启动一个调度进程和多个Web进程并在退出后重新启动
+    """
+    listener = create_listener(args.host, args.port)
+    internal = create_listener('127.0.0.1', 0)
+    env = {
+        SCHEDULER_URL_ENV: f"http://127.0.0.1:{internal.getsockname()[1]}",
+        INTERNAL_TOKEN_ENV: secrets.token_hex(16),
+        SUPERVISED_ENV: '1'
+    }
+    children = [ChildProcess('调度进程', 'scheduler', internal, '127.0.0.1', env, args.threads)]
+    children += [ChildProcess(f'Web进程{i + 1}', 'web', listener, args.host, env, args.threads) for i in range(args.workers)]
+
+    stopping = []
+    def handle_stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    logger.info(f"服务在 http://{args.host}:{args.port} 启动，{args.workers} 个Web进程")
+    for child in children:
+        child.start()
+    while not stopping:
+        time.sleep(0.5)
+        for child in children:
+            child.check()
+
+    logger.info("正在停止服务")
+    for child in children:
+        child.stop()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for child in children:
+        child.wait(max(deadline - time.time(), 0))
+
+
+def run_child(args):
+    """
+    子进程：在主进程传入的端口上运行web_app（角色由环境变量指定）
+
+    安装了waitress时由waitress提供服务（连接超时、请求缓冲，慢速客户端不占用处理线程）；
+    未安装时退回Werkzeug开发服务器，它没有请求超时和慢速客户端保护，不适合直接面向公网
+    """
+    from web_app import app
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+    if waitress:
+        sock = socket.socket(fileno=args.child_fd)
+        waitress.serve(app, sockets=[sock], threads=args.threads, channel_timeout=CHANNEL_TIMEOUT)
+        return
+    logger.warning("未安装waitress，使用Werkzeug开发服务器（没有请求超时和慢速客户端保护），生产环境请安装: pip install waitress")
+    from werkzeug.serving import make_server
+    server = make_server(args.host, args.port, app, threaded=True, fd=args.child_fd)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程部署：一个调度进程负责任务队列和后台线程，多个Web进程共享同一个端口处理请求')
+    parser.add_argument('--host', default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 4), help='Web进程数')
+    parser.add_argument('--threads', type=int, default=8, help='每个进程的请求处理线程数（使用waitress时）')
+    parser.add_argument('--child-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_fd is not None:
+        run_child(args)
+    elif os.name == 'nt':
+        # Windows不支持向子进程传递监听端口，退回单进程运行
+        logger.info("当前平台不支持多进程共享端口，以单进程方式运行")
+        from web_app import app
+        app.run(host=args.host, port=args.port, threaded=True)
+    else:
+        run_supervisor(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import hmac
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 进程角色：single（默认，python web_app.py单进程运行，既处理请求又调度任务）、
+# scheduler（serve.py启动的调度进程，唯一运行任务队列和各后台线程）、web（serve.py启动的Web进程，只处理请求）
+ROLE_ENV = 'WUCAI_ROLE'
+ROLES = ('single', 'scheduler', 'web')
+
+# 调度进程的内部地址和内部调用令牌，由serve.py生成并传给各进程
+SCHEDULER_URL_ENV = 'WUCAI_SCHEDULER_URL'
+INTERNAL_TOKEN_ENV = 'WUCAI_INTERNAL_TOKEN'
+INTERNAL_TOKEN_HEADER = 'X-Wucai-Internal-Token'
+
+# 调度锁：同一工作目录只允许一个进程运行任务调度
+SCHEDULER_LOCK_FILE = os.path.join('.wucai', 'scheduler.lock')
+
+# 转发给调度进程的请求头（不转发Accept-Encoding，响应由Web进程自行压缩；客户端自带的X-Submitter不转发）
+FORWARDED_HEADERS = ('Content-Type', 'If-None-Match')
+# 转发时附带的客户端地址和Web进程确定的提交者，调度进程只在内部调用令牌校验通过时采用
+FORWARDED_FOR_HEADER = 'X-Forwarded-For'
+SUBMITTER_HEADER = 'X-Submitter'
+FORWARD_TIMEOUT = 60
+
+_lock_file = None
+
+
+class SchedulerUnavailable(Exception):
+    """Web进程无法连接调度进程"""
+
+
+def get_role():
+    role = os.environ.get(ROLE_ENV) or 'single'
+    if role not in ROLES:
+        raise ValueError(f"不支持的进程角色: {role}")
+    return role
+
+
+def is_scheduler():
+    return get_role() != 'web'
+
+
+def acquire_scheduler_lock(lock_file=SCHEDULER_LOCK_FILE):
+    """
+    获取调度锁（进程退出时自动释放）
+
+    Returns:
+        是否获取成功；已有其他进程持有时返回False
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    os.makedirs(os.path.dirname(lock_file) or '.', exist_ok=True)
+    f = open(lock_file, 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+    _lock_file = f
+    return True
+
+
+def check_internal_token(req):
+    """
+    校验内部调用令牌；未由serve.py启动（没有令牌）时一律拒绝
+    """
+    token = os.environ.get(INTERNAL_TOKEN_ENV)
+    return bool(token) and hmac.compare_digest(req.headers.get(INTERNAL_TOKEN_HEADER, ''), token)
+
+
+def scheduler_request(method, path, **kwargs):
+    """
+    向调度进程发送内部请求
+
+    Raises:
+        SchedulerUnavailable: 调度进程未启动、正在重启或响应超时
+    """
+    import requests
+    base_url = os.environ.get(SCHEDULER_URL_ENV)
+    if not base_url:
+        raise SchedulerUnavailable('未配置调度进程地址')
+    headers = kwargs.pop('headers', {})
+    headers[INTERNAL_TOKEN_HEADER] = os.environ.get(INTERNAL_TOKEN_ENV, '')
+    headers['Accept-Encoding'] = 'identity'
+    try:
+        return requests.request(method, base_url.rstrip('/') + path, headers=headers, timeout=FORWARD_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        raise SchedulerUnavailable(str(e))
+
+
+def forward_request(req, submitter=None):
+    """
+    把当前请求原样转发给调度进程
+
+    Args:
+        submitter: Web进程确定的提交者标识
+
+    Returns:
+        (响应内容, 状态码, 响应头)
+    """
+    headers = {name: req.headers[name] for name in FORWARDED_HEADERS if name in req.headers}
+    headers[FORWARDED_FOR_HEADER] = req.remote_addr or ''
+    if submitter:
+        headers[SUBMITTER_HEADER] = submitter
+    response = scheduler_request(req.method, req.full_path.rstrip('?'), data=req.get_data(), headers=headers)
+    forwarded = {name: response.headers[name] for name in ('Content-Type', 'ETag') if name in response.headers}
+    return response.content, response.status_code, forwarded
+
+
+def call_scheduler(name, payload):
+    """
+    在调度进程中执行内部调用
+
+    Returns:
+        (响应数据, 状态码)
+    """
+    response = scheduler_request('POST', f'/internal/call/{name}', json=payload)
+    try:
+        return response.json(), response.status_code
+    except ValueError:
+        raise SchedulerUnavailable(f"调度进程返回了无法解析的响应（{response.status_code}）")
@@ -0,0 +1,45 @@
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """
+    服务启动耗时报告
+
+    依次记录启动过程中各个步骤（导入依赖、加载任务状态、注册后台任务等）的耗时，
+    启动完成后写入日志，并可通过/startup_report查看，用于发现拖慢重启的步骤。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.steps = []
+        self.total_ms = None
+        self.ready_at = None
+
+    def mark(self, step, **details):
+        """
+        记录从上一步结束到现在的耗时
+
+        Args:
+            step: 步骤名称
+            details: 附加信息（如加载的任务数）
+        """
+        now = time.perf_counter()
+        self.steps.append({'step': step, 'ms': round((now - self.last) * 1000, 1), **details})
+        self.last = now
+
+    def finish(self):
+        """
+        启动完成，记录总耗时并写入日志
+        """
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        self.ready_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        summary = ', '.join(f"{item['step']} {item['ms']}ms" for item in self.steps)
+        logger.info(f"服务启动完成，耗时 {self.total_ms}ms ({summary})")
+
+    def as_dict(self):
+        return {'total_ms': self.total_ms, 'ready_at': self.ready_at, 'steps': self.steps}
@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+from statistics import median
+
+from upload_stream import validate_document, get_file_ext
+
+logger = logging.getLogger(__name__)
+
+# 处理记录文件路径，用于统计各模型的历史吞吐量
+RECORDS_FILE = os.path.join('.wucai', 'processing_records.json')
+
+# 默认吞吐量参数（无历史记录时使用）
+BASE_SECONDS = 30  # 启动子进程、加载依赖等固定开销
+SECONDS_PER_PAGE = 0.5  # 本地提取每页/每张幻灯片的耗时
+DEFAULT_SECONDS_PER_IMAGE = 15.0  # 视觉模型识别每张图片的耗时
+DEFAULT_TOKENS_PER_SECOND = 20.0  # 文本模型的输出速度
+OUTPUT_TOKENS_PER_PAGE = 400  # 每页内容整理后大约输出的token数
+MAX_OUTPUT_TOKENS = 8192  # 模型常见的单次输出上限
+
+# 截止时间 = 预计耗时 * 安全系数，并限制在上下限之间
+SAFETY_FACTOR = 2.0
+MIN_DEADLINE_SECONDS = 300
+MAX_DEADLINE_SECONDS = 4 * 3600
+
+# 参与统计的最近记录数
+HISTORY_SIZE = 200
+
+
+def inspect_document(file_path):
+    """
+    快速统计文档规模：页数/幻灯片数、图片数和字符数（无法获取的项为0）
+    """
+    ext = get_file_ext(file_path)
+    try:
+        return validate_document(file_path, ext)
+    except Exception as e:
+        logger.error(f"统计文档规模时出错: {str(e)}")
+        return {'pages': 0, 'images': 0, 'chars': 0}
+
+
+def load_throughput(text_model, image_model, records_file=RECORDS_FILE):
+    """
+    根据历史处理记录统计模型吞吐量：文本模型每秒输出token数、视觉模型每张图片耗时
+    """
+    throughput = {
+        'tokens_per_second': DEFAULT_TOKENS_PER_SECOND,
+        'seconds_per_image': DEFAULT_SECONDS_PER_IMAGE
+    }
+    if not os.path.exists(records_file):
+        return throughput
+    try:
+        with open(records_file, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        records = json.loads(content) if content else []
+    except (json.JSONDecodeError, IOError) as e:
+        logger.error(f"读取处理记录时出错: {str(e)}")
+        return throughput
+
+    token_rates = []
+    image_costs = []
+    for record in records[-HISTORY_SIZE:]:
+        stage_seconds = record.get('stage_seconds') or {}
+        if record.get('text_model') == text_model and stage_seconds.get('generate'):
+            output_tokens = record.get('output_tokens', 0)
+            if output_tokens:
+                token_rates.append(output_tokens / stage_seconds['generate'])
+        if record.get('image_model') == image_model and stage_seconds.get('image'):
+            image_count = record.get('image_count', 0)
+            if image_count:
+                image_costs.append(stage_seconds['image'] / image_count)
+
+    if token_rates:
+        throughput['tokens_per_second'] = median(token_rates)
+    if image_costs:
+        throughput['seconds_per_image'] = median(image_costs)
+    return throughput
+
+
+def estimate_task_seconds(profile, throughput, output_tokens=None):
+    """
+    根据文档规模和吞吐量估算处理耗时（秒）
+
+    Args:
+        output_tokens: 已估算的输出token数，不传时按字符数或页数粗略估算
+    """
+    if output_tokens is None:
+        if profile['chars']:
+            output_tokens = profile['chars'] * 2 // 3
+        else:
+            output_tokens = max(profile['pages'], 1) * OUTPUT_TOKENS_PER_PAGE
+        output_tokens = max(512, min(output_tokens, MAX_OUTPUT_TOKENS))
+
+    return (
+        BASE_SECONDS
+        + profile['pages'] * SECONDS_PER_PAGE
+        + profile['images'] * throughput['seconds_per_image']
+        + output_tokens / max(throughput['tokens_per_second'], 0.1)
+    )
+
+
+def compute_deadline(file_path, text_model, image_model, profile=None):
+    """
+    计算任务的截止时间，profile为上传时已统计的文档规模，未提供时重新统计
+
+    Returns:
+        (deadline_seconds, estimated_seconds, profile)
+    """
+    profile = profile or inspect_document(file_path)
+    throughput = load_throughput(text_model, image_model)
+    estimated = estimate_task_seconds(profile, throughput)
+    deadline = min(max(estimated * SAFETY_FACTOR, MIN_DEADLINE_SECONDS), MAX_DEADLINE_SECONDS)
+    return int(deadline), round(estimated, 1), profile
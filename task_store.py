@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+# 任务状态数据库路径
+TASK_DB_FILE = os.path.join('.wucai', 'tasks.db')
+
+# 删除记录的保留时间（秒），其他进程需在此期间内同步
+REMOVAL_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class TaskStore(MutableMapping):
+    """
+    基于SQLite的任务状态存储，接口与{task_id: info}字典一致
+
+    启动时只读取任务ID、创建序号和版本号这几个带索引的列，任务记录在首次访问时才解析并缓存；
+    缓存中的记录可以原地修改，调用save()后按任务写回（不再整体重写一个大JSON文件）。
+    删除的任务记入removals表，其他进程按版本号和删除记录增量同步（见refresh）。
+    """
+
+    def __init__(self, db_file=TASK_DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    status TEXT,
+                    updated_at REAL,
+                    data TEXT NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_seq ON tasks (seq)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_version ON tasks (version)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS removals (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    task_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    version INTEGER,
+                    removed_at REAL NOT NULL
+                )
+            ''')
+        self.records = {}  # 已加载的任务记录
+        self.index = OrderedDict()  # {task_id: [seq, version]}，按创建顺序排列
+        for task_id, seq, version in self.conn.execute('SELECT task_id, seq, version FROM tasks ORDER BY seq'):
+            self.index[task_id] = [seq, version]
+        self.next_seq = max([seq for seq, _ in self.index.values()] + [-1]) + 1
+        # 已同步到的最大版本号和删除记录ID，refresh()只读取之后的变化
+        self.seen_version = max([version for _, version in self.index.values()] + [0])
+        self.seen_removal = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM removals').fetchone()[0]
+
+    def __getitem__(self, task_id):
+        with self.lock:
+            info = self.records.get(task_id)
+            if info is not None:
+                return info
+            if task_id not in self.index:
+                raise KeyError(task_id)
+            row = self.conn.execute('SELECT data, seq, version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                raise KeyError(task_id)
+            info = json.loads(row[0])
+            info['seq'], info['version'] = row[1], row[2]
+            self.records[task_id] = info
+            return info
+
+    def __setitem__(self, task_id, info):
+        with self.lock:
+            if task_id not in self.index:
+                self.index[task_id] = [self.next_seq, info.get('version') or 0]
+                self.next_seq += 1
+            info['seq'] = self.index[task_id][0]
+            info.setdefault('version', self.index[task_id][1])
+            self.records[task_id] = info
+            self.write(task_id)
+
+    def __delitem__(self, task_id):
+        self.remove(task_id)
+
+    def remove(self, task_id, version=None):
+        """
+        删除任务并记入删除记录
+
+        Args:
+            version: 删除时的任务变更版本号，其他进程同步后据此通知增量轮询的客户端
+        """
+        with self.lock:
+            if task_id not in self.index:
+                raise KeyError(task_id)
+            seq = self.index.pop(task_id)[0]
+            self.records.pop(task_id, None)
+            now = time.time()
+            with self.conn:
+                self.conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+                self.conn.execute(
+                    'INSERT INTO removals (task_id, seq, version, removed_at) VALUES (?, ?, ?, ?)',
+                    (task_id, seq, version, now)
+                )
+                self.conn.execute('DELETE FROM removals WHERE removed_at < ?', (now - REMOVAL_RETENTION_SECONDS,))
+
+    def __contains__(self, task_id):
+        return task_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def versions(self):
+        """
+        按创建顺序返回 [(task_id, version)]，不加载任务记录
+        """
+        with self.lock:
+            return [(task_id, version) for task_id, (_, version) in self.index.items()]
+
+    def sequences(self):
+        """
+        按创建顺序返回 [(seq, task_id)]，不加载任务记录
+        """
+        with self.lock:
+            return [(seq, task_id) for task_id, (seq, _) in self.index.items()]
+
+    def refresh(self):
+        """
+        读取其他进程写入的变化（多进程部署时只读的Web进程使用）：版本号大于上次同步的任务和新的删除记录，
+        丢弃对应的缓存记录。写入方需按版本号顺序写回，否则版本号较小的变更会被跳过
+
+        Returns:
+            (变化的任务 [(task_id, seq, version)]，按版本号升序, 删除的任务 [(task_id, seq, version)])
+        """
+        with self.lock:
+            changed = self.conn.execute(
+                'SELECT task_id, seq, version FROM tasks WHERE version > ? ORDER BY version', (self.seen_version,)
+            ).fetchall()
+            removals = self.conn.execute(
+                'SELECT id, task_id, seq, version FROM removals WHERE id > ? ORDER BY id', (self.seen_removal,)
+            ).fetchall()
+            for task_id, seq, version in changed:
+                self.records.pop(task_id, None)
+                self.index[task_id] = [seq, version]
+                self.seen_version = max(self.seen_version, version)
+                self.next_seq = max(self.next_seq, seq + 1)
+            removed = []
+            for removal_id, task_id, seq, version in removals:
+                self.seen_removal = removal_id
+                self.records.pop(task_id, None)
+                if self.index.pop(task_id, None) is not None:
+                    removed.append((task_id, seq, version))
+            return changed, removed
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def write(self, task_id):
+        info = self.records[task_id]
+        seq = self.index[task_id][0]
+        self.index[task_id][1] = info.get('version') or 0
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, seq, version, status, updated_at, data) VALUES (?, ?, ?, ?, ?, ?)',
+                (task_id, seq, info.get('version') or 0, info.get('status'), time.time(),
+                 json.dumps(info, ensure_ascii=False, separators=(',', ':')))
+            )
+
+    def save(self, task_ids=None):
+        """
+        将已加载的任务记录写回数据库
+
+        Args:
+            task_ids: 需要保存的任务ID，为None时保存全部已加载的记录
+        """
+        with self.lock:
+            for task_id in list(self.records) if task_ids is None else task_ids:
+                if task_id in self.records and task_id in self.index:
+                    self.write(task_id)
+
+    def snapshot(self):
+        """
+        返回全部任务记录的副本 {task_id: info}；未加载的记录直接从数据库解析，不放入缓存
+        """
+        with self.lock:
+            tasks = {task_id: info.copy() for task_id, info in self.records.items()}
+            rows = self.conn.execute('SELECT task_id, seq, version, data FROM tasks ORDER BY seq').fetchall()
+        result = {}
+        for task_id, seq, version, data in rows:
+            if task_id in tasks:
+                result[task_id] = tasks[task_id]
+                continue
+            info = json.loads(data)
+            info['seq'], info['version'] = seq, version
+            result[task_id] = info
+        return result
+
+    def import_json(self, json_file):
+        """
+        从旧版本的task_status.json一次性导入任务状态，导入后将原文件重命名为.migrated
+
+        Returns:
+            导入的任务数
+        """
+        with open(json_file, 'r', encoding='utf-8') as f:
+            tasks = json.load(f)
+        with self.lock:
+            version = max([info.get('version') or 0 for info in tasks.values()] + [0])
+            with self.conn:
+                for task_id, info in tasks.items():
+                    if task_id in self.index:
+                        continue
+                    # 旧版本保存的任务没有版本号，按创建顺序补齐
+                    if not info.get('version'):
+                        version += 1
+                        info['version'] = version
+                    info['seq'] = self.next_seq
+                    self.index[task_id] = [self.next_seq, info['version']]
+                    self.next_seq += 1
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO tasks (task_id, seq, version, status, updated_at, data) VALUES (?, ?, ?, ?, ?, ?)',
+                        (task_id, info['seq'], info['version'], info.get('status'), time.time(),
+                         json.dumps(info, ensure_ascii=False, separators=(',', ':')))
+                    )
+        os.replace(json_file, f"{json_file}.migrated")
+        logger.info(f"已从 {json_file} 导入 {len(tasks)} 条任务状态")
+        return len(tasks)
@@ -0,0 +1,47 @@
+import os
+
+from batch_executor import BatchExecutor, write_request
+
+
+class FakeBackend:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.submitted = []
+
+    def submit(self, input_file):
+        if self.fail:
+            raise RuntimeError('submit failed')
+        self.submitted.append(input_file)
+        return f'batch-{len(self.submitted)}'
+
+    def poll(self, batch_id):
+        return {'status': 'completed', 'results': [], 'error': None}
+
+
+def make_executor(tmp_path, backend, results):
+    executor = BatchExecutor(
+        load_config=lambda: {'batch_mode': {'backend': 'fake'}},
+        on_result=lambda task_id, result: results.append((task_id, result)),
+        batch_dir=str(tmp_path)
+    )
+    executor.backends['fake'] = backend
+    write_request(os.path.join(executor.pending_dir, 'task-1.json'), 'qwen-plus', [{'role': 'user', 'content': 'hi'}])
+    return executor
+
+
+def test_submit_failure_removes_input_file(tmp_path):
+    executor = make_executor(tmp_path, FakeBackend(fail=True), [])
+    assert executor.run_once(force=True)['submitted'] == 0
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.jsonl')]
+    assert [task_id for task_id, _, _ in executor.list_pending()] == ['task-1']
+    assert not executor.submitting
+
+
+def test_submit_and_poll(tmp_path):
+    results = []
+    executor = make_executor(tmp_path, FakeBackend(), results)
+    assert executor.run_once(force=True) == {'submitted': 1, 'finished': 1}
+    assert executor.list_pending() == []
+    assert executor.batches['batch-1']['status'] == 'completed'
+    assert [task_id for task_id, _ in results] == ['task-1']
+    assert results[0][1]['error']
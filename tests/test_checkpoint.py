@@ -0,0 +1,17 @@
+import os
+import time
+
+from checkpoint import Checkpoint
+
+
+def test_hash_signature_survives_mtime_change(tmp_path):
+    source = tmp_path / 'doc.pdf'
+    source.write_bytes(b'%PDF-1.4')
+    path = str(tmp_path / 'task.json')
+    checkpoint = Checkpoint(path, str(source), 'abc')
+    checkpoint.update(extracted_text='text')
+
+    later = time.time() + 3600
+    os.utime(source, (later, later))
+    assert Checkpoint(path, str(source), 'abc').get('extracted_text') == 'text'
+    assert Checkpoint(path, str(source), 'def').get('extracted_text') is None
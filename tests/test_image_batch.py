@@ -0,0 +1,25 @@
+from image_batch import parse_batch_response
+
+
+def test_headers_on_their_own_line():
+    text = "【图片1】\n一张流程图，包含三个步骤。\n\n【图片2】\n柱状图，展示季度销售额。"
+    assert parse_batch_response(text, 2) == ['一张流程图，包含三个步骤。', '柱状图，展示季度销售额。']
+
+
+def test_description_on_header_line():
+    text = "【图片1】这是一张系统架构图，\n包含网关和数据库。\n【图片2】：表格，列出各部门预算。"
+    assert parse_batch_response(text, 2) == ['这是一张系统架构图，\n包含网关和数据库。', '表格，列出各部门预算。']
+
+
+def test_markdown_headers_and_missing_image():
+    text = "### **【图片1】** 公司logo\n\n**[图片 3]**：二维码"
+    assert parse_batch_response(text, 3) == ['公司logo', None, '二维码']
+
+
+def test_inline_reference_is_not_a_header():
+    text = "【图片1】与【图片2】相同的折线图\n【图片2】折线图"
+    assert parse_batch_response(text, 2) == ['与【图片2】相同的折线图', '折线图']
+
+
+def test_no_headers():
+    assert parse_batch_response("无法识别", 2) == [None, None]
@@ -0,0 +1,77 @@
+from model_router import (
+    load_routing, fits, score_models, route_text_model, format_route_marker, parse_route_line, CONTEXT_SAFETY
+)
+
+
+def test_load_routing_merges_weights():
+    routing = load_routing({'model_routing': {'strategy': 'auto', 'weights': {'cost': 1.0}, 'unknown': 1}})
+    assert routing['strategy'] == 'auto'
+    assert routing['weights'] == {'quality': 1.0, 'cost': 1.0, 'latency': 0.3}
+    assert 'unknown' not in routing
+
+
+def test_fits_keeps_safety_margin():
+    info = {'context_length': 10000}
+    assert fits(info, int(10000 * CONTEXT_SAFETY))
+    assert not fits(info, int(10000 * CONTEXT_SAFETY) + 1)
+    assert fits(None, 10 ** 9)
+
+
+def test_fixed_strategy_uses_configured_model():
+    route = route_text_model({'text_model': 'qwen-turbo'}, 1000, 1000)
+    assert route['model'] == 'qwen-turbo'
+    assert route['reason'] == 'configured'
+
+
+def test_fixed_strategy_switches_on_context_overflow():
+    # qwen-turbo上下文为32768，放不下时换用能放下的模型中评分最高、价格最低的
+    route = route_text_model({'text_model': 'qwen-turbo'}, 40000, 8000)
+    assert route['reason'] == 'context_overflow'
+    assert route['model'] == 'qwen-max-longcontext'
+
+    config = {'text_model': 'qwen-turbo', 'model_routing': {'candidates': ['qwen-turbo', 'qwen-plus', 'qwen-max']}}
+    assert route_text_model(config, 40000, 8000)['model'] == 'qwen-plus'
+
+    route = route_text_model({'text_model': 'qwen-turbo'}, 10 ** 6, 8000)
+    assert route['reason'] == 'no_model_fits'
+    assert route['model'] == 'qwen-max-longcontext'
+
+
+def test_rules_match_in_order():
+    config = {'text_model': 'qwen-plus', 'model_routing': {'rules': [
+        {'max_tokens': 5000, 'model': 'qwen-turbo'},
+        {'min_tokens': 5000, 'model': 'qwen-max'}
+    ]}}
+    assert route_text_model(config, 1000, 1000)['model'] == 'qwen-turbo'
+    assert route_text_model(config, 10000, 5000)['model'] == 'qwen-max'
+    # 规则指定的模型放不下时继续按策略选择
+    assert route_text_model(config, 40000, 8000)['model'] == 'qwen-plus'
+
+
+def test_auto_strategy_prefers_cheap_fast_model_for_small_docs():
+    latencies = {'qwen-turbo': 0.5, 'qwen-plus': 1.0, 'qwen-max': 3.0}
+    config = {'model_routing': {'strategy': 'auto', 'candidates': list(latencies)}}
+    route = route_text_model(config, 1000, 1000, latencies.get)
+    assert route['reason'] == 'auto'
+    assert route['model'] == 'qwen-turbo'
+    # 大文档提高质量权重
+    route = route_text_model(config, 15000, 8000, latencies.get)
+    assert route['model'] == 'qwen-plus'
+
+
+def test_score_models_uses_average_latency_when_unknown():
+    candidates = [
+        {'id': 'a', 'rating': 4, 'input_price': 0.01, 'output_price': 0.01},
+        {'id': 'b', 'rating': 4, 'input_price': 0.01, 'output_price': 0.01}
+    ]
+    weights = {'quality': 1.0, 'cost': 0.0, 'latency': 1.0}
+    scored = score_models(candidates, 1000, 1000, weights, {'a': 2.0}.get)
+    assert scored[0][0] == scored[1][0]
+
+
+def test_route_marker_round_trip():
+    route = {'model': 'qwen-plus', 'reason': 'configured'}
+    assert parse_route_line(format_route_marker(route)) == route
+    assert parse_route_line('MODEL_ROUTE:not json') is None
+    assert parse_route_line('MODEL_ROUTE:{"reason": "auto"}') is None
+    assert parse_route_line('其他输出') is None
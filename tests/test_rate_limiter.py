@@ -0,0 +1,99 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from rate_limiter import AdaptiveLimiter
+
+
+def make_limiter():
+    return AdaptiveLimiter(state_file=None)
+
+
+def sequence(*results):
+    calls = []
+
+    def func():
+        result = results[min(len(calls), len(results) - 1)]
+        calls.append(result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return func, calls
+
+
+def test_none_result_stops_after_max_retries():
+    func, calls = sequence(None)
+    assert make_limiter().call('m', func, max_retries=2, base_delay=0) is None
+    assert len(calls) == 3
+
+
+def test_exception_reraised_after_max_retries():
+    func, calls = sequence(RuntimeError('boom'))
+    with pytest.raises(RuntimeError):
+        make_limiter().call('m', func, max_retries=2, base_delay=0)
+    assert len(calls) == 3
+
+
+def test_throttled_then_success():
+    ok = SimpleNamespace(status_code=200)
+    func, calls = sequence(RuntimeError('boom'), None, SimpleNamespace(status_code=429), ok)
+    assert make_limiter().call('m', func, max_retries=4, base_delay=0) is ok
+    assert len(calls) == 4
+
+
+def test_throttled_returns_last_response_when_retries_exhausted():
+    throttled = SimpleNamespace(status_code=429)
+    limiter = make_limiter()
+    func, calls = sequence(throttled)
+    assert limiter.call('m', func, max_retries=1, base_delay=0) is throttled
+    assert len(calls) == 2
+    assert limiter.get_stats('m').limit < 2
+
+
+def test_burst_of_throttles_halves_once():
+    limiter = make_limiter()
+    stats = limiter.get_stats('m')
+    stats.limit = 8.0
+    started = time.time()
+    for _ in range(4):
+        limiter.record('m', success=False, throttled=True, started=started)
+    assert stats.limit == 4.0
+    limiter.record('m', success=False, throttled=True, started=stats.last_decrease + 1)
+    assert stats.limit == 2.0
+
+
+def test_throttle_adopts_lower_limit_from_other_process(tmp_path):
+    state_file = str(tmp_path / 'rate_limits.json')
+    other = AdaptiveLimiter(state_file=state_file)
+    other.get_stats('m').limit = 1.0
+    other.save_state(force=True)
+    limiter = AdaptiveLimiter(initial_limit=8, state_file=None)
+    limiter.state_file = state_file
+    limiter.get_stats('m').limit = 8.0
+    limiter.record('m', success=False, throttled=True)
+    assert limiter.get_stats('m').limit == 1.0
+
+
+def test_streaming_latency_uses_first_chunk():
+    limiter = make_limiter()
+
+    def stream():
+        limiter.mark_first_chunk()
+        time.sleep(0.05)
+        return SimpleNamespace(status_code=200)
+
+    limiter.call('m', stream)
+    assert limiter.get_latency('m') < 0.04
+
+
+def test_non_streaming_latency_normalized_by_output_tokens():
+    limiter = make_limiter()
+
+    def call():
+        time.sleep(0.05)
+        return SimpleNamespace(status_code=200, usage={'output_tokens': 100})
+
+    limiter.call('m', call)
+    assert limiter.get_latency('m') < 0.005
@@ -0,0 +1,67 @@
+import os
+import time
+
+from retention import RetentionManager, DEFAULT_POLICY
+
+DAY = 86400
+
+
+def make_upload(upload_dir, name, age_days, size=16):
+    path = os.path.join(upload_dir, name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    mtime = time.time() - age_days * DAY
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def make_manager(tmp_path, tasks):
+    upload_dir = tmp_path / 'uploads'
+    upload_dir.mkdir(exist_ok=True)
+    return RetentionManager(
+        get_tasks=lambda: tasks,
+        remove_tasks=lambda task_ids: None,
+        load_config=lambda: {},
+        upload_dir=str(upload_dir),
+        output_dir=str(tmp_path / 'output'),
+        resolve_upload=lambda task_id, info: os.path.join(str(upload_dir), f"{info['file_hash']}.pdf")
+    )
+
+
+def make_tasks():
+    old = time.time() - 30 * DAY
+    return {
+        'pending': {'status': 'pending', 'input_filename': 'a.pdf', 'file_hash': 'h_pending', 'start_time': old},
+        'failed': {'status': 'failed', 'input_filename': 'b.pdf', 'file_hash': 'h_failed', 'start_time': old, 'end_time': old},
+        'completed': {'status': 'completed', 'input_filename': 'c.pdf', 'file_hash': 'h_completed', 'start_time': old, 'end_time': old},
+        'recent': {'status': 'completed', 'input_filename': 'd.pdf', 'file_hash': 'h_recent', 'start_time': time.time(), 'end_time': time.time()},
+    }
+
+
+def test_uploads_of_unfinished_tasks_are_kept(tmp_path):
+    tasks = make_tasks()
+    manager = make_manager(tmp_path, tasks)
+    upload_dir = manager.upload_dir
+    for info in tasks.values():
+        make_upload(upload_dir, f"{info['file_hash']}.pdf", age_days=30)
+    make_upload(upload_dir, 'orphan.pdf', age_days=30)
+
+    report = {'deleted_uploads': 0, 'deleted_temp': 0, 'freed_bytes': 0}
+    manager.clean_uploads(tasks, DEFAULT_POLICY.copy(), report)
+
+    remaining = set(os.listdir(upload_dir))
+    assert remaining == {'h_pending.pdf', 'h_failed.pdf', 'h_recent.pdf'}
+    assert report['deleted_uploads'] == 2
+
+
+def test_size_limit_skips_active_tasks(tmp_path):
+    tasks = make_tasks()
+    manager = make_manager(tmp_path, tasks)
+    for info in tasks.values():
+        make_upload(manager.upload_dir, f"{info['file_hash']}.pdf", age_days=1, size=100)
+
+    policy = {**DEFAULT_POLICY, 'upload_max_age_days': 90, 'upload_max_bytes': 1}
+    report = {'deleted_uploads': 0, 'deleted_temp': 0, 'freed_bytes': 0}
+    manager.clean_uploads(tasks, policy, report)
+
+    assert set(os.listdir(manager.upload_dir)) == {'h_pending.pdf'}
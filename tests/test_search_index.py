@@ -0,0 +1,54 @@
+from search_index import SearchIndex, build_match_query, tokenize_for_index
+
+
+def test_tokenize_cjk_bigrams():
+    assert tokenize_for_index('知识库abc') == ' 知识 识库 库 abc'
+    assert tokenize_for_index('图') == ' 图 '
+
+
+def test_build_match_query():
+    query, terms = build_match_query('知识库 Flask 图')
+    assert query == '"知识 识库" AND "Flask"* AND "图"*'
+    assert terms == ['知识库', 'Flask', '图']
+
+
+def make_index(tmp_path, documents):
+    index = SearchIndex(str(tmp_path / 'search.db'))
+    for name, content in documents.items():
+        path = tmp_path / name
+        path.write_text(content, encoding='utf-8')
+        index.index_document(name, str(path))
+    return index
+
+
+def test_search_ranks_and_highlights(tmp_path):
+    filler = '无关内容。' * 40
+    index = make_index(tmp_path, {
+        'a_processed.md': filler + '这里介绍知识库的构建方法。' + filler,
+        'b_processed.md': '数据库索引设计。',
+    })
+    results = index.search('知识库')
+    assert [result['doc_id'] for result in results] == ['a_processed.md']
+    snippet = results[0]['snippet']
+    assert '<mark>知识库</mark>' in snippet
+    assert snippet.startswith('...') and snippet.endswith('...')
+    assert len(snippet) < 250
+    assert index.search('识库构') == []
+    assert index.search('索引')[0]['doc_id'] == 'b_processed.md'
+
+
+def test_snippet_escapes_html_and_handles_title_only_hit(tmp_path):
+    index = make_index(tmp_path, {'report_processed.md': '<b>Flask</b> 应用'})
+    assert index.search('flask')[0]['snippet'] == '&lt;b&gt;<mark>Flask</mark>&lt;/b&gt; 应用'
+    assert index.search('report')[0]['snippet'] == '&lt;b&gt;Flask&lt;/b&gt; 应用'
+
+
+def test_reindex_and_remove(tmp_path):
+    index = make_index(tmp_path, {'a_processed.md': '旧的内容'})
+    path = tmp_path / 'a_processed.md'
+    path.write_text('新的文本，更长一些', encoding='utf-8')
+    assert index.index_document('a_processed.md', str(path))
+    assert index.search('旧的') == []
+    assert index.search('新的')[0]['doc_id'] == 'a_processed.md'
+    index.remove_document('a_processed.md')
+    assert index.search('新的') == []
@@ -0,0 +1,34 @@
+from task_store import TaskStore
+
+
+def test_refresh_reads_only_changes(tmp_path):
+    db_file = str(tmp_path / 'tasks.db')
+    writer = TaskStore(db_file)
+    writer['a'] = {'status': 'pending', 'version': 1}
+    writer['b'] = {'status': 'pending', 'version': 2}
+    reader = TaskStore(db_file)
+    assert reader['a']['status'] == 'pending'
+    assert reader.refresh() == ([], [])
+
+    writer['a']['status'] = 'completed'
+    writer['a']['version'] = 3
+    writer.save(['a'])
+    writer['c'] = {'status': 'pending', 'version': 4}
+    writer.remove('b', 5)
+
+    changed, removed = reader.refresh()
+    assert changed == [('a', 0, 3), ('c', 2, 4)]
+    assert removed == [('b', 1, 5)]
+    assert reader['a']['status'] == 'completed'
+    assert list(reader) == ['a', 'c']
+    assert reader.refresh() == ([], [])
+
+
+def test_removals_survive_reopen(tmp_path):
+    db_file = str(tmp_path / 'tasks.db')
+    writer = TaskStore(db_file)
+    writer['a'] = {'status': 'completed', 'version': 1}
+    reader = TaskStore(db_file)
+    del writer['a']
+    assert reader.refresh() == ([], [('a', 0, None)])
+    assert TaskStore(db_file).refresh() == ([], [])
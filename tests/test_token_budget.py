@@ -0,0 +1,47 @@
+from token_budget import TokenBudget, hash_key
+
+CONFIG = {'token_budget': {'submitter_per_minute': 1000}}
+
+
+def make_budget(tmp_path, submitted, config=CONFIG):
+    return TokenBudget(lambda: config, submitted.append, db_file=str(tmp_path / 'budget.db'))
+
+
+def task(task_id):
+    return {'task_id': task_id}
+
+
+def test_unrelated_submitter_not_blocked(tmp_path):
+    submitted = []
+    budget = make_budget(tmp_path, submitted)
+    assert budget.admit('a1', 'key', 'alice', 800, task('a1')) is None
+    assert budget.admit('a2', 'key', 'alice', 800, task('a2'))
+    assert budget.check('key', 'bob', 500)['decision'] == 'admit'
+    assert budget.admit('b1', 'key', 'bob', 500, task('b1')) is None
+    # 同一提交者的小任务仍排在前面的等待任务之后
+    assert budget.check('key', 'alice', 100)['decision'] == 'queue'
+    assert budget.admit('a3', 'key', 'alice', 100, task('a3'))
+    assert [item['task_id'] for item in submitted] == ['a1', 'b1']
+
+
+def test_process_waiting_keeps_order_within_scope(tmp_path):
+    submitted = []
+    budget = make_budget(tmp_path, submitted)
+    budget.admit('a1', 'key', 'alice', 800, task('a1'))
+    budget.admit('b1', 'key', 'bob', 800, task('b1'))
+    budget.admit('a2', 'key', 'alice', 800, task('a2'))
+    budget.admit('a3', 'key', 'alice', 100, task('a3'))
+    budget.admit('b2', 'key', 'bob', 600, task('b2'))
+    budget.release('b1')
+    assert budget.process_waiting() == 1
+    assert [item['task_id'] for item in submitted] == ['a1', 'b1', 'b2']
+    assert list(budget.waiting) == ['a2', 'a3']
+
+
+def test_shared_api_key_limit_keeps_fifo(tmp_path):
+    submitted = []
+    budget = make_budget(tmp_path, submitted, {'token_budget': {'per_minute': 1000}})
+    budget.admit('a1', 'key', 'alice', 800, task('a1'))
+    budget.admit('a2', 'key', 'alice', 800, task('a2'))
+    assert budget.waiting['a2']['scope'] == ('api_key', hash_key('key'))
+    assert budget.check('key', 'bob', 100)['decision'] == 'queue'
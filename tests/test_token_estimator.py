@@ -0,0 +1,80 @@
+import json
+
+import token_estimator
+from token_estimator import (
+    text_features, base_estimate, detect_language, build_calibration, get_calibration, estimate_tokens,
+    estimate_output_tokens, format_sample_marker, parse_sample_line, sample_document_text,
+    MIN_CALIBRATION_SAMPLES, MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS, DEFAULT_IMAGE_TOKENS
+)
+
+UNCALIBRATED = {'zh': 1.0, 'en': 1.0, 'image_tokens': DEFAULT_IMAGE_TOKENS, 'samples': {'zh': 0, 'en': 0}}
+
+
+def sample_record(text, input_tokens):
+    return {'token_sample': {'features': text_features(text), 'input_tokens': input_tokens}}
+
+
+def test_text_features_and_language():
+    features = text_features('知识库 knowledge base 2024!\n\n')
+    assert features['cjk'] == 3
+    assert features['words'] == 2
+    assert features['letters'] == 13
+    assert features['digits'] == 4
+    assert features['symbols'] == 1
+    assert features['newlines'] == 1
+    assert detect_language(text_features('这是一段中文文本，包含少量English')) == 'zh'
+    assert detect_language(text_features('An English paragraph with 一个 Chinese word')) == 'en'
+
+
+def test_estimate_tokens_uncalibrated():
+    text = '中文' * 50
+    assert estimate_tokens(text, UNCALIBRATED) == int(base_estimate(text_features(text))) + 1
+    assert estimate_tokens('', UNCALIBRATED) == 1
+
+
+def test_build_calibration_per_language():
+    zh_text = '中文文本' * 100
+    records = [sample_record(zh_text, int(base_estimate(text_features(zh_text)) * 1.5)) for _ in range(MIN_CALIBRATION_SAMPLES)]
+    # 英文样本不足时不校准
+    records.append(sample_record('english words ' * 50, 10))
+    records.append({'image_count': 4, 'image_token_usage': 4000})
+    calibration = build_calibration(records)
+    assert calibration['zh'] == 1.5
+    assert calibration['en'] == 1.0
+    assert calibration['samples'] == {'zh': MIN_CALIBRATION_SAMPLES, 'en': 1}
+    assert calibration['image_tokens'] == 1000
+    assert estimate_tokens(zh_text, calibration) > estimate_tokens(zh_text, UNCALIBRATED)
+
+
+def test_calibration_clamped():
+    text = 'english words ' * 50
+    records = [sample_record(text, 10 ** 6) for _ in range(MIN_CALIBRATION_SAMPLES)]
+    assert build_calibration(records)['en'] == token_estimator.CALIBRATION_RANGE[1]
+
+
+def test_get_calibration_reloads_when_records_change(tmp_path):
+    records_file = tmp_path / 'records.json'
+    assert get_calibration(str(records_file))['samples'] == {'zh': 0, 'en': 0}
+    zh_text = '中文文本' * 100
+    records = [sample_record(zh_text, 500) for _ in range(MIN_CALIBRATION_SAMPLES)]
+    records_file.write_text(json.dumps(records), encoding='utf-8')
+    assert get_calibration(str(records_file))['samples']['zh'] == MIN_CALIBRATION_SAMPLES
+
+
+def test_estimate_output_tokens_bounds():
+    assert estimate_output_tokens(10) == MIN_OUTPUT_TOKENS
+    assert estimate_output_tokens(3000) == 3000
+    assert estimate_output_tokens(10 ** 6) == MAX_OUTPUT_TOKENS
+
+
+def test_sample_marker_round_trip():
+    sample = parse_sample_line(format_sample_marker('中文 text', 42))
+    assert sample == {'features': text_features('中文 text'), 'input_tokens': 42}
+    assert parse_sample_line('TOKEN_SAMPLE:broken') is None
+    assert parse_sample_line('其他输出') is None
+
+
+def test_sample_markdown_text(tmp_path):
+    path = tmp_path / 'doc.md'
+    path.write_text('# 标题\n正文', encoding='utf-8')
+    assert sample_document_text(str(path), 'md') == ('# 标题\n正文', 1.0)
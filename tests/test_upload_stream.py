@@ -0,0 +1,124 @@
+import io
+import os
+import hashlib
+
+import pytest
+from flask import Flask, Request, jsonify, request
+
+from upload_stream import HashingUploadStream, UploadRejected, SNIFF_SIZE, check_magic
+
+
+def part_files(directory):
+    return [name for name in os.listdir(directory) if name.endswith('.part')]
+
+
+def test_hash_and_size_match_content(tmp_path):
+    data = b'%PDF-1.4\n' + os.urandom(5000)
+    stream = HashingUploadStream(str(tmp_path), 'doc.pdf')
+    for start in range(0, len(data), 700):
+        stream.write(data[start:start + 700])
+    assert stream.finish() == hashlib.sha256(data).hexdigest()
+    assert stream.size == len(data)
+    stream.close()
+    with open(stream.path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_magic_mismatch_rejected_after_head(tmp_path):
+    stream = HashingUploadStream(str(tmp_path), 'doc.pdf')
+    with pytest.raises(UploadRejected):
+        stream.write(b'not a pdf' * (SNIFF_SIZE // 9 + 1))
+    # 文件头校验失败时立即删除临时文件
+    assert part_files(tmp_path) == []
+
+
+def test_short_file_sniffed_on_finish(tmp_path):
+    stream = HashingUploadStream(str(tmp_path), 'slides.pptx')
+    stream.write(b'PK\x03\x04short')
+    stream.finish()
+    stream.discard()
+
+    stream = HashingUploadStream(str(tmp_path), 'slides.pptx')
+    stream.write(b'%PDF-short')
+    with pytest.raises(UploadRejected):
+        stream.finish()
+    assert part_files(tmp_path) == []
+
+
+def test_pdf_magic_allows_leading_bytes():
+    assert check_magic('pdf', b'\r\n%PDF-1.7')
+    assert not check_magic('ppt', b'PK\x03\x04')
+    assert not check_magic('md', b'abc\x00def')
+
+
+def test_markdown_utf8_split_across_chunks(tmp_path):
+    data = '# 标题\n正文内容'.encode('utf-8')
+    stream = HashingUploadStream(str(tmp_path), 'notes.md')
+    # 在多字节字符中间切分也不应误判
+    stream.write(data[:4])
+    stream.write(data[4:])
+    assert stream.finish() == hashlib.sha256(data).hexdigest()
+    stream.discard()
+
+
+def test_markdown_invalid_utf8_rejected(tmp_path):
+    stream = HashingUploadStream(str(tmp_path), 'notes.md')
+    with pytest.raises(UploadRejected):
+        stream.write(b'# title\n\xff\xfe')
+    assert part_files(tmp_path) == []
+
+    # 以不完整的多字节字符结尾
+    stream = HashingUploadStream(str(tmp_path), 'notes.md')
+    stream.write('正文'.encode('utf-8')[:-1])
+    with pytest.raises(UploadRejected):
+        stream.finish()
+    assert part_files(tmp_path) == []
+
+
+def make_app(upload_dir, max_content_length):
+    class StreamingRequest(Request):
+        def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+            stream = HashingUploadStream(upload_dir, filename)
+            self.__dict__.setdefault('upload_streams', []).append(stream)
+            return stream
+
+        def close(self):
+            try:
+                super().close()
+            finally:
+                for stream in self.__dict__.get('upload_streams', ()):
+                    stream.discard()
+
+    app = Flask(__name__)
+    app.request_class = StreamingRequest
+    app.config['MAX_CONTENT_LENGTH'] = max_content_length
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        try:
+            digest = request.files['file'].stream.finish()
+        except UploadRejected as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'hash': digest})
+
+    return app
+
+
+def test_upload_over_size_limit_rejected(tmp_path):
+    client = make_app(str(tmp_path), 4096).test_client()
+    data = b'%PDF-1.4\n' + b'x' * 2000
+    response = client.post('/upload', data={'file': (io.BytesIO(data), 'doc.pdf')})
+    assert response.status_code == 200
+    assert response.get_json()['hash'] == hashlib.sha256(data).hexdigest()
+
+    response = client.post('/upload', data={'file': (io.BytesIO(b'%PDF-1.4\n' + b'x' * 8192), 'doc.pdf')})
+    assert response.status_code == 413
+    # 请求结束后不留下任何临时文件
+    assert part_files(tmp_path) == []
+
+
+def test_upload_magic_mismatch_returns_400(tmp_path):
+    client = make_app(str(tmp_path), 1024 * 1024).test_client()
+    response = client.post('/upload', data={'file': (io.BytesIO(b'plain text'), 'doc.pdf')})
+    assert response.status_code == 400
+    assert part_files(tmp_path) == []
@@ -0,0 +1,108 @@
+import numpy as np
+
+import vector_index
+from vector_index import HashingEmbedder, VectorIndex, split_markdown, split_long_text
+
+TOPICS = ['apple', 'banana', 'cherry', 'durian', 'elderberry', 'fig', 'grape', 'honeydew']
+
+
+def write_doc(directory, name, content):
+    path = directory / name
+    path.write_text(content, encoding='utf-8')
+    return str(path)
+
+
+def make_index(tmp_path):
+    return VectorIndex(HashingEmbedder(64), str(tmp_path / 'index'))
+
+
+def test_split_markdown_by_heading():
+    content = '# 第一章\n引言\n## 1.1\n正文\n```\n# 代码里的注释\n```\n# 第二章\n结尾'
+    chunks = split_markdown(content)
+    assert [c['heading'] for c in chunks] == ['第一章', '第一章 > 1.1', '第二章']
+    assert '# 代码里的注释' in chunks[1]['text']
+
+
+def test_split_long_text_respects_limit():
+    text = '\n\n'.join(['a' * 30] * 5 + ['b' * 100])
+    pieces = split_long_text(text, 70)
+    assert all(len(piece) <= 70 for piece in pieces)
+    assert ''.join(pieces).replace('\n', '') == text.replace('\n', '')
+
+
+def test_hashing_embedder_normalized_and_deterministic():
+    embedder = HashingEmbedder(64)
+    vectors = embedder.embed(['知识库检索', 'knowledge base', ''])
+    assert vectors.dtype == np.float32
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1.0)
+    assert np.allclose(vectors, embedder.embed(['知识库检索', 'knowledge base', '']))
+
+
+def test_index_query_and_remove(tmp_path):
+    docs = tmp_path / 'output'
+    docs.mkdir()
+    index = make_index(tmp_path)
+    path = write_doc(docs, 'fruit_processed.md', '# Apple\napple apple pie\n# Banana\nbanana bread')
+    write_doc(docs, 'other_processed.md', '# 知识库\n向量检索与全文检索')
+    assert index.sync_directory(str(docs)) == (2, 0)
+    # 文件未变化时跳过
+    assert index.index_document('fruit_processed.md', path) is None
+
+    results = index.query('banana bread', k=2)
+    assert results[0]['doc_id'] == 'fruit_processed.md'
+    assert results[0]['heading'] == 'Banana'
+    assert index.query('向量检索', k=1)[0]['doc_id'] == 'other_processed.md'
+
+    (docs / 'other_processed.md').unlink()
+    assert index.sync_directory(str(docs)) == (0, 1)
+    assert all(r['doc_id'] == 'fruit_processed.md' for r in index.query('向量检索', k=5))
+
+    # 重新打开后从向量文件和元数据恢复
+    reopened = make_index(tmp_path)
+    assert reopened.query('apple pie', k=1)[0]['heading'] == 'Apple'
+
+
+def test_ivf_build_and_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, 'IVF_TRAIN_THRESHOLD', 40)
+    docs = tmp_path / 'output'
+    docs.mkdir()
+    index = make_index(tmp_path)
+    for i in range(60):
+        topic = TOPICS[i % len(TOPICS)]
+        write_doc(docs, f'{topic}{i}_processed.md', f'# {topic} {i}\n{topic} notes {topic} facts')
+    index.sync_directory(str(docs))
+
+    # 分块数达到阈值时训练聚类中心，之后新增的分块直接分配到最近的簇，向量文件按内存映射读取
+    assert index.centroids is not None
+    assert index.meta['trained_count'] == 40
+    assert isinstance(index.vectors, np.memmap)
+    assert sum(len(rows) for rows in index.lists.values()) == 60
+    assert len(index.lists) > 1
+
+    results = index.query('grape notes grape facts', k=3, nprobe=len(index.centroids))
+    assert results and all(r['doc_id'].startswith('grape') for r in results)
+    # 只扫描最近的簇时仍能找到同主题的分块
+    assert index.query('cherry facts', k=1, nprobe=1)[0]['doc_id'].startswith('cherry')
+
+    reopened = make_index(tmp_path)
+    assert reopened.centroids is not None
+    assert reopened.query('fig notes', k=1)[0]['doc_id'].startswith('fig')
+
+
+def test_compaction_after_removals(tmp_path):
+    docs = tmp_path / 'output'
+    docs.mkdir()
+    index = make_index(tmp_path)
+    for i in range(10):
+        write_doc(docs, f'doc{i}_processed.md', f'# doc {i}\n{TOPICS[i % len(TOPICS)]} text {i}')
+    index.sync_directory(str(docs))
+    for i in range(5):
+        (docs / f'doc{i}_processed.md').unlink()
+    generation = index.generation
+    assert index.sync_directory(str(docs)) == (0, 5)
+
+    # 删除比例过高时压缩向量文件并重新编号
+    assert index.generation == generation + 1
+    assert index.count == 5
+    assert index.deleted_count == 0
+    assert index.query('durian text 8', k=1)[0]['doc_id'] == 'doc8_processed.md'
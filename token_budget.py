@@ -0,0 +1,328 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# token消耗流水数据库，多个进程共享
+BUDGET_DB_FILE = os.path.join('.wucai', 'token_budget.db')
+
+# 默认预算，可通过配置项token_budget覆盖其中任意一项（0表示不限制）
+DEFAULT_BUDGET = {
+    'per_minute': 0,  # 每个API Key每分钟的token预算
+    'per_day': 0,  # 每个API Key最近24小时的token预算
+    'submitter_per_minute': 0,  # 每个提交者每分钟的token预算
+    'submitter_per_day': 0,  # 每个提交者最近24小时的token预算
+    'submitters': {},  # 按提交者单独设置的预算 {'提交者': {'per_minute': ..., 'per_day': ...}}
+    'on_exceed': 'queue',  # 超出预算时 queue: 排队等待额度; reject: 直接拒绝
+    'max_wait_seconds': 3600  # 排队超过该时间仍未获得额度的任务按超出预算处理
+}
+
+# 统计窗口（秒）
+WINDOWS = {'per_minute': 60, 'per_day': 24 * 3600}
+
+# 子进程上报的token用量行（文本生成和图像识别）
+USAGE_PATTERN = re.compile(r'^(?:IMAGE_)?TOKEN_USAGE:(\d+)\s*$')
+
+# 排队任务的检查间隔
+CHECK_INTERVAL = 5.0
+
+
+def load_budget(config):
+    """
+    合并配置中的token预算和默认值
+    """
+    budget = DEFAULT_BUDGET.copy()
+    budget.update({k: v for k, v in (config.get('token_budget') or {}).items() if k in DEFAULT_BUDGET})
+    return budget
+
+
+def hash_key(api_key):
+    """
+    API Key只以哈希前缀记录，不落盘明文
+    """
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+def parse_usage_line(line):
+    """
+    解析子进程输出的token用量行，不是用量行时返回None
+    """
+    match = USAGE_PATTERN.match(line)
+    return int(match.group(1)) if match else None
+
+
+def get_limits(budget, submitter):
+    """
+    返回各范围的预算 [(范围, 窗口名, 预算)]，只包含设置了预算的项
+    """
+    overrides = (budget['submitters'] or {}).get(submitter) or {}
+    limits = []
+    for window in WINDOWS:
+        if budget[window]:
+            limits.append(('api_key', window, budget[window]))
+        submitter_limit = overrides.get(window, budget[f'submitter_{window}'])
+        if submitter and submitter_limit:
+            limits.append(('submitter', window, submitter_limit))
+    return limits
+
+
+class TokenBudget:
+    """
+    按API Key和提交者的滚动token预算做准入控制
+
+    已消耗的token按子进程上报的实际用量逐次记入SQLite流水，按1分钟和24小时的滚动窗口统计；
+    已放行但尚未完成的任务按入队前的估算预占额度，实际用量记入后相应扣减预占。新任务的估算用量
+    加上已消耗和预占的额度超出预算时排队等待（或按配置直接拒绝），额度释放后在同一API Key或提交者的
+    范围内按提交顺序放行，额度不相关的任务不受影响。
+    """
+
+    def __init__(self, load_config, submit, db_file=BUDGET_DB_FILE):
+        """
+        Args:
+            load_config: 返回当前配置的函数
+            submit: submit(task_data)把获得额度的任务加入执行队列
+            db_file: 流水数据库路径
+        """
+        self.load_config = load_config
+        self.submit = submit
+        self.lock = threading.RLock()
+        self.wake_event = threading.Event()
+        self.reservations = {}  # {task_id: {'key_id', 'submitter', 'tokens'}}，已放行任务剩余的预占额度
+        self.waiting = OrderedDict()  # {task_id: {'key_id', 'submitter', 'tokens', 'task_data', 'queued_at', 'reason', 'scope'}}
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS spend (
+                    ts REAL NOT NULL,
+                    key_id TEXT NOT NULL,
+                    submitter TEXT,
+                    task_id TEXT,
+                    tokens INTEGER NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_spend_key ON spend (key_id, ts)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_spend_submitter ON spend (submitter, ts)')
+        self.last_prune = 0
+
+    def spent(self, scope, value, window):
+        """
+        返回某个API Key或提交者在窗口内已消耗的token数
+        """
+        column = 'key_id' if scope == 'api_key' else 'submitter'
+        since = time.time() - WINDOWS[window]
+        row = self.conn.execute(f'SELECT COALESCE(SUM(tokens), 0) FROM spend WHERE {column} = ? AND ts >= ?', (value, since)).fetchone()
+        return row[0]
+
+    def reserved(self, scope, value):
+        field = 'key_id' if scope == 'api_key' else 'submitter'
+        return sum(item['tokens'] for item in self.reservations.values() if item[field] == value)
+
+    def evaluate(self, key_id, submitter, tokens, budget):
+        """
+        判断估算用量为tokens的任务现在能否放行
+
+        Returns:
+            (是否放行, 超出的预算说明, 永远无法满足时为True, 超出的范围(scope, value))
+        """
+        for scope, window, limit in get_limits(budget, submitter):
+            value = key_id if scope == 'api_key' else submitter
+            used = self.spent(scope, value, window) + self.reserved(scope, value)
+            name = f"{'API Key' if scope == 'api_key' else f'提交者 {submitter} '}{'每分钟' if window == 'per_minute' else '每日'}预算{limit}"
+            if tokens > limit:
+                # 单个任务超过每日预算时永远无法放行；超过每分钟预算时在窗口空闲时单独放行
+                if window == 'per_day':
+                    return False, f"估算用量{tokens}超出{name}", True, (scope, value)
+                if used > 0:
+                    return False, f"估算用量{tokens}超出{name}，等待窗口空闲", False, (scope, value)
+                continue
+            if used + tokens > limit:
+                return False, f"已用{used}，加上估算用量{tokens}超出{name}", False, (scope, value)
+        return True, None, False, None
+
+    def queued_ahead(self, key_id, submitter):
+        """
+        返回等待队列中与本任务争用同一API Key或提交者额度的范围，没有时返回None（额度不相关的任务不排在其后）
+        """
+        for item in self.waiting.values():
+            scope = item['scope']
+            if scope == ('api_key', key_id) or (submitter and scope == ('submitter', submitter)):
+                return scope
+        return None
+
+    def check(self, api_key, submitter, tokens):
+        """
+        入队前检查任务是否可能获得额度（不预占）
+
+        Returns:
+            {'decision': 'admit' | 'queue' | 'reject', 'reason': 原因}
+        """
+        budget = load_budget(self.load_config())
+        key_id = hash_key(api_key)
+        with self.lock:
+            allowed, reason, impossible, _ = self.evaluate(key_id, submitter, tokens, budget)
+            # 同一范围内已有排队的任务时按顺序排队，避免小任务一直插队
+            if allowed and self.queued_ahead(key_id, submitter) is None:
+                return {'decision': 'admit', 'reason': None}
+            if impossible or budget['on_exceed'] == 'reject':
+                return {'decision': 'reject', 'reason': reason or '前面有任务在等待token额度'}
+            return {'decision': 'queue', 'reason': reason or '前面有任务在等待token额度'}
+
+    def admit(self, task_id, api_key, submitter, tokens, task_data):
+        """
+        为任务申请额度：能放行时预占额度并立即提交，否则加入等待队列
+
+        Returns:
+            None表示已提交，否则为排队原因
+        """
+        budget = load_budget(self.load_config())
+        key_id = hash_key(api_key)
+        with self.lock:
+            allowed, reason, _, scope = self.evaluate(key_id, submitter, tokens, budget)
+            ahead = self.queued_ahead(key_id, submitter)
+            if allowed and ahead is None:
+                self.reservations[task_id] = {'key_id': key_id, 'submitter': submitter, 'tokens': tokens}
+            else:
+                self.waiting[task_id] = {
+                    'key_id': key_id, 'submitter': submitter, 'tokens': tokens, 'task_data': task_data,
+                    'queued_at': time.time(), 'reason': reason or '前面有任务在等待token额度', 'scope': scope or ahead
+                }
+                logger.info(f"任务 {task_id} 等待token额度: {self.waiting[task_id]['reason']}")
+                return self.waiting[task_id]['reason']
+        self.submit(task_data)
+        return None
+
+    def record(self, task_id, tokens, api_key=None, submitter=None):
+        """
+        记入一次API调用的实际用量，并扣减该任务的预占额度
+
+        Args:
+            api_key, submitter: 任务没有预占记录时（如批量结果返回时）使用
+        """
+        with self.lock:
+            reservation = self.reservations.get(task_id)
+            if reservation:
+                key_id, submitter = reservation['key_id'], reservation['submitter']
+                reservation['tokens'] = max(reservation['tokens'] - tokens, 0)
+            else:
+                key_id = hash_key(api_key)
+            with self.conn:
+                self.conn.execute(
+                    'INSERT INTO spend (ts, key_id, submitter, task_id, tokens) VALUES (?, ?, ?, ?, ?)',
+                    (time.time(), key_id, submitter, task_id, tokens)
+                )
+            self.prune()
+
+    def release(self, task_id):
+        """
+        任务结束后释放剩余的预占额度，并检查等待中的任务
+        """
+        with self.lock:
+            released = self.reservations.pop(task_id, None)
+        if released:
+            self.wake_event.set()
+
+    def discard(self, task_id):
+        """
+        从等待队列中移除任务（任务被取消时调用）
+        """
+        with self.lock:
+            return self.waiting.pop(task_id, None) is not None
+
+    def prune(self):
+        # 每小时删除一次超出最长窗口的流水
+        now = time.time()
+        if now - self.last_prune < 3600:
+            return
+        self.last_prune = now
+        with self.conn:
+            self.conn.execute('DELETE FROM spend WHERE ts < ?', (now - max(WINDOWS.values()),))
+
+    def process_waiting(self, on_expired=None):
+        """
+        按提交顺序放行获得额度的等待任务；排在前面的任务仍无额度时，争用同一API Key或提交者额度的
+        后续任务继续等待，其他任务照常检查
+
+        Args:
+            on_expired: on_expired(task_id, reason)处理等待超时的任务
+
+        Returns:
+            放行的任务数
+        """
+        budget = load_budget(self.load_config())
+        released = []
+        expired = []
+        blocked = set()  # 已有任务在等待的范围
+        with self.lock:
+            for task_id, item in list(self.waiting.items()):
+                ahead = next((scope for scope in (('api_key', item['key_id']), ('submitter', item['submitter'])) if scope in blocked), None)
+                if ahead:
+                    allowed, reason, impossible, scope = False, '前面有任务在等待token额度', False, ahead
+                else:
+                    allowed, reason, impossible, scope = self.evaluate(item['key_id'], item['submitter'], item['tokens'], budget)
+                if allowed:
+                    del self.waiting[task_id]
+                    self.reservations[task_id] = {'key_id': item['key_id'], 'submitter': item['submitter'], 'tokens': item['tokens']}
+                    released.append(item['task_data'])
+                    continue
+                if impossible or time.time() - item['queued_at'] > budget['max_wait_seconds']:
+                    del self.waiting[task_id]
+                    expired.append((task_id, reason))
+                    continue
+                item['reason'], item['scope'] = reason, scope
+                blocked.add(scope)
+        for task_data in released:
+            logger.info(f"任务 {task_data['task_id']} 获得token额度，加入执行队列")
+            self.submit(task_data)
+        for task_id, reason in expired:
+            logger.info(f"任务 {task_id} 等待token额度超时: {reason}")
+            if on_expired:
+                on_expired(task_id, reason)
+        return len(released)
+
+    def status(self):
+        """
+        返回预算设置、各API Key和提交者的用量以及等待中的任务
+        """
+        budget = load_budget(self.load_config())
+        since = {window: time.time() - seconds for window, seconds in WINDOWS.items()}
+        with self.lock:
+            usage = {}
+            for scope, column in (('api_key', 'key_id'), ('submitter', 'submitter')):
+                rows = self.conn.execute(
+                    f'SELECT {column}, COALESCE(SUM(CASE WHEN ts >= ? THEN tokens END), 0), SUM(tokens) '
+                    f'FROM spend WHERE ts >= ? AND {column} IS NOT NULL GROUP BY {column}',
+                    (since['per_minute'], since['per_day'])
+                ).fetchall()
+                usage[scope] = {
+                    value: {'per_minute': minute, 'per_day': day, 'reserved': self.reserved(scope, value)}
+                    for value, minute, day in rows
+                }
+            waiting = [
+                {'task_id': task_id, 'submitter': item['submitter'], 'tokens': item['tokens'],
+                 'queued_at': item['queued_at'], 'reason': item['reason']}
+                for task_id, item in self.waiting.items()
+            ]
+        return {'budget': budget, 'usage': usage, 'waiting': waiting}
+
+    def loop(self, on_expired=None):
+        while True:
+            self.wake_event.wait(CHECK_INTERVAL)
+            self.wake_event.clear()
+            try:
+                if self.waiting:
+                    self.process_waiting(on_expired)
+            except Exception as e:
+                logger.error(f"检查等待token额度的任务时出错: {str(e)}")
+
+    def start(self, on_expired=None):
+        thread = threading.Thread(target=self.loop, args=(on_expired,), daemon=True)
+        thread.start()
+        return thread
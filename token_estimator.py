@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import zipfile
+import threading
+import logging
+from statistics import median
+
+import config_manager
+from model_router import route_text_model
+from task_deadline import load_throughput, estimate_task_seconds, RECORDS_FILE, HISTORY_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 子进程上报token校准样本的输出前缀，格式: TOKEN_SAMPLE:<JSON>
+TOKEN_SAMPLE_PREFIX = 'TOKEN_SAMPLE:'
+
+# 字符分类：中日韩文字、英文单词、数字、标点符号和换行
+CJK_CHARS = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+CJK_PATTERN = re.compile(f'[{CJK_CHARS}]')
+WORD_PATTERN = re.compile(r'[A-Za-z]+')
+DIGIT_PATTERN = re.compile(r'\d')
+SYMBOL_PATTERN = re.compile(f'[^\\sA-Za-z\\d{CJK_CHARS}]')
+NEWLINE_PATTERN = re.compile(r'\n+')
+
+# 未校准时的换算系数（参照通义千问分词器的典型值）
+CJK_TOKENS_PER_CHAR = 0.7
+LETTERS_PER_TOKEN = 4.0
+DIGITS_PER_TOKEN = 2.5
+
+# 校准系数的范围和所需的最少样本数
+MIN_CALIBRATION_SAMPLES = 3
+CALIBRATION_RANGE = (0.5, 2.0)
+
+# 视觉模型每张图片的输入输出token数（无历史记录时使用）
+DEFAULT_IMAGE_TOKENS = 1500
+# 图片描述写入文档后增加的文本token数
+DESCRIPTION_TOKENS_PER_IMAGE = 200
+# 输出token数的上下限（模型常见的输出上限）
+MIN_OUTPUT_TOKENS = 512
+MAX_OUTPUT_TOKENS = 8192
+
+# PDF只抽取部分页面的文本，按页数外推
+SAMPLE_PAGES = 8
+# 无法提取文本时每页的字符数
+DEFAULT_CHARS_PER_PAGE = 600
+
+SLIDE_TEXT_PATTERN = re.compile(rb'<a:t>([^<]*)</a:t>')
+SLIDE_NAME_PATTERN = re.compile(r'ppt/slides/slide\d+\.xml$')
+
+
+def text_features(text):
+    """
+    统计文本中各类字符的数量
+    """
+    words = WORD_PATTERN.findall(text)
+    return {
+        'cjk': len(CJK_PATTERN.findall(text)),
+        'words': len(words),
+        'letters': sum(map(len, words)),
+        'digits': len(DIGIT_PATTERN.findall(text)),
+        'symbols': len(SYMBOL_PATTERN.findall(text)),
+        'newlines': len(NEWLINE_PATTERN.findall(text))
+    }
+
+
+def base_estimate(features):
+    """
+    按未校准的系数估算token数
+    """
+    return (
+        features['cjk'] * CJK_TOKENS_PER_CHAR
+        + max(features['words'], features['letters'] / LETTERS_PER_TOKEN)
+        + features['digits'] / DIGITS_PER_TOKEN
+        + features['symbols']
+        + features['newlines']
+    )
+
+
+def detect_language(features):
+    """
+    按token占比判断文本以中文为主（zh）还是以英文为主（en）
+    """
+    cjk_tokens = features['cjk'] * CJK_TOKENS_PER_CHAR
+    return 'zh' if cjk_tokens >= base_estimate(features) - cjk_tokens else 'en'
+
+
+def scale_features(features, scale):
+    return {key: value * scale for key, value in features.items()}
+
+
+_calibration = None
+_calibration_signature = None
+_calibration_lock = threading.Lock()
+
+
+def build_calibration(records):
+    """
+    根据处理记录中的样本（实际输入token数和文本的字符统计）计算中文和英文的校准系数，
+    以及视觉模型每张图片的平均token数
+    """
+    ratios = {'zh': [], 'en': []}
+    image_tokens = []
+    for record in records[-HISTORY_SIZE:]:
+        sample = record.get('token_sample')
+        if sample and sample.get('input_tokens') and sample.get('features'):
+            estimated = base_estimate(sample['features'])
+            if estimated > 0:
+                ratios[detect_language(sample['features'])].append(sample['input_tokens'] / estimated)
+        if record.get('image_count') and record.get('image_token_usage'):
+            image_tokens.append(record['image_token_usage'] / record['image_count'])
+
+    low, high = CALIBRATION_RANGE
+    calibration = {'samples': {lang: len(values) for lang, values in ratios.items()}}
+    for lang, values in ratios.items():
+        factor = median(values) if len(values) >= MIN_CALIBRATION_SAMPLES else 1.0
+        calibration[lang] = round(min(max(factor, low), high), 4)
+    calibration['image_tokens'] = round(median(image_tokens)) if image_tokens else DEFAULT_IMAGE_TOKENS
+    return calibration
+
+
+def get_calibration(records_file=RECORDS_FILE):
+    """
+    获取校准系数，处理记录文件未变化时使用缓存
+    """
+    global _calibration, _calibration_signature
+    try:
+        stat = os.stat(records_file)
+        signature = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        signature = None
+    with _calibration_lock:
+        if _calibration is not None and signature == _calibration_signature:
+            return _calibration
+        records = []
+        if signature:
+            try:
+                with open(records_file, 'r', encoding='utf-8') as f:
+                    content = f.read().strip()
+                records = json.loads(content) if content else []
+            except (json.JSONDecodeError, IOError) as e:
+                logger.error(f"读取处理记录时出错: {str(e)}")
+        _calibration = build_calibration(records)
+        _calibration_signature = signature
+        return _calibration
+
+
+def estimate_from_features(features, calibration=None):
+    calibration = calibration or get_calibration()
+    return int(base_estimate(features) * calibration[detect_language(features)]) + 1
+
+
+def estimate_tokens(text, calibration=None):
+    """
+    估算文本的token数（按历史调用的实际用量校准）
+    """
+    return estimate_from_features(text_features(text), calibration)
+
+
+def estimate_output_tokens(content_tokens):
+    """
+    估算整理后输出的token数：与原文相近，并限制在模型常见的输出上限内
+
+    /estimate、预算预占、模型路由和生成阶段的进度计算共用此函数
+    """
+    return max(MIN_OUTPUT_TOKENS, min(content_tokens, MAX_OUTPUT_TOKENS))
+
+
+def sample_document_text(file_path, ext):
+    """
+    快速抽取文档的部分文本用于估算
+
+    Returns:
+        (抽样文本, 外推倍数)
+    """
+    if ext in ('md', 'markdown'):
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read(), 1.0
+    if ext == 'pdf':
+        from PyPDF2 import PdfReader
+        reader = PdfReader(file_path)
+        total = len(reader.pages)
+        if total == 0:
+            return '', 1.0
+        step = max(total / SAMPLE_PAGES, 1)
+        indexes = sorted({int(i * step) for i in range(min(total, SAMPLE_PAGES))})
+        text = '\n'.join(reader.pages[i].extract_text() or '' for i in indexes)
+        return text, total / len(indexes)
+    if ext == 'pptx':
+        with zipfile.ZipFile(file_path) as archive:
+            parts = [
+                b' '.join(SLIDE_TEXT_PATTERN.findall(archive.read(name)))
+                for name in archive.namelist() if SLIDE_NAME_PATTERN.match(name)
+            ]
+        return b'\n'.join(parts).decode('utf-8', errors='replace'), 1.0
+    # 旧版ppt等无法快速抽取文本的格式按页数估算
+    return '', 1.0
+
+
+def get_model_prices(model_id):
+    info = config_manager.get_model_info(model_id) or {}
+    return info.get('input_price', 0), info.get('output_price', 0)
+
+
+def estimate_document(file_path, ext, profile, config, prompt=''):
+    """
+    入队前估算任务的token用量、费用和耗时
+
+    Args:
+        file_path: 文档路径
+        ext: 扩展名（不含点）
+        profile: 文档规模 {'pages', 'images', 'chars'}
+        config: 当前配置
+        prompt: 用户提示词
+
+    Returns:
+        {'input_tokens', 'output_tokens', 'image_tokens', 'text_model', 'image_model', 'cost', 'estimated_seconds', ...}
+    """
+    calibration = get_calibration()
+    try:
+        text, scale = sample_document_text(file_path, ext)
+    except Exception as e:
+        logger.error(f"抽取文档文本用于估算时出错: {str(e)}")
+        text, scale = '', 1.0
+    if text.strip():
+        features = scale_features(text_features(text), scale)
+    else:
+        # 扫描件或无法抽取文本的格式按页数估算
+        chars = max(profile.get('pages', 0), 1) * DEFAULT_CHARS_PER_PAGE
+        features = {'cjk': chars, 'words': 0, 'letters': 0, 'digits': 0, 'symbols': 0, 'newlines': 0}
+
+    images = profile.get('images', 0)
+    content_tokens = estimate_from_features(features, calibration) + images * DESCRIPTION_TOKENS_PER_IMAGE
+    default_prompt = config.get('default_markdown_prompt' if ext in ('md', 'markdown') else
+                                'default_ppt_prompt' if ext in ('ppt', 'pptx') else 'default_prompt', '') or ''
+    input_tokens = content_tokens + estimate_tokens(f"{default_prompt}\n{prompt}", calibration)
+    output_tokens = estimate_output_tokens(content_tokens)
+    image_tokens = images * calibration['image_tokens']
+
+    route = route_text_model(config, input_tokens, output_tokens)
+    text_model = route['model']
+    image_model = config.get('image_model') or 'qwen-vl-plus'
+    text_input_price, text_output_price = get_model_prices(text_model)
+    image_input_price, _ = get_model_prices(image_model)
+    # 价格单位为每千token
+    text_cost = (input_tokens * text_input_price + output_tokens * text_output_price) / 1000
+    image_cost = image_tokens * image_input_price / 1000
+
+    throughput = load_throughput(text_model, image_model)
+    estimated_seconds = estimate_task_seconds(profile, throughput, output_tokens)
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'image_tokens': image_tokens,
+        'total_tokens': input_tokens + output_tokens + image_tokens,
+        'language': detect_language(features),
+        'text_model': text_model,
+        'image_model': image_model,
+        'route_reason': route['reason'],
+        'cost': {
+            'text': round(text_cost, 4),
+            'image': round(image_cost, 4),
+            'total': round(text_cost + image_cost, 4)
+        },
+        'estimated_seconds': round(estimated_seconds, 1),
+        'calibrated': any(calibration['samples'].values())
+    }
+
+
+def format_sample_marker(text, input_tokens):
+    """
+    生成上报给web_app.py的校准样本输出行：发送文本的字符统计和API返回的实际输入token数
+    """
+    return TOKEN_SAMPLE_PREFIX + json.dumps({'features': text_features(text), 'input_tokens': input_tokens})
+
+
+def parse_sample_line(line):
+    """
+    解析子进程输出的校准样本行，不是样本行时返回None
+    """
+    if not line.startswith(TOKEN_SAMPLE_PREFIX):
+        return None
+    try:
+        sample = json.loads(line[len(TOKEN_SAMPLE_PREFIX):])
+    except ValueError:
+        return None
+    return sample if isinstance(sample, dict) and sample.get('features') else None
@@ -0,0 +1,179 @@
+import os
+import re
+import codecs
+import hashlib
+import tempfile
+import zipfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 各文件类型的魔数，None表示文本文件，改为校验UTF-8编码
+MAGIC_SIGNATURES = {
+    'pdf': [b'%PDF-'],
+    'pptx': [b'PK\x03\x04'],
+    'ppt': [b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'],
+    'md': None,
+    'markdown': None
+}
+
+# 嗅探魔数所需的文件头长度（PDF允许文件头前有少量垃圾字节）
+SNIFF_SIZE = 1024
+
+
+class UploadRejected(Exception):
+    """
+    上传的文件未通过校验（类型不符、内容损坏等）
+    """
+    pass
+
+
+def get_file_ext(filename):
+    """
+    获取不带点的小写扩展名
+    """
+    return os.path.splitext(filename or '')[1].lower().lstrip('.')
+
+
+def check_magic(ext, head):
+    """
+    校验文件头与扩展名是否一致
+    """
+    signatures = MAGIC_SIGNATURES.get(ext)
+    if signatures is None:
+        # 文本文件：文件头中不应出现NUL字节
+        return b'\x00' not in head
+    if ext == 'pdf':
+        return any(sig in head for sig in signatures)
+    return any(head.startswith(sig) for sig in signatures)
+
+
+class HashingUploadStream:
+    """
+    上传文件流
+
+    Werkzeug解析multipart请求时直接分块写入上传目录下的临时文件，同时计算SHA-256，
+    并在收到文件头后立即校验魔数，类型不符时中止上传，不必等整个文件落盘。
+    """
+
+    def __init__(self, directory, filename):
+        self.ext = get_file_ext(filename)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.hasher = hashlib.sha256()
+        self.head = b''
+        self.size = 0
+        self.sniffed = False
+        # 文本文件增量校验UTF-8，避免多字节字符被分块截断时误判
+        self.decoder = codecs.getincrementaldecoder('utf-8')() if MAGIC_SIGNATURES.get(self.ext, b'') is None else None
+
+    def write(self, data):
+        if not self.sniffed:
+            self.head += data[:SNIFF_SIZE - len(self.head)]
+            if len(self.head) >= SNIFF_SIZE:
+                self.sniff()
+        if self.decoder:
+            try:
+                self.decoder.decode(data)
+            except UnicodeDecodeError:
+                self.discard()
+                raise UploadRejected('文本文件不是有效的UTF-8编码')
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def sniff(self):
+        """
+        校验文件头，不符合时删除临时文件并中止上传
+        """
+        self.sniffed = True
+        if not check_magic(self.ext, self.head):
+            self.discard()
+            raise UploadRejected(f'文件内容与扩展名 .{self.ext} 不符')
+
+    def finish(self):
+        """
+        上传写入完成后调用，完成对短文件的嗅探
+
+        Returns:
+            文件内容的SHA-256十六进制摘要
+        """
+        if not self.sniffed:
+            self.sniff()
+        if self.decoder:
+            try:
+                self.decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                self.discard()
+                raise UploadRejected('文本文件不是有效的UTF-8编码')
+        self.file.flush()
+        return self.hasher.hexdigest()
+
+    def discard(self):
+        """
+        关闭并删除临时文件
+        """
+        try:
+            self.file.close()
+        except Exception:
+            pass
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # 以下方法供Werkzeug的FileStorage使用
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        return self.file.readline(*args)
+
+    def close(self):
+        try:
+            self.file.close()
+        except Exception:
+            pass
+
+
+def validate_document(file_path, ext):
+    """
+    在入队前打开文档做结构校验并统计规模，损坏或空文档时抛出UploadRejected
+
+    Returns:
+        {'pages': 页数/幻灯片数, 'images': 图片数, 'chars': 字符数}
+    """
+    profile = {'pages': 0, 'images': 0, 'chars': 0}
+    if ext == 'pdf':
+        try:
+            from PyPDF2 import PdfReader
+            profile['pages'] = len(PdfReader(file_path).pages)
+        except Exception as e:
+            raise UploadRejected(f'PDF文件已损坏或无法解析: {str(e)}')
+        if profile['pages'] == 0:
+            raise UploadRejected('PDF文件没有任何页面')
+    elif ext == 'pptx':
+        try:
+            with zipfile.ZipFile(file_path) as archive:
+                names = archive.namelist()
+        except zipfile.BadZipFile:
+            raise UploadRejected('PPTX文件已损坏或无法解析')
+        if 'ppt/presentation.xml' not in names:
+            raise UploadRejected('文件不是有效的PPTX演示文稿')
+        profile['pages'] = sum(1 for name in names if re.match(r'ppt/slides/slide\d+\.xml$', name))
+        profile['images'] = sum(1 for name in names if name.startswith('ppt/media/'))
+        if profile['pages'] == 0:
+            raise UploadRejected('PPTX文件没有任何幻灯片')
+    elif ext in ('md', 'markdown'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        if not content.strip():
+            raise UploadRejected('markdown文件内容为空')
+        profile['pages'] = 1
+        profile['chars'] = len(content)
+        profile['images'] = len(re.findall(r'!\[.*?\]\(.*?\)', content))
+    return profile
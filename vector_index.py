@@ -0,0 +1,522 @@
+import os
+import re
+import json
+import time
+import math
+import sqlite3
+import hashlib
+import threading
+import logging
+from collections import Counter
+
+import numpy as np
+
+from search_index import CJK_PATTERN, cjk_tokens
+
+logger = logging.getLogger(__name__)
+
+# 向量索引目录：vectors.f32为只追加的向量文件（按内存映射读取），chunks.db保存分块元数据，
+# centroids.npy为IVF聚类中心，meta.json记录嵌入模型和维度
+VECTOR_INDEX_DIR = os.path.join('.wucai', 'vector_index')
+
+# 单个分块的最大字符数，超过时按段落继续切分
+MAX_CHUNK_CHARS = 1200
+
+# 分块数达到该值后训练IVF聚类中心，之前直接暴力检索
+IVF_TRAIN_THRESHOLD = 20000
+# 分块数增长到上次训练时的倍数，或已删除分块超过该比例时重建索引
+IVF_RETRAIN_GROWTH = 4
+COMPACT_DELETED_RATIO = 0.3
+# 训练聚类中心时的采样数和迭代次数
+KMEANS_SAMPLE_SIZE = 50000
+KMEANS_ITERATIONS = 10
+
+# 默认嵌入后端及参数，可通过配置项embedding_backend/embedding_model调整
+DEFAULT_EMBEDDING_BACKEND = 'hashing'
+DEFAULT_EMBEDDING_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+HASHING_DIM = 512
+
+
+def split_markdown(content, max_chars=MAX_CHUNK_CHARS):
+    """
+    按标题切分markdown文档，过长的小节再按段落切分
+
+    Returns:
+        [{'heading': 标题路径（如"第一章 > 1.1"）, 'text': 正文}]
+    """
+    chunks = []
+    headings = []  # [(级别, 标题)]
+    lines = []
+
+    def flush():
+        text = '\n'.join(lines).strip()
+        lines.clear()
+        if not text:
+            return
+        heading = ' > '.join(title for _, title in headings)
+        for piece in split_long_text(text, max_chars):
+            chunks.append({'heading': heading, 'text': piece})
+
+    in_code_block = False
+    for line in content.splitlines():
+        if line.lstrip().startswith('```'):
+            in_code_block = not in_code_block
+        match = None if in_code_block else re.match(r'^(#{1,6})\s+(.*?)\s*#*\s*$', line)
+        if match:
+            flush()
+            level = len(match.group(1))
+            while headings and headings[-1][0] >= level:
+                headings.pop()
+            headings.append((level, match.group(2)))
+        else:
+            lines.append(line)
+    flush()
+    return chunks
+
+
+def split_long_text(text, max_chars):
+    """
+    将超长文本按空行分段后合并为不超过max_chars的片段，单个超长段落直接截断切分
+    """
+    if len(text) <= max_chars:
+        return [text]
+    pieces = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n', text):
+        while len(paragraph) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            pieces.append(current)
+            current = ''
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current.strip():
+        pieces.append(current)
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+
+class HashingEmbedder:
+    """
+    基于特征哈希的确定性嵌入（英文按词、中文按二元组），不依赖任何模型，
+    用于测试和没有安装本地模型的环境，只能做词面匹配
+    """
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+        self.name = f"hashing:{dim}"
+
+    def tokens(self, text):
+        tokens = []
+        last = 0
+        for match in CJK_PATTERN.finditer(text):
+            tokens.extend(re.findall(r'\w+', text[last:match.start()].lower()))
+            tokens.extend(cjk_tokens(match.group()))
+            last = match.end()
+        tokens.extend(re.findall(r'\w+', text[last:].lower()))
+        return tokens
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token, count in Counter(self.tokens(text)).items():
+                digest = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                sign = 1.0 if digest & 1 else -1.0
+                vectors[i, (digest >> 1) % self.dim] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """
+    本地CPU嵌入模型（需要安装sentence-transformers）
+    """
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers:{model_name}:{self.dim}"
+
+    def embed(self, texts):
+        return self.model.encode(
+            texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+
+
+EMBEDDERS = {
+    'hashing': lambda config: HashingEmbedder(),
+    'sentence-transformers': lambda config: SentenceTransformerEmbedder(
+        config.get('embedding_model') or DEFAULT_EMBEDDING_MODEL
+    )
+}
+
+
+def get_embedder(config):
+    """
+    根据配置创建嵌入后端，本地模型不可用时回退到哈希嵌入
+    """
+    backend = config.get('embedding_backend') or DEFAULT_EMBEDDING_BACKEND
+    if backend not in EMBEDDERS:
+        logger.error(f"未知的嵌入后端: {backend}，使用 {DEFAULT_EMBEDDING_BACKEND}")
+        backend = DEFAULT_EMBEDDING_BACKEND
+    try:
+        return EMBEDDERS[backend](config)
+    except Exception as e:
+        logger.error(f"加载嵌入后端 {backend} 时出错: {str(e)}，使用 {DEFAULT_EMBEDDING_BACKEND}")
+        return EMBEDDERS[DEFAULT_EMBEDDING_BACKEND](config)
+
+
+def spherical_kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    对归一化向量做球面k-means，返回归一化后的聚类中心
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.linalg.norm(sums, axis=1) == 0
+        # 空簇重新随机选取中心
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """
+    输出文档的分块向量索引
+
+    向量追加写入vectors.f32并通过内存映射读取，分块数较少时暴力检索；超过阈值后训练IVF聚类中心，
+    查询时只扫描与查询向量最接近的若干个簇。文档按修改时间和大小增量更新，旧分块标记删除，
+    删除比例过高或数据量大幅增长时重建索引。
+    """
+
+    def __init__(self, embedder, index_dir=VECTOR_INDEX_DIR):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.index_dir = index_dir
+        self.vectors_file = os.path.join(index_dir, 'vectors.f32')
+        self.centroids_file = os.path.join(index_dir, 'centroids.npy')
+        self.meta_file = os.path.join(index_dir, 'meta.json')
+        self.db_file = os.path.join(index_dir, 'chunks.db')
+        self.lock = threading.RLock()
+        self.generation = 0  # 每次重建后递增，查询据此判断行号是否已重新编号
+        os.makedirs(index_dir, exist_ok=True)
+        self.load()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def load(self):
+        """
+        加载索引，嵌入模型变化时清空重建
+        """
+        meta = {}
+        if os.path.exists(self.meta_file):
+            try:
+                with open(self.meta_file, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.error(f"读取向量索引元数据时出错: {str(e)}")
+        if meta.get('embedder') != self.embedder.name:
+            if meta:
+                logger.info(f"嵌入模型已变化（{meta.get('embedder')} -> {self.embedder.name}），重建向量索引")
+            for path in (self.vectors_file, self.centroids_file, self.db_file, f'{self.db_file}-wal', f'{self.db_file}-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+            meta = {'embedder': self.embedder.name, 'dim': self.dim, 'trained_count': 0}
+        self.meta = meta
+        self.save_meta()
+
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    doc_id TEXT PRIMARY KEY,
+                    task_id TEXT,
+                    mtime REAL,
+                    size INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    row INTEGER PRIMARY KEY,
+                    doc_id TEXT NOT NULL,
+                    heading TEXT,
+                    text TEXT,
+                    list_id INTEGER NOT NULL DEFAULT 0,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks (doc_id)')
+            max_row = conn.execute('SELECT MAX(row) FROM chunks').fetchone()[0]
+            live = conn.execute('SELECT row, list_id FROM chunks WHERE deleted = 0 ORDER BY row').fetchall()
+            self.deleted_count = conn.execute('SELECT COUNT(*) FROM chunks WHERE deleted = 1').fetchone()[0]
+
+        # 向量写入后、元数据提交前退出时，截掉多余的向量
+        self.count = 0 if max_row is None else max_row + 1
+        row_bytes = self.dim * 4
+        if os.path.exists(self.vectors_file) and os.path.getsize(self.vectors_file) != self.count * row_bytes:
+            with open(self.vectors_file, 'r+b') as f:
+                f.truncate(self.count * row_bytes)
+
+        self.centroids = np.load(self.centroids_file) if os.path.exists(self.centroids_file) else None
+        lists = {}
+        for row, list_id in live:
+            lists.setdefault(list_id, []).append(row)
+        self.lists = {list_id: np.array(rows, dtype=np.int64) for list_id, rows in lists.items()}
+        self.open_vectors()
+
+    def save_meta(self):
+        tmp_file = f"{self.meta_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, self.meta_file)
+
+    def open_vectors(self):
+        """
+        重新映射向量文件（追加写入后调用）
+        """
+        if self.count:
+            self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+
+    @property
+    def live_count(self):
+        return sum(len(rows) for rows in self.lists.values())
+
+    def assign_lists(self, vectors):
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def index_document(self, doc_id, file_path, task_id=None):
+        """
+        切分并嵌入一个输出文档，替换该文档已有的分块，文件未变化时跳过
+
+        Returns:
+            新增的分块数，文件未变化时为None
+        """
+        stat = os.stat(file_path)
+        with self.connect() as conn:
+            row = conn.execute('SELECT mtime, size FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+        if row and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return None
+
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            chunks = split_markdown(f.read())
+        # 嵌入在锁外进行，本地模型较慢时不阻塞查询
+        vectors = self.embedder.embed([f"{c['heading']}\n{c['text']}" for c in chunks]) if chunks else None
+
+        with self.lock:
+            self.remove_document(doc_id)
+            start = self.count
+            list_ids = []
+            if chunks:
+                list_ids = self.assign_lists(vectors)
+                with open(self.vectors_file, 'ab') as f:
+                    f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with self.connect() as conn:
+                conn.executemany(
+                    'INSERT INTO chunks (row, doc_id, heading, text, list_id) VALUES (?, ?, ?, ?, ?)',
+                    [(start + i, doc_id, c['heading'], c['text'], int(list_ids[i])) for i, c in enumerate(chunks)]
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO documents (doc_id, task_id, mtime, size) VALUES (?, ?, ?, ?)',
+                    (doc_id, task_id, stat.st_mtime, stat.st_size)
+                )
+            self.count += len(chunks)
+            for i, list_id in enumerate(list_ids):
+                self.lists[int(list_id)] = np.append(self.lists.get(int(list_id), np.empty(0, dtype=np.int64)), start + i)
+            self.open_vectors()
+            self.maybe_rebuild()
+        logger.info(f"已更新向量索引: {doc_id}（{len(chunks)} 个分块）")
+        return len(chunks)
+
+    def remove_document(self, doc_id):
+        """
+        将文档的分块标记为删除
+        """
+        with self.lock:
+            with self.connect() as conn:
+                rows = [r[0] for r in conn.execute('SELECT row FROM chunks WHERE doc_id = ? AND deleted = 0', (doc_id,))]
+                conn.execute('UPDATE chunks SET deleted = 1 WHERE doc_id = ?', (doc_id,))
+                conn.execute('DELETE FROM documents WHERE doc_id = ?', (doc_id,))
+            if rows:
+                removed = np.array(rows, dtype=np.int64)
+                self.lists = {
+                    list_id: ids[~np.isin(ids, removed)] for list_id, ids in self.lists.items()
+                }
+                self.deleted_count += len(rows)
+
+    def maybe_rebuild(self):
+        """
+        数据量跨过训练阈值、大幅增长或删除比例过高时重建索引
+        """
+        live = self.live_count
+        trained = self.meta.get('trained_count', 0)
+        needs_training = live >= IVF_TRAIN_THRESHOLD and (not trained or live >= trained * IVF_RETRAIN_GROWTH)
+        needs_compaction = self.count and self.deleted_count / self.count > COMPACT_DELETED_RATIO
+        if needs_training or needs_compaction:
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        压缩掉已删除的向量，并在数据量足够时重新训练IVF聚类中心
+        """
+        with self.lock:
+            started = time.time()
+            live_rows = np.sort(np.concatenate(list(self.lists.values()))) if self.lists else np.empty(0, dtype=np.int64)
+            tmp_file = f"{self.vectors_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                for start in range(0, len(live_rows), 65536):
+                    f.write(np.ascontiguousarray(self.vectors[live_rows[start:start + 65536]]).tobytes())
+            os.replace(tmp_file, self.vectors_file)
+            self.count = len(live_rows)
+            self.open_vectors()
+
+            centroids = None
+            if self.count >= IVF_TRAIN_THRESHOLD:
+                nlist = min(4096, int(4 * math.sqrt(self.count)))
+                sample = np.random.default_rng(0).choice(self.count, size=min(KMEANS_SAMPLE_SIZE, self.count), replace=False)
+                centroids = spherical_kmeans(np.asarray(self.vectors[np.sort(sample)]), nlist)
+            self.centroids = centroids
+            list_ids = np.concatenate([
+                self.assign_lists(np.asarray(self.vectors[start:start + 65536]))
+                for start in range(0, self.count, 65536)
+            ]) if self.count else np.empty(0, dtype=np.int64)
+
+            with self.connect() as conn:
+                conn.execute('DELETE FROM chunks WHERE deleted = 1')
+                # 按旧行号顺序重新编号，与压缩后的向量文件一一对应
+                conn.execute('CREATE TEMP TABLE row_map (old_row INTEGER PRIMARY KEY, new_row INTEGER, list_id INTEGER)')
+                conn.executemany(
+                    'INSERT INTO row_map VALUES (?, ?, ?)',
+                    [(int(old), new, int(list_ids[new])) for new, old in enumerate(live_rows)]
+                )
+                conn.execute('UPDATE chunks SET row = -1 - (SELECT new_row FROM row_map WHERE old_row = chunks.row), '
+                             'list_id = (SELECT list_id FROM row_map WHERE old_row = chunks.row)')
+                conn.execute('UPDATE chunks SET row = -1 - row')
+            if centroids is not None:
+                np.save(self.centroids_file, centroids)
+            elif os.path.exists(self.centroids_file):
+                os.remove(self.centroids_file)
+            self.meta['trained_count'] = self.count if centroids is not None else 0
+            self.save_meta()
+            self.deleted_count = 0
+            self.generation += 1
+            lists = {}
+            for row, list_id in enumerate(list_ids):
+                lists.setdefault(int(list_id), []).append(row)
+            self.lists = {list_id: np.array(rows, dtype=np.int64) for list_id, rows in lists.items()}
+            logger.info(f"向量索引重建完成: {self.count} 个分块, {0 if centroids is None else len(centroids)} 个簇, "
+                        f"耗时 {time.time() - started:.1f} 秒")
+
+    def sync_directory(self, directory, pattern='_processed.md'):
+        """
+        增量同步输出目录：索引新增或修改的文档，删除已不存在的文档
+
+        Returns:
+            (更新数, 删除数)
+        """
+        existing = {name: os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(pattern)}
+        updated = 0
+        for doc_id, path in existing.items():
+            try:
+                if self.index_document(doc_id, path) is not None:
+                    updated += 1
+            except (IOError, OSError) as e:
+                logger.error(f"向量索引文档 {doc_id} 时出错: {str(e)}")
+        with self.connect() as conn:
+            indexed = [row[0] for row in conn.execute('SELECT doc_id FROM documents')]
+        removed = 0
+        for doc_id in indexed:
+            if doc_id not in existing:
+                self.remove_document(doc_id)
+                removed += 1
+        if removed:
+            with self.lock:
+                self.maybe_rebuild()
+        return updated, removed
+
+    def query(self, text, k=5, nprobe=None):
+        """
+        检索与查询文本最相似的k个分块（余弦相似度）
+        """
+        query_vector = self.embedder.embed([text])[0]
+        for _ in range(3):
+            results = self.search_vector(query_vector, k, nprobe)
+            if results is not None:
+                return results
+        return []
+
+    def search_vector(self, query_vector, k, nprobe):
+        """
+        检索一次，期间索引被重建（行号失效）时返回None
+        """
+        with self.lock:
+            vectors = self.vectors
+            centroids = self.centroids
+            lists = self.lists
+            generation = self.generation
+        if centroids is None:
+            probe = list(lists.keys())
+        else:
+            nprobe = nprobe or max(8, len(centroids) // 64)
+            probe = np.argsort(-(centroids @ query_vector))[:nprobe]
+        candidates = [lists[int(list_id)] for list_id in probe if int(list_id) in lists]
+        rows = np.sort(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        if not len(rows):
+            return []
+        scores = np.asarray(vectors[rows]) @ query_vector
+        top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        top_rows = [int(rows[i]) for i in top]
+        with self.connect() as conn:
+            placeholders = ','.join('?' * len(top_rows))
+            chunks = {
+                row: (doc_id, heading, chunk_text)
+                for row, doc_id, heading, chunk_text in conn.execute(
+                    f'SELECT row, doc_id, heading, text FROM chunks WHERE row IN ({placeholders})', top_rows
+                )
+            }
+        if generation != self.generation:
+            return None
+        results = []
+        for i, row in zip(top, top_rows):
+            if row not in chunks:
+                continue
+            doc_id, heading, chunk_text = chunks[row]
+            results.append({
+                'doc_id': doc_id,
+                'output_file': doc_id,
+                'heading': heading,
+                'text': chunk_text,
+                'score': round(float(scores[i]), 4)
+            })
+        return results
+
+
+# 进程内共享的索引实例及其对应的嵌入配置
+_vector_index = None
+_vector_index_key = None
+_vector_index_lock = threading.Lock()
+
+
+def get_vector_index(config):
+    """
+    获取进程内共享的向量索引实例，配置的嵌入后端或模型变化时重新加载
+    """
+    global _vector_index, _vector_index_key
+    key = (config.get('embedding_backend') or DEFAULT_EMBEDDING_BACKEND, config.get('embedding_model'))
+    with _vector_index_lock:
+        if _vector_index is None or _vector_index_key != key:
+            _vector_index = VectorIndex(get_embedder(config))
+            _vector_index_key = key
+        return _vector_index
@@ -1,18 +1,46 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from startup_report import StartupReport
+# 启动耗时报告，从导入依赖开始计时
+startup_report = StartupReport()
+
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, send_file
 from flask_cors import CORS  # 导入CORS支持
 import os
 import subprocess
 import json
 import time
 import uuid
+import hashlib
+import shutil
+import sqlite3
+import tempfile
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import threading
 import queue
+import bisect
+from collections import OrderedDict
 from functools import wraps
 import traceback
 import logging
 import config_manager  # 导入配置管理模块
+from progress_tracker import ProgressTracker
+from task_deadline import compute_deadline
+from checkpoint import get_checkpoint_file
+from upload_stream import HashingUploadStream, UploadRejected, validate_document, get_file_ext
+from search_index import get_search_index
+from doc_sections import get_section_index, read_range, MAX_SECTION_BYTES
+from http_compression import compress_response, choose_encoding, find_sidecar, write_sidecars, COMPRESSED_DIR
+from doc_sections import SECTIONS_DIR
+from retention import RetentionManager, load_policy
+from task_store import TaskStore
+from model_router import parse_route_line
+from token_estimator import estimate_document, parse_sample_line
+from task_deadline import inspect_document
+from batch_executor import BatchExecutor, get_request_file, load_batch_mode, DEFERRED_EXIT_CODE
+from token_budget import TokenBudget, parse_usage_line
+from worker_pool import WorkerPool, MemoryLimitExceeded, parse_peak_line, SUPERVISED_ENV, RECYCLE_EXIT_CODE
+from server_roles import is_scheduler, acquire_scheduler_lock, check_internal_token, forward_request, call_scheduler, SchedulerUnavailable, SCHEDULER_LOCK_FILE, FORWARDED_FOR_HEADER, SUBMITTER_HEADER
+startup_report.mark('import_modules')
 
 # 配置日志
 logging.basicConfig(
@@ -29,11 +57,44 @@ def log_error(message):
     """记录错误日志"""
     logger.error(message)
 
+def get_vector_index(config):
+    """获取向量索引（依赖numpy，首次使用时再导入，不拖慢启动）"""
+    from vector_index import get_vector_index as load_vector_index
+    return load_vector_index(config)
+
+class UploadRequest(Request):
+    """
+    上传请求：/upload的文件内容直接分块写入上传目录，写入时计算哈希并嗅探文件类型；
+    请求结束时删除本请求创建的所有临时文件（多余的文件字段、上传中途断开、处理出错），已采用的文件此前已移走
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/upload' and filename:
+            # 扩展名不支持时在写入任何内容前拒绝
+            if not allowed_file(filename):
+                raise UploadRejected('不支持的文件格式')
+            stream = HashingUploadStream(app.config['UPLOAD_FOLDER'], filename)
+            self.__dict__.setdefault('upload_streams', []).append(stream)
+            return stream
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self.__dict__.get('upload_streams', ()):
+                stream.discard()
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
 app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # 200MB max file size，提高限制以支持更大的PPT文件
 CORS(app)  # 启用CORS支持，允许跨域请求
+# JSON响应使用紧凑格式并直接输出中文（中文转义为\uXXXX会使体积翻倍）
+app.json.compact = True
+app.json.ensure_ascii = False
+# 响应压缩和JSON的ETag/304处理
+app.after_request(compress_response)
 
 # 确保目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -43,41 +104,179 @@ os.makedirs('.wucai', exist_ok=True)
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'pdf', 'md', 'markdown', 'ppt', 'pptx'}
 
+# 进程角色：单进程运行或由serve.py启动的调度进程负责任务调度和后台线程，Web进程只处理请求，
+# 修改任务状态的请求转发给调度进程，任务状态从共享的任务数据库读取
+IS_SCHEDULER = is_scheduler()
+if IS_SCHEDULER and not acquire_scheduler_lock():
+    raise RuntimeError(f"另一个进程正在运行任务调度（{SCHEDULER_LOCK_FILE}），同一目录只能启动一个调度进程；多进程部署请使用serve.py")
+
 # 任务队列和状态管理
 task_queue = queue.Queue()
-task_status = {}  # {task_id: {'status': 'pending|processing|completed|failed', 'result': ..., 'progress': ...}}
+task_status = None  # TaskStore {task_id: {'status': 'pending|processing|completed|failed', 'result': ..., 'progress': ...}}
 
-# 任务状态文件路径
+# 旧版本的任务状态文件路径，启动时存在则导入任务状态数据库
 TASK_STATUS_FILE = os.path.join('.wucai', 'task_status.json')
 
-# 从文件加载任务状态
+# 任务取消：标记文件目录、子进程取消退出码（需与pdf_to_knowledge_md.py保持一致）
+CANCEL_DIR = os.path.join('.wucai', 'cancel')
+CANCELLED_EXIT_CODE = 3
+CANCEL_GRACE_SECONDS = 30  # 子进程在该时间内未在工作单元边界退出时强制终止
+os.makedirs(CANCEL_DIR, exist_ok=True)
+
+# 正在运行的处理子进程 {task_id: Popen}
+running_processes = {}
+running_processes_lock = threading.Lock()
+
+# 打开任务状态存储
 def load_task_status():
     """
-    从JSON文件加载任务状态，实现任务状态持久化
+    打开任务状态数据库（只读取索引列，任务记录按需加载）；存在旧版本的JSON状态文件时一次性导入
     """
     global task_status
-    if os.path.exists(TASK_STATUS_FILE):
+    task_status = TaskStore()
+    if IS_SCHEDULER and os.path.exists(TASK_STATUS_FILE):
         try:
-            with open(TASK_STATUS_FILE, 'r', encoding='utf-8') as f:
-                task_status = json.load(f)
-            log_info("已从文件加载任务状态")
-        except (json.JSONDecodeError, FileNotFoundError, IOError) as e:
-            log_error(f"加载任务状态文件时出错: {str(e)}")
-            task_status = {}
+            task_status.import_json(TASK_STATUS_FILE)
+        except (json.JSONDecodeError, IOError, OSError, sqlite3.Error) as e:
+            log_error(f"导入任务状态文件时出错: {str(e)}")
+    log_info(f"已加载任务状态索引，共 {len(task_status)} 个任务")
+
+# 任务变更版本号：每次任务状态变化时递增，/tasks?since=<版本号>据此只返回变化的任务
+task_version = 0
+task_changes = OrderedDict()  # {task_id: 最近一次变更的版本号}，按版本号升序排列
+task_order = []  # 按创建序号排列的 [(seq, task_id)]，用于游标分页（游标为创建序号，移除任务后不变）
+task_removals = OrderedDict()  # {task_id: 移除时的版本号}，归档移除的任务，增量轮询时通知客户端
+MAX_TASK_REMOVALS = 10000
+task_version_lock = threading.RLock()
 
-# 保存任务状态到文件
-def save_task_status():
+def rebuild_task_index():
+    """加载任务状态后重建变更版本和创建顺序索引（只使用存储的索引列，不解析任务记录）"""
+    global task_version, task_changes, task_order
+    with task_version_lock:
+        versions = task_status.versions()
+        task_order = task_status.sequences()
+        # 移除任务也会递增版本号，重启后从记录的最大值继续，避免客户端错过变更
+        task_version = max([version for _, version in versions] + [task_status.get_meta('version', 0)])
+        task_changes = OrderedDict(sorted(versions, key=lambda item: item[1]))
+
+def register_task(task_id):
+    """新建任务后登记创建顺序（创建序号由任务状态存储分配）"""
+    with task_version_lock:
+        task_order.append((task_status[task_id]['seq'], task_id))
+
+def touch_task(task_id):
+    """任务状态发生变化：递增版本号；跟随任务显示主任务的进度，一并递增"""
+    global task_version
+    with task_version_lock:
+        for changed_id in [task_id] + list(task_status.get(task_id, {}).get('followers') or []):
+            if changed_id not in task_status:
+                continue
+            task_version += 1
+            task_status[changed_id]['version'] = task_version
+            task_changes[changed_id] = task_version
+            task_changes.move_to_end(changed_id)
+
+def remove_tasks(task_ids):
+    """从任务状态中移除任务（归档后调用）"""
+    global task_version, task_order
+    with task_version_lock:
+        for task_id in task_ids:
+            if task_id not in task_status:
+                continue
+            task_version += 1
+            task_status.remove(task_id, task_version)
+            task_changes.pop(task_id, None)
+            task_removals[task_id] = task_version
+        while len(task_removals) > MAX_TASK_REMOVALS:
+            task_removals.popitem(last=False)
+        task_order = [item for item in task_order if item[1] in task_status]
+        task_status.set_meta('version', task_version)
+
+# Web进程重新读取任务数据库的最短间隔（秒）
+TASK_REFRESH_INTERVAL = 0.5
+last_task_refresh = 0
+task_refresh_lock = threading.Lock()
+
+def refresh_task_status():
+    """Web进程：读取调度进程写入的任务变化和删除记录，增量更新变更版本和创建顺序索引"""
+    global last_task_refresh, task_version
+    with task_refresh_lock:
+        if time.time() - last_task_refresh < TASK_REFRESH_INTERVAL:
+            return
+        last_task_refresh = time.time()
+        changed, removed = task_status.refresh()
+        if not changed and not removed:
+            return
+        with task_version_lock:
+            for task_id, seq, version in changed:
+                if task_id not in task_changes:
+                    bisect.insort(task_order, (seq, task_id))
+                task_changes[task_id] = version
+                task_changes.move_to_end(task_id)
+                task_version = max(task_version, version)
+            for task_id, seq, version in removed:
+                task_changes.pop(task_id, None)
+                position = bisect.bisect_left(task_order, (seq, task_id))
+                if position < len(task_order) and task_order[position] == (seq, task_id):
+                    del task_order[position]
+                task_version = max(task_version, version or 0)
+                task_removals[task_id] = version or task_version
+            while len(task_removals) > MAX_TASK_REMOVALS:
+                task_removals.popitem(last=False)
+
+# 保存任务状态
+def save_task_status(task_id=None):
     """
-    将当前任务状态保存到JSON文件
+    将任务状态写回数据库；task_id为本次发生变化的任务，其版本号递增，只写回该任务及与其合并的任务，
+    不指定时写回全部已加载的任务
     """
-    try:
-        with open(TASK_STATUS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(task_status, f, ensure_ascii=False, indent=2)
-    except (IOError, TypeError) as e:
-        log_error(f"保存任务状态文件时出错: {str(e)}")
+    task_ids = None
+    # 递增版本号和写回在同一把锁内完成，写入顺序与版本号一致，Web进程按版本号增量同步时不会漏掉变更
+    with task_version_lock:
+        if task_id is not None:
+            touch_task(task_id)
+            info = task_status.get(task_id) or {}
+            # 跟随任务的版本号随主任务递增；合并时主任务的跟随列表也会变化
+            task_ids = [task_id] + list(info.get('followers') or []) + ([info['attached_to']] if info.get('attached_to') else [])
+        try:
+            task_status.save(task_ids)
+        except (sqlite3.Error, TypeError, ValueError, RuntimeError) as e:
+            log_error(f"保存任务状态时出错: {str(e)}")
+
+def on_config_changed(new_config, old_config):
+    """配置变更（配置中心保存或手动修改配置文件）后记录变化的配置项"""
+    changed = sorted(
+        key for key in set(new_config) | set(old_config)
+        if key != 'last_updated' and new_config.get(key) != old_config.get(key)
+    )
+    if changed:
+        log_info(f"配置已变更: {', '.join(changed)}")
+
+config_manager.add_listener(on_config_changed)
 
 # 初始化时加载任务状态
 load_task_status()
+rebuild_task_index()
+startup_report.mark('load_task_status', tasks=len(task_status))
+
+if not IS_SCHEDULER:
+    app.before_request(refresh_task_status)
+
+def scheduler_route(f):
+    """
+    调度进程负责的接口（依赖任务队列、token预算、批量执行器等进程内状态）：Web进程把请求转发给调度进程
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if IS_SCHEDULER:
+            return f(*args, **kwargs)
+        try:
+            content, status, headers = forward_request(request, get_submitter())
+        except SchedulerUnavailable as e:
+            log_error(f"转发请求 {request.path} 到调度进程时出错: {str(e)}")
+            return jsonify({'error': f'调度进程暂不可用，请稍后重试: {str(e)}'}), 503
+        return app.response_class(content, status=status, headers=headers)
+    return decorated_function
 
 import traceback
 
@@ -142,23 +341,429 @@ def log_error_detail(task_id, file_path, error_message, error_type="processing_e
     
     # 写入错误日志文件
     with open(error_log_file, 'w', encoding='utf-8') as f:
-        json.dump(error_logs, f, ensure_ascii=False, indent=2)
+        json.dump(error_logs, f, ensure_ascii=False, separators=(',', ':'))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def build_task_paths(task_id, original_filename, file_hash=None):
+    """
+    根据任务ID和原始文件名构建上传文件和输出文件路径
+    有内容哈希时按哈希存储上传文件，相同内容只保存一份
+
+    Returns:
+        (file_path, output_path)
+    """
+    # 提取文件扩展名
+    _, file_ext = os.path.splitext(original_filename)
+    # 使用内容哈希（早期任务为task_id）作为基础文件名，正确添加扩展名
+    secure_unique_filename = f"{file_hash or task_id}{file_ext.lower()}"  # 存储时使用安全文件名，保持扩展名格式
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_unique_filename)
+    
+    # 构建输出文件路径 - 使用原始文件名（保留中文）来构建输出文件名
+    input_name_without_ext = os.path.splitext(original_filename)[0]
+    output_filename = f"{input_name_without_ext}_processed.md"
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    return file_path, output_path
+
+# 单飞合并：相同内容、模型和提示词的在途任务只执行一次 {合并键: 主任务ID}
+inflight_tasks = {}
+inflight_lock = threading.Lock()
+
+# 跟随任务从主任务共享的状态字段
+SHARED_TASK_FIELDS = (
+    'status', 'progress', 'eta_seconds', 'progress_detail', 'result', 'error',
+    'processing_time', 'output_length', 'deadline_seconds', 'estimated_seconds', 'end_time', 'model_route', 'batch', 'admission'
+)
+
+def get_singleflight_key(task_info):
+    """
+    根据内容哈希、模型、提示词和优先级计算单飞合并键，没有内容哈希时返回None
+    """
+    if not task_info.get('file_hash'):
+        return None
+    parts = [
+        task_info['file_hash'], task_info.get('text_model') or '', task_info.get('image_model') or '', task_info.get('prompt') or '',
+        # 实时任务不合并到批量任务上等待
+        task_info.get('priority') or 'interactive'
+    ]
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+def submit_task(task_id, task_data):
+    """
+    提交任务：相同内容、模型和提示词的任务正在执行时挂到该任务上共享执行结果，否则申请token额度后加入队列
+
+    Returns:
+        合并到的主任务ID，未合并时返回None
+    """
+    key = get_singleflight_key(task_status[task_id])
+    if key:
+        with inflight_lock:
+            leader_id = inflight_tasks.get(key)
+            leader = task_status.get(leader_id) if leader_id else None
+            if leader and leader.get('status') in ('pending', 'processing') and not leader.get('cancel_requested'):
+                task_status[task_id]['attached_to'] = leader_id
+                leader.setdefault('followers', []).append(task_id)
+                save_task_status(task_id)  # 保存状态到文件
+                log_info(f"任务 {task_id} 与在途任务 {leader_id} 相同，合并执行")
+                return leader_id
+            inflight_tasks[key] = task_id
+    # 按入队前估算的token用量申请额度，超出预算时排队等待
+    info = task_status[task_id]
+    tokens = (info.get('estimate') or {}).get('total_tokens') or 0
+    reason = token_budget.admit(task_id, task_data['api_key'], info.get('submitter'), tokens, task_data)
+    if reason:
+        info['admission'] = {'state': 'waiting', 'reason': reason, 'queued_at': time.time()}
+        info['result'] = {'message': f'等待token额度: {reason}'}
+        save_task_status(task_id)  # 保存状态到文件
+    return None
+
+def enqueue_admitted_task(task_data):
+    """任务获得token额度后加入执行队列"""
+    info = task_status.get(task_data['task_id'])
+    if info and info.get('admission'):
+        info['admission'] = None
+        info['result'] = None
+        save_task_status(task_data['task_id'])  # 保存状态到文件
+    task_queue.put(task_data)
+
+def expire_waiting_task(task_id, reason):
+    """等待token额度超时（或估算用量超出每日预算）的任务按失败处理"""
+    info = task_status.get(task_id)
+    if not info or info.get('status') != 'pending':
+        return
+    info.update({
+        'status': 'failed',
+        'admission': None,
+        'error': f'超出token预算: {reason}',
+        'result': {'message': f'超出token预算: {reason}，可稍后重试'},
+        'end_time': time.time()
+    })
+    save_task_status(task_id)  # 保存状态到文件
+    finish_singleflight(task_id)
+
+def get_submitter():
+    """
+    提交者标识（token预算和排队按此区分），默认为客户端地址；客户端自行设置的标识不被采用，避免更换标识获得新的额度。
+    只有可信来源设置的请求头X-Submitter才生效：Web进程转发的请求（内部令牌校验通过，同时取转发前的客户端地址），
+    或来自配置项trusted_proxies中反向代理的请求（客户端地址取X-Forwarded-For中代理追加的最后一项）
+    """
+    remote_addr = request.remote_addr
+    submitter = None
+    if check_internal_token(request):
+        remote_addr = request.headers.get(FORWARDED_FOR_HEADER) or remote_addr
+        submitter = request.headers.get(SUBMITTER_HEADER)
+    elif remote_addr in (config_manager.load_config().get('trusted_proxies') or []):
+        remote_addr = request.headers.get('X-Forwarded-For', '').split(',')[-1].strip() or remote_addr
+        submitter = request.headers.get(SUBMITTER_HEADER)
+    return (submitter or remote_addr or '').strip()[:64] or None
+
+def finish_singleflight(task_id):
+    """
+    主任务结束后释放合并键，并把最终状态同步给挂在其上的跟随任务
+    """
+    info = task_status.get(task_id)
+    if not info:
+        return
+    key = get_singleflight_key(info)
+    with inflight_lock:
+        if key and inflight_tasks.get(key) == task_id:
+            del inflight_tasks[key]
+    
+    for follower_id in info.get('followers', []):
+        follower = task_status.get(follower_id)
+        if not follower or follower.get('attached_to') != task_id or follower.get('status') not in ('pending', 'processing'):
+            continue
+        for field in SHARED_TASK_FIELDS:
+            if field in info:
+                follower[field] = info[field]
+        # 结果共享，跟随任务没有额外消耗token
+        follower['token_usage'] = 0
+        follower['image_token_usage'] = 0
+        if info.get('status') == 'cancelled':
+            follower['result'] = {'message': '共享的处理任务已被取消，可重试'}
+    save_task_status(task_id)  # 保存状态到文件
+
+def get_task_view(task_id):
+    """
+    获取任务状态副本；跟随任务在主任务执行期间显示主任务的状态和进度
+    """
+    info = task_status[task_id].copy()
+    leader = task_status.get(info.get('attached_to'))
+    if leader and info.get('status') in ('pending', 'processing'):
+        for field in SHARED_TASK_FIELDS:
+            if field in leader:
+                info[field] = leader[field]
+    return info
+
+def get_cancel_file(task_id):
+    """
+    获取任务的取消标记文件路径
+    """
+    return os.path.join(CANCEL_DIR, task_id)
+
+def run_processing_command(cmd, env, tracker, timeout, task_id=None):
+    """
+    启动处理子进程并逐行读取输出，将进度行交给进度跟踪器
+
+    Returns:
+        (returncode, stdout_str, stderr_str)
+
+    Raises:
+        subprocess.TimeoutExpired: 子进程执行超过timeout秒
+    """
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env
+    )
+    if task_id:
+        with running_processes_lock:
+            running_processes[task_id] = process
+        worker_pool.track(task_id, process)
+    
+    # 在单独线程中读取stderr，防止管道写满导致子进程阻塞
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_thread.start()
+    
+    # 超时后先发送终止信号，让子进程保存检查点；仍未退出时强制终止，readline随即返回EOF
+    timed_out = threading.Event()
+    def kill_on_timeout():
+        timed_out.set()
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    timer = threading.Timer(timeout, kill_on_timeout)
+    timer.start()
+    
+    stdout_lines = []
+    reported_peak = None
+    try:
+        for raw_line in iter(process.stdout.readline, b''):
+            # 手动解码输出，使用UTF-8编码并替换无法解码的字符
+            line = raw_line.decode('utf-8', errors='replace')
+            tokens = parse_usage_line(line)
+            if tokens and task_id:
+                # 每次API调用的实际用量立即记入token预算
+                token_budget.record(task_id, tokens)
+            route = parse_route_line(line)
+            peak = parse_peak_line(line)
+            if route:
+                # 记录本任务实际使用的文本模型和选择原因
+                tracker.task_info['model_route'] = route
+            elif peak:
+                reported_peak = peak
+            elif not tracker.feed_line(line):
+                stdout_lines.append(line)
+        process.wait()
+    finally:
+        timer.cancel()
+        stderr_thread.join(timeout=5)
+        tracker.flush()
+        if task_id:
+            with running_processes_lock:
+                running_processes.pop(task_id, None)
+    
+    if task_id:
+        # 记录子进程的峰值内存；因超出内存上限被终止时抛出MemoryLimitExceeded
+        peak = worker_pool.untrack(task_id, reported_peak)
+        tracker.task_info['peak_rss_mb'] = round(peak / (1024 * 1024), 1) if peak else None
+    
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    
+    stderr_str = b''.join(stderr_chunks).decode('utf-8', errors='replace')
+    return process.returncode, ''.join(stdout_lines), stderr_str
+
+def parse_token_usage(task_id, stdout_str, stderr_str):
+    """
+    从子进程输出中提取文本处理和图像识别的token用量
+
+    Returns:
+        (token_usage, image_token_usage)
+    """
+    token_usage = 0
+    image_token_usage = 0
+    import re
+    
+    # 检查标准输出中的文本处理token用量
+    token_match = re.search(r'TOKEN_USAGE:(\d+)', stdout_str)
+    if token_match:
+        token_usage = int(token_match.group(1))
+        log_info(f"任务 {task_id} 从子进程输出中提取到文本处理token用量: {token_usage}")
+    else:
+        # 尝试从错误输出中查找（以防万一输出到stderr）
+        token_match = re.search(r'TOKEN_USAGE:(\d+)', stderr_str)
+        if token_match:
+            token_usage = int(token_match.group(1))
+            log_info(f"任务 {task_id} 从错误输出中提取到文本处理token用量: {token_usage}")
+        else:
+            log_info(f"任务 {task_id} 未找到文本处理token用量信息")
+    
+    # 检查标准输出中的图像识别token用量
+    image_token_matches = re.findall(r'IMAGE_TOKEN_USAGE:(\d+)', stdout_str)
+    if image_token_matches:
+        for match in image_token_matches:
+            image_token_usage += int(match)
+        log_info(f"任务 {task_id} 从子进程输出中提取到图像识别token用量: {image_token_usage}")
+    else:
+        # 尝试从错误输出中查找
+        image_token_matches = re.findall(r'IMAGE_TOKEN_USAGE:(\d+)', stderr_str)
+        if image_token_matches:
+            for match in image_token_matches:
+                image_token_usage += int(match)
+            log_info(f"任务 {task_id} 从错误输出中提取到图像识别token用量: {image_token_usage}")
+    return token_usage, image_token_usage
+
+def record_task_success(task_id, file_path, output_path, prompt, token_usage, image_token_usage, token_sample, stats):
+    """
+    任务成功后更新任务状态、保存处理记录，并更新全文索引、向量索引和预压缩文件
+
+    Args:
+        token_usage: 文本生成的token用量
+        image_token_usage: 图像识别的token用量
+        token_sample: 文本调用的校准样本，没有时为None
+        stats: {'page_count', 'image_count', 'output_tokens', 'stage_seconds'}，用于统计模型历史吞吐量
+    """
+    end_time = time.time()
+    processing_duration = end_time - task_status[task_id]['start_time']  # 计算总处理时间（秒）
+    
+    # 获取输出文件的大小（字数）
+    output_length = 0
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+            output_length = len(content)
+    
+    # 计算总token用量
+    total_token_usage = token_usage + image_token_usage
+    log_info(f"任务 {task_id} 总token用量: {total_token_usage} (文本处理: {token_usage} + 图像识别: {image_token_usage})")
+    
+    task_status[task_id]['status'] = 'completed'
+    task_status[task_id]['progress'] = 100
+    task_status[task_id]['eta_seconds'] = 0
+    # 将处理时间和输出字数作为顶级字段，方便前端访问
+    task_status[task_id]['processing_time'] = processing_duration  # 以秒为单位的处理时间
+    task_status[task_id]['output_length'] = output_length  # 输出字数
+    task_status[task_id]['token_usage'] = total_token_usage  # 设置实际的总token用量
+    task_status[task_id]['image_token_usage'] = image_token_usage  # 记录图像识别token用量
+    
+    task_status[task_id]['result'] = {
+        'output_file': os.path.basename(output_path),
+        'message': '处理成功',
+        'processing_time': processing_duration,  # 以秒为单位的处理时间
+        'output_length': output_length,  # 输出字数
+        'token_usage': total_token_usage,  # 使用实际计算的总token用量
+        'image_token_usage': image_token_usage  # 记录图像识别token用量
+    }
+    save_task_status(task_id)  # 保存状态到文件
+    
+    # 保存处理记录
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    record = {
+        'task_id': task_id,
+        'input_file': task_status[task_id]['input_filename'],  # 使用完整的原始文件名
+        'unique_input_file': os.path.basename(file_path),  # 内部存储的安全文件名
+        'output_file': os.path.basename(output_path),  # 包含原始文件名的输出文件名
+        'prompt': prompt,
+        'timestamp': timestamp,
+        'processing_time': task_status[task_id]['start_time'],  # 任务开始的Unix时间戳
+        'duration_seconds': processing_duration,  # 处理耗时（秒）
+        'status': 'completed',
+        'output_length': output_length,  # 输出字数
+        'token_usage': total_token_usage,  # 使用总token用量
+        'image_token_usage': image_token_usage,  # 添加图像识别token用量记录
+        # 以下字段用于统计模型历史吞吐量，估算后续任务的截止时间
+        'text_model': task_status[task_id].get('text_model'),
+        'image_model': task_status[task_id].get('image_model'),
+        'page_count': stats['page_count'],
+        'image_count': stats['image_count'],
+        'output_tokens': stats['output_tokens'],
+        'token_sample': token_sample,
+        'stage_seconds': stats['stage_seconds']
+    }
+    
+    # 保存到JSON记录文件
+    records_file = os.path.join('.wucai', 'processing_records.json')
+    records = []
+    if os.path.exists(records_file):
+        try:
+            with open(records_file, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+                if content:  # 检查文件内容是否为空
+                    records = json.loads(content)
+                else:
+                    records = []  # 空文件则初始化为空列表
+        except (json.JSONDecodeError, FileNotFoundError):
+            records = []  # 如果解析失败或文件不存在，初始化为空列表
+    
+    records.append(record)
+    
+    with open(records_file, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False, separators=(',', ':'))
+    
+    # 将输出文档加入全文索引
+    try:
+        get_search_index().index_document(
+            os.path.basename(output_path), output_path,
+            title=task_status[task_id]['input_filename'], task_id=task_id
+        )
+    except Exception as e:
+        log_error(f"任务 {task_id} 更新全文索引时出错: {str(e)}")
+    
+    # 按标题切分输出文档并加入向量索引，供语义检索
+    try:
+        get_vector_index(config_manager.load_config()).index_document(
+            os.path.basename(output_path), output_path, task_id=task_id
+        )
+    except Exception as e:
+        log_error(f"任务 {task_id} 更新向量索引时出错: {str(e)}")
+    
+    # 预先生成标题偏移索引和预压缩文件，供分页查看和压缩下载
+    try:
+        get_section_index(output_path)
+        write_sidecars(output_path)
+    except Exception as e:
+        log_error(f"任务 {task_id} 生成标题偏移索引或预压缩文件时出错: {str(e)}")
+    
+    # 任务成功后检查点不再需要
+    checkpoint_file = get_checkpoint_file(task_id)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
 def process_task(task_id, file_path, api_key, prompt, output_path):
     """处理单个任务的函数"""
     global task_status
     
     try:
+        # 排队期间已被取消的任务不再处理
+        if task_status[task_id].get('status') == 'cancelled':
+            log_info(f"任务 {task_id} 已取消，跳过处理")
+            return
+        
         # 加载配置
         config = config_manager.load_config()
         
+        # 根据页数/幻灯片数、图片数和模型历史吞吐量估算截止时间，替代固定的5分钟超时
+        deadline_seconds, estimated_seconds, document_profile = compute_deadline(
+            file_path,
+            task_status[task_id].get('text_model', ''),
+            task_status[task_id].get('image_model', ''),
+            task_status[task_id].get('document_profile')
+        )
+        
         # 更新任务状态为处理中
         task_status[task_id]['status'] = 'processing'
         task_status[task_id]['progress'] = 5  # 开始处理
-        save_task_status()  # 保存状态到文件
+        task_status[task_id]['deadline_seconds'] = deadline_seconds
+        task_status[task_id]['estimated_seconds'] = estimated_seconds
+        task_status[task_id]['document_profile'] = document_profile
+        save_task_status(task_id)  # 保存状态到文件
+        log_info(f"任务 {task_id} 预计耗时 {estimated_seconds} 秒，截止时间 {deadline_seconds} 秒")
         
         # 不设置环境变量，使用config_manager中的配置
         env = os.environ.copy()
@@ -172,146 +777,77 @@ def process_task(task_id, file_path, api_key, prompt, output_path):
             'python', 'pdf_to_knowledge_md.py',
             file_path,
             '--prompt', prompt,
-            '--output', output_path
+            '--output', output_path,
+            '--cancel-file', get_cancel_file(task_id),
+            '--checkpoint-file', get_checkpoint_file(task_id)
         ]
+        # 上传时已计算内容哈希，子进程直接用作提取缓存的键
+        if task_status[task_id].get('file_hash'):
+            cmd.extend(['--file-hash', task_status[task_id]['file_hash']])
+        # 批量任务不实时调用文本模型，生成请求交给批量执行器
+        if task_status[task_id].get('priority') == 'batch':
+            cmd.extend(['--defer-request', get_request_file(task_id)])
         
         # 使用传入的api_key或配置中的api_key
         api_key_to_use = api_key or config.get('api_key', '')
         if api_key_to_use:
             cmd.extend(['--api-key', api_key_to_use])
         
-        # 更新进度到20%
-        task_status[task_id]['progress'] = 20
-        save_task_status()  # 保存状态到文件
-        
-        # 执行处理 - 使用二进制模式避免编码问题
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            env=env,
-            timeout=300  # 5分钟超时
+        # 执行处理 - 进度根据子进程上报的实际完成单元计算，持久化按间隔节流
+        tracker = ProgressTracker(task_status[task_id], lambda: save_task_status(task_id))
+        returncode, stdout_str, stderr_str = run_processing_command(
+            cmd, env, tracker,
+            timeout=deadline_seconds,
+            task_id=task_id
         )
-        
-        # 更新进度到80%
-        task_status[task_id]['progress'] = 80
-        save_task_status()  # 保存状态到文件
-        
-        # 手动解码输出，使用UTF-8编码并处理可能的解码错误
-        try:
-            stdout_str = result.stdout.decode('utf-8')
-        except UnicodeDecodeError:
-            # 如果UTF-8解码失败，使用系统默认编码并替换错误字符
-            stdout_str = result.stdout.decode('utf-8', errors='replace')
 
-        try:
-            stderr_str = result.stderr.decode('utf-8')
-        except UnicodeDecodeError:
-            # 如果UTF-8解码失败，使用系统默认编码并替换错误字符
-            stderr_str = result.stderr.decode('utf-8', errors='replace')
-
-        if result.returncode == 0:
+        if returncode == 0:
             # 处理成功
-            end_time = time.time()
-            processing_duration = end_time - task_status[task_id]['start_time']  # 计算总处理时间（秒）
-            
-            # 获取输出文件的大小（字数）
-            output_length = 0
-            if os.path.exists(output_path):
-                with open(output_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    output_length = len(content)
-                    
-            # 从子进程输出中提取token用量
-            token_usage = 0
-            image_token_usage = 0
-            import re
+            token_usage, image_token_usage = parse_token_usage(task_id, stdout_str, stderr_str)
             
-            # 检查标准输出中的文本处理token用量
-            token_match = re.search(r'TOKEN_USAGE:(\d+)', stdout_str)
-            if token_match:
-                token_usage = int(token_match.group(1))
-                log_info(f"任务 {task_id} 从子进程输出中提取到文本处理token用量: {token_usage}")
-            else:
-                # 尝试从错误输出中查找（以防万一输出到stderr）
-                token_match = re.search(r'TOKEN_USAGE:(\d+)', stderr_str)
-                if token_match:
-                    token_usage = int(token_match.group(1))
-                    log_info(f"任务 {task_id} 从错误输出中提取到文本处理token用量: {token_usage}")
-                else:
-                    log_info(f"任务 {task_id} 未找到文本处理token用量信息")
-            
-            # 检查标准输出中的图像识别token用量
-            image_token_matches = re.findall(r'IMAGE_TOKEN_USAGE:(\d+)', stdout_str)
-            if image_token_matches:
-                for match in image_token_matches:
-                    image_token_usage += int(match)
-                log_info(f"任务 {task_id} 从子进程输出中提取到图像识别token用量: {image_token_usage}")
-            else:
-                # 尝试从错误输出中查找
-                image_token_matches = re.findall(r'IMAGE_TOKEN_USAGE:(\d+)', stderr_str)
-                if image_token_matches:
-                    for match in image_token_matches:
-                        image_token_usage += int(match)
-                    log_info(f"任务 {task_id} 从错误输出中提取到图像识别token用量: {image_token_usage}")
-            
-            # 计算总token用量
-            total_token_usage = token_usage + image_token_usage
-            log_info(f"任务 {task_id} 总token用量: {total_token_usage} (文本处理: {token_usage} + 图像识别: {image_token_usage})")
-
-            task_status[task_id]['status'] = 'completed'
-            task_status[task_id]['progress'] = 100
-            # 将处理时间和输出字数作为顶级字段，方便前端访问
-            task_status[task_id]['processing_time'] = processing_duration  # 以秒为单位的处理时间
-            task_status[task_id]['output_length'] = output_length  # 输出字数
-            task_status[task_id]['token_usage'] = total_token_usage  # 设置实际的总token用量
-            task_status[task_id]['image_token_usage'] = image_token_usage  # 记录图像识别token用量
+            # 文本调用的字符统计和实际输入token数，用于校准本地token估算
+            token_sample = None
+            for line in stdout_str.splitlines():
+                token_sample = parse_sample_line(line) or token_sample
             
-            task_status[task_id]['result'] = {
-                'output_file': os.path.basename(output_path),
-                'message': '处理成功',
-                'processing_time': processing_duration,  # 以秒为单位的处理时间
-                'output_length': output_length,  # 输出字数
-                'token_usage': total_token_usage,  # 使用实际计算的总token用量
-                'image_token_usage': image_token_usage  # 记录图像识别token用量
+            record_task_success(task_id, file_path, output_path, prompt, token_usage, image_token_usage, token_sample, {
+                'page_count': tracker.stages.get('extract', [0, 0])[1],
+                'image_count': tracker.stages.get('image', [0, 0])[1],
+                'output_tokens': tracker.stages.get('generate', [0, 0])[0],
+                # 从检查点恢复的任务各阶段耗时不具代表性，不记录
+                'stage_seconds': None if task_status[task_id].get('retry_count') else tracker.stage_seconds
+            })
+        elif returncode == DEFERRED_EXIT_CODE:
+            # 批量模式：文档读取和图片识别已完成，生成请求等待批量执行器提交，结果返回后由complete_batch_task完成任务
+            _, image_token_usage = parse_token_usage(task_id, stdout_str, stderr_str)
+            task_status[task_id]['eta_seconds'] = None
+            task_status[task_id]['batch'] = {
+                'state': 'queued',
+                'queued_at': time.time(),
+                'batch_id': None,
+                'image_token_usage': image_token_usage,
+                'stats': {
+                    'page_count': tracker.stages.get('extract', [0, 0])[1],
+                    'image_count': tracker.stages.get('image', [0, 0])[1],
+                    'output_tokens': 0,
+                    # 包含批量排队时间，不用于统计吞吐量
+                    'stage_seconds': None
+                }
             }
-            save_task_status()  # 保存状态到文件
-            
-            # 保存处理记录
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            record = {
-                'task_id': task_id,
-                'input_file': task_status[task_id]['input_filename'],  # 使用完整的原始文件名
-                'unique_input_file': os.path.basename(file_path),  # 内部存储的安全文件名
-                'output_file': os.path.basename(output_path),  # 包含原始文件名的输出文件名
-                'prompt': prompt,
-                'timestamp': timestamp,
-                'processing_time': task_status[task_id]['start_time'],  # 任务开始的Unix时间戳
-                'duration_seconds': processing_duration,  # 处理耗时（秒）
-                'status': 'completed',
-                'output_length': output_length,  # 输出字数
-                'token_usage': total_token_usage,  # 使用总token用量
-                'image_token_usage': image_token_usage  # 添加图像识别token用量记录
+            task_status[task_id]['result'] = {'message': '文档读取和图片识别已完成，等待批量生成'}
+            save_task_status(task_id)  # 保存状态到文件
+            batch_executor.wake()
+            log_info(f"任务 {task_id} 的生成请求已加入批量队列")
+            return
+        elif returncode == CANCELLED_EXIT_CODE or task_status[task_id].get('cancel_requested'):
+            # 任务被取消 - 子进程在工作单元边界退出，保留已上传文件和已完成的进度信息
+            task_status[task_id]['status'] = 'cancelled'
+            task_status[task_id]['eta_seconds'] = None
+            task_status[task_id]['result'] = {
+                'message': '任务已取消'
             }
-            
-            # 保存到JSON记录文件
-            records_file = os.path.join('.wucai', 'processing_records.json')
-            records = []
-            if os.path.exists(records_file):
-                try:
-                    with open(records_file, 'r', encoding='utf-8') as f:
-                        content = f.read().strip()
-                        if content:  # 检查文件内容是否为空
-                            records = json.loads(content)
-                        else:
-                            records = []  # 空文件则初始化为空列表
-                except (json.JSONDecodeError, FileNotFoundError):
-                    records = []  # 如果解析失败或文件不存在，初始化为空列表
-            
-            records.append(record)
-            
-            with open(records_file, 'w', encoding='utf-8') as f:
-                json.dump(records, f, ensure_ascii=False, indent=2)
-                
+            save_task_status(task_id)  # 保存状态到文件
+            log_info(f"任务 {task_id} 已取消")
         else:
             # 处理失败 - 现在能更好地捕获子进程错误
             task_status[task_id]['status'] = 'failed'
@@ -320,7 +856,7 @@ def process_task(task_id, file_path, api_key, prompt, output_path):
             task_status[task_id]['result'] = {
                 'message': f'处理失败: {stderr_str}'
             }
-            save_task_status()  # 保存状态到文件
+            save_task_status(task_id)  # 保存状态到文件
             
             # 记录错误日志 - 现在会记录到全局错误日志
             log_error(f"任务 {task_id} 错误: {stderr_str}")
@@ -328,25 +864,45 @@ def process_task(task_id, file_path, api_key, prompt, output_path):
             log_error_detail(task_id, file_path, f"处理失败: {stderr_str}", "processing_error")
 
         task_status[task_id]['end_time'] = time.time()
-        save_task_status()  # 保存状态到文件
+        save_task_status(task_id)  # 保存状态到文件
+        
+        # 清理取消标记文件
+        cancel_file = get_cancel_file(task_id)
+        if os.path.exists(cancel_file):
+            os.remove(cancel_file)
         
-    except subprocess.TimeoutExpired:
-        # 处理超时
+    except subprocess.TimeoutExpired as e:
+        # 处理超时 - 已完成的工作保存在检查点中，重试时继续
+        timeout_msg = f"处理超时 (超过{int(e.timeout)}秒)"
         task_status[task_id]['status'] = 'failed'
-        task_status[task_id]['error'] = "处理超时 (超过5分钟)"
+        task_status[task_id]['error'] = timeout_msg
         task_status[task_id]['progress'] = 100
         task_status[task_id]['result'] = {
-            'message': '处理超时: 任务执行时间超过5分钟'
+            'message': f'处理超时: 任务执行时间超过{int(e.timeout)}秒，已完成的部分已保存，可重试继续处理'
         }
-        save_task_status()  # 保存状态到文件
+        save_task_status(task_id)  # 保存状态到文件
         
         # 记录错误日志
-        log_error(f"任务 {task_id} 超时错误: 处理超时 (超过5分钟)")
+        log_error(f"任务 {task_id} 超时错误: {timeout_msg}")
         # 同时记录到详细错误日志文件
-        log_error_detail(task_id, file_path, "处理超时 (超过5分钟)", "timeout_error")
+        log_error_detail(task_id, file_path, timeout_msg, "timeout_error")
         
         task_status[task_id]['end_time'] = time.time()
-        save_task_status()  # 保存状态到文件
+        save_task_status(task_id)  # 保存状态到文件
+        
+    except MemoryLimitExceeded as e:
+        # 子进程内存超出上限被终止 - 已完成的工作保存在检查点中
+        task_status[task_id]['status'] = 'failed'
+        task_status[task_id]['error'] = str(e)
+        task_status[task_id]['progress'] = 100
+        task_status[task_id]['result'] = {
+            'message': f'处理失败: {str(e)}，可调大worker_pool.task_memory_mb后重试'
+        }
+        task_status[task_id]['end_time'] = time.time()
+        save_task_status(task_id)  # 保存状态到文件
+        
+        log_error(f"任务 {task_id} 内存超出上限: {str(e)}")
+        log_error_detail(task_id, file_path, str(e), "memory_error")
         
     except Exception as e:
         # 处理异常
@@ -356,7 +912,7 @@ def process_task(task_id, file_path, api_key, prompt, output_path):
         task_status[task_id]['result'] = {
             'message': f'处理过程中发生错误: {str(e)}'
         }
-        save_task_status()  # 保存状态到文件
+        save_task_status(task_id)  # 保存状态到文件
         
         # 记录错误日志
         log_error(f"任务 {task_id} 异常: {str(e)}")
@@ -364,7 +920,72 @@ def process_task(task_id, file_path, api_key, prompt, output_path):
         log_error_detail(task_id, file_path, str(e), "processing_exception")
         
         task_status[task_id]['end_time'] = time.time()
-        save_task_status()  # 保存状态到文件
+        save_task_status(task_id)  # 保存状态到文件
+    
+    finally:
+        # 释放合并键和未用完的预占额度，把结果同步给合并到本任务的跟随任务，等待额度的任务随即重新检查；
+        # 等待批量结果的任务在结果返回或取消后再释放
+        if not task_status.get(task_id, {}).get('batch'):
+            finish_singleflight(task_id)
+            token_budget.release(task_id)
+        # 释放工作槽位，暂缓的任务随即启动
+        worker_pool.release(task_id)
+
+def on_batch_submitted(batch_id, task_ids):
+    """批量执行器提交请求后记录任务所在的批量任务"""
+    for task_id in task_ids:
+        batch = task_status.get(task_id, {}).get('batch')
+        if batch:
+            batch.update(state='submitted', batch_id=batch_id, submitted_at=time.time())
+            task_status[task_id]['result'] = {'message': '已提交批量生成，等待结果'}
+            save_task_status(task_id)  # 保存状态到文件
+
+def complete_batch_task(task_id, result):
+    """
+    批量执行器返回结果后写出文档并完成任务；已取消或重新提交的任务忽略结果
+
+    Args:
+        result: {'content', 'input_tokens', 'output_tokens', 'error'}
+    """
+    info = task_status.get(task_id)
+    if not info or info.get('status') != 'processing' or not info.get('batch'):
+        log_info(f"任务 {task_id} 已不再等待批量结果，忽略")
+        return
+    batch = info['batch']
+    file_path, output_path = build_task_paths(task_id, info['input_filename'], info.get('file_hash'))
+    if result.get('input_tokens') or result.get('output_tokens'):
+        config = config_manager.load_config()
+        token_budget.record(
+            task_id, result['input_tokens'] + result['output_tokens'],
+            api_key=config.get('api_key', '') or config.get('app_key', ''), submitter=info.get('submitter')
+        )
+    try:
+        if result.get('error') or not result.get('content'):
+            raise RuntimeError(result.get('error') or '批量生成没有返回内容')
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(result['content'])
+        info['batch'] = None
+        stats = dict(batch['stats'], output_tokens=result['output_tokens'])
+        record_task_success(
+            task_id, file_path, output_path, info.get('prompt', ''),
+            result['input_tokens'] + result['output_tokens'], batch['image_token_usage'], None, stats
+        )
+        log_info(f"任务 {task_id} 批量生成完成")
+    except Exception as e:
+        info['batch'] = None
+        info['status'] = 'failed'
+        info['error'] = str(e)
+        info['progress'] = 100
+        info['result'] = {
+            'message': f'批量生成失败: {str(e)}，可重试（已完成的文档读取和图片识别会被复用）'
+        }
+        save_task_status(task_id)  # 保存状态到文件
+        log_error(f"任务 {task_id} 批量生成失败: {str(e)}")
+        log_error_detail(task_id, file_path, f"批量生成失败: {str(e)}", "batch_error")
+    info['end_time'] = time.time()
+    save_task_status(task_id)  # 保存状态到文件
+    finish_singleflight(task_id)
+    token_budget.release(task_id)
 
 def task_worker():
     """任务工作线程"""
@@ -375,11 +996,18 @@ def task_worker():
                 break
             
             task_id = task_data['task_id']
+            if task_status.get(task_id, {}).get('status') == 'cancelled':
+                # 排队期间已取消的任务直接丢弃
+                task_queue.task_done()
+                continue
             file_path = task_data['file_path']
             api_key = task_data['api_key']  # 修改为api_key以符合命名规范
             prompt = task_data['prompt']
             output_path = task_data['output_path']
             
+            # 等待空闲的工作槽位（同时运行的任务数、内存软上限），任务按入队顺序启动
+            worker_pool.acquire(task_id)
+            
             # 启动处理线程
             processing_thread = threading.Thread(
                 target=process_task,
@@ -394,18 +1022,176 @@ def task_worker():
             print(f"任务工作线程错误: {str(e)}")
             continue
 
-# 启动任务工作线程
+# 启动任务工作线程（只在调度进程中运行，以下后台线程同）
 worker_thread = threading.Thread(target=task_worker, daemon=True)
-worker_thread.start()
+if IS_SCHEDULER:
+    worker_thread.start()
+
+def sync_output_indexes():
+    """启动时增量同步输出目录到全文索引和向量索引（补建历史文档、清理已删除文档），并补建预压缩文件"""
+    try:
+        updated, removed = get_search_index().sync_directory(app.config['OUTPUT_FOLDER'])
+        log_info(f"全文索引同步完成: 更新 {updated} 个文档, 删除 {removed} 个文档")
+    except Exception as e:
+        log_error(f"同步全文索引时出错: {str(e)}")
+    try:
+        updated, removed = get_vector_index(config_manager.load_config()).sync_directory(app.config['OUTPUT_FOLDER'])
+        log_info(f"向量索引同步完成: 更新 {updated} 个文档, 删除 {removed} 个文档")
+    except Exception as e:
+        log_error(f"同步向量索引时出错: {str(e)}")
+    try:
+        written = 0
+        for name in os.listdir(app.config['OUTPUT_FOLDER']):
+            if name.endswith('_processed.md'):
+                written += write_sidecars(os.path.join(app.config['OUTPUT_FOLDER'], name))
+        log_info(f"预压缩文件同步完成: 生成 {written} 个文件")
+    except Exception as e:
+        log_error(f"生成预压缩文件时出错: {str(e)}")
+
+# 在后台同步索引，不阻塞启动
+search_sync_thread = threading.Thread(target=sync_output_indexes, daemon=True)
+if IS_SCHEDULER:
+    search_sync_thread.start()
+
+# 保留策略：定期归档旧任务记录、清理上传文件和临时文件
+retention_manager = RetentionManager(
+    get_tasks=lambda: task_status.snapshot(),
+    remove_tasks=remove_tasks,
+    load_config=config_manager.load_config,
+    upload_dir=app.config['UPLOAD_FOLDER'],
+    output_dir=app.config['OUTPUT_FOLDER'],
+    cache_dirs=(COMPRESSED_DIR, SECTIONS_DIR),
+    resolve_upload=lambda task_id, info: build_task_paths(task_id, info['input_filename'], info.get('file_hash'))[0]
+)
+if IS_SCHEDULER:
+    retention_manager.start()
+
+# token预算准入控制：按API Key和提交者的滚动窗口统计实际用量，超出预算的任务排队等待额度
+token_budget = TokenBudget(load_config=config_manager.load_config, submit=enqueue_admitted_task)
+if IS_SCHEDULER:
+    token_budget.start(on_expired=expire_waiting_task)
+
+# 延迟批量执行：收集低优先级任务的生成请求，合并提交并把结果分发回任务
+batch_executor = BatchExecutor(
+    load_config=config_manager.load_config,
+    on_result=complete_batch_task,
+    on_submit=on_batch_submitted
+)
+if IS_SCHEDULER:
+    batch_executor.start()
+
+def recycle_server(reason):
+    """
+    服务进程需要回收且已没有运行中的任务：由serve.py等进程管理器启动时退出并由其重新启动，
+    排队中的任务在新进程启动时恢复；否则无法重新启动，只记录日志并重新计数
+    """
+    if os.environ.get(SUPERVISED_ENV):
+        log_info(f"服务进程回收（{reason}），退出后由进程管理器重新启动")
+        logging.shutdown()
+        os._exit(RECYCLE_EXIT_CODE)
+    log_info(f"服务进程需要回收（{reason}），但未由进程管理器启动，继续运行")
+    worker_pool.reset_recycle()
+
+# 处理子进程工作池：限制同时运行的任务数，记录每个任务的峰值内存，内存超出上限时暂缓或终止任务
+worker_pool = WorkerPool(load_config=config_manager.load_config, on_recycle=recycle_server)
+if IS_SCHEDULER:
+    worker_pool.start()
+
+def recover_unfinished_tasks():
+    """
+    恢复服务进程上次退出时未完成的任务：排队中的任务重新提交；处理中的任务（等待批量结果的除外）
+    随服务进程中断，标记为失败，重试时从检查点继续
+    """
+    config = config_manager.load_config()
+    api_key = config.get('api_key', '') or config.get('app_key', '')
+    for task_id, info in task_status.snapshot().items():
+        if info.get('status') == 'processing' and not info.get('batch'):
+            task_status[task_id].update({
+                'status': 'failed',
+                'error': '服务重启时任务中断',
+                'progress': 100,
+                'eta_seconds': None,
+                'result': {'message': '服务重启时任务中断，已完成的部分已保存，可重试继续处理'},
+                'end_time': time.time()
+            })
+            save_task_status(task_id)  # 保存状态到文件
+            finish_singleflight(task_id)
+        elif info.get('status') == 'pending' and not info.get('attached_to') and not info.get('cancel_requested'):
+            file_path, output_path = build_task_paths(task_id, info['input_filename'], info.get('file_hash'))
+            task_status[task_id]['admission'] = None
+            submit_task(task_id, {
+                'task_id': task_id,
+                'file_path': file_path,
+                'api_key': api_key,
+                'prompt': info.get('prompt', ''),
+                'output_path': output_path
+            })
+            log_info(f"任务 {task_id} 在服务重启前未开始处理，已重新提交")
+
+recover_thread = threading.Thread(target=recover_unfinished_tasks, daemon=True)
+if IS_SCHEDULER:
+    recover_thread.start()
+startup_report.mark('start_background_threads')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def create_task(task_id, task_info, task_data):
+    """
+    检查token预算后创建任务并提交；估算用量永远无法满足（或配置为超出即拒绝）时直接拒绝，不创建任务
+
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    tokens = (task_info.get('estimate') or {}).get('total_tokens') or 0
+    admission = token_budget.check(task_data['api_key'], task_info.get('submitter'), tokens)
+    if admission['decision'] == 'reject':
+        log_info(f"任务 {task_id} 超出token预算被拒绝: {admission['reason']}")
+        return {'error': f"超出token预算: {admission['reason']}"}, 429
+    task_status[task_id] = task_info
+    register_task(task_id)
+    save_task_status(task_id)  # 保存状态到文件
+    # 添加任务到队列，相同任务在途时合并执行
+    return {'attached_to': submit_task(task_id, task_data)}, 200
+
+# Web进程可以请求调度进程执行的内部调用
+SCHEDULER_CALLS = {'create_task': create_task}
+
+def run_on_scheduler(name, **kwargs):
+    """
+    执行内部调用：调度进程中直接调用，Web进程中通过内部接口在调度进程中执行
+
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    if IS_SCHEDULER:
+        return SCHEDULER_CALLS[name](**kwargs)
+    try:
+        return call_scheduler(name, kwargs)
+    except SchedulerUnavailable as e:
+        log_error(f"调用调度进程 {name} 时出错: {str(e)}")
+        return {'error': f'调度进程暂不可用，请稍后重试: {str(e)}'}, 503
+
+@app.route('/internal/call/<name>', methods=['POST'])
+def internal_call(name):
+    """Web进程转发给调度进程的内部调用，只接受带有内部令牌的请求"""
+    if not IS_SCHEDULER or name not in SCHEDULER_CALLS or not check_internal_token(request):
+        return jsonify({'error': '接口不存在'}), 404
+    try:
+        result, status_code = SCHEDULER_CALLS[name](**request.get_json())
+        return jsonify(result), status_code
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"执行内部调用 {name} 时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'执行内部调用时发生错误: {str(e)}'}), 500
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    upload_stream = None
     try:
         # 检查是否有文件在请求中
+        # 访问request.files时文件已流式写入上传目录，类型不符的文件在此阶段即被拒绝
         if 'file' not in request.files:
             return jsonify({'error': '没有文件'}), 400
         
@@ -416,8 +1202,17 @@ def upload_file():
         if not allowed_file(file.filename):
             return jsonify({'error': '不支持的文件格式'}), 400
         
+        upload_stream = file.stream
+        file_hash = upload_stream.finish()
+        upload_stream.close()
+        
         # 获取提示词参数
         prompt = request.form.get('prompt', '')
+        # 优先级：interactive实时处理，batch延迟到批量执行（不占用实时调用的并发和配额，按批量价格计费）
+        priority = request.form.get('priority', 'interactive')
+        if priority not in ('interactive', 'batch'):
+            upload_stream.discard()
+            return jsonify({'error': '不支持的优先级'}), 400
         
         # 从配置中心读取API Key
         config = config_manager.load_config()
@@ -427,24 +1222,24 @@ def upload_file():
             api_key = config['app_key']
             
         if not api_key:
+            upload_stream.discard()
             return jsonify({'error': 'API Key未配置，请在配置中心设置'}), 400
         
         # 生成任务ID
         task_id = str(uuid.uuid4())
         
-        # 保存上传的文件
+        # 保存上传的文件 - 按内容哈希存储，相同内容已存在时直接复用，无需再次校验
         original_filename = file.filename  # 保存原始文件名（包含中文）
-        # 提取文件扩展名
-        _, file_ext = os.path.splitext(original_filename)
-        # 使用task_id作为基础文件名，正确添加扩展名
-        secure_unique_filename = f"{task_id}{file_ext.lower()}"  # 存储时使用安全文件名，保持扩展名格式
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_unique_filename)
-        file.save(file_path)
-        
-        # 构建输出文件路径 - 使用原始文件名（保留中文）来构建输出文件名
-        input_name_without_ext = os.path.splitext(original_filename)[0]
-        output_filename = f"{input_name_without_ext}_processed.md"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+        file_path, output_path = build_task_paths(task_id, original_filename, file_hash)
+        document_profile = None
+        deduplicated = os.path.exists(file_path)
+        if deduplicated:
+            upload_stream.discard()
+            log_info(f"上传文件内容与已有文件相同，直接复用: {file_path}")
+        else:
+            # 入队前校验文档结构并统计页数，损坏或空文档直接拒绝
+            document_profile = validate_document(upload_stream.path, get_file_ext(original_filename))
+            os.replace(upload_stream.path, file_path)
         
         # 记录任务开始时间
         start_time = time.time()
@@ -453,8 +1248,16 @@ def upload_file():
         text_model = config.get('text_model', 'qwen-max')
         image_model = config.get('image_model', 'qwen-vl-plus')
         
+        # 入队前估算token用量、费用和耗时
+        estimate = None
+        try:
+            ext = get_file_ext(original_filename)
+            estimate = estimate_document(file_path, ext, document_profile or inspect_document(file_path), config, prompt)
+        except Exception as e:
+            log_error(f"估算任务 {task_id} 的token用量时出错: {str(e)}")
+        
         # 初始化任务状态
-        task_status[task_id] = {
+        task_info = {
             'status': 'pending',
             'progress': 0,
             'input_filename': original_filename,  # 存储原始完整文件名
@@ -463,11 +1266,16 @@ def upload_file():
             'result': None,
             'error': None,
             'text_model': text_model,
-            'image_model': image_model
+            'image_model': image_model,
+            'prompt': prompt,  # 重试任务时使用
+            'priority': priority,
+            'submitter': get_submitter(),  # 按提交者统计token预算
+            'file_hash': file_hash,  # 上传内容的SHA-256
+            'file_size': upload_stream.size,
+            'document_profile': document_profile,  # 上传时统计的页数/图片数
+            'estimate': estimate  # 入队前估算的token用量、费用和耗时
         }
-        save_task_status()  # 保存状态到文件
         
-        # 添加任务到队列
         task_data = {
             'task_id': task_id,
             'file_path': file_path,
@@ -476,15 +1284,32 @@ def upload_file():
             'output_path': output_path
         }
         
-        task_queue.put(task_data)
+        # 创建任务并加入队列（多进程部署时在调度进程中执行），相同任务在途时合并执行
+        result, status_code = run_on_scheduler('create_task', task_id=task_id, task_info=task_info, task_data=task_data)
+        if status_code != 200:
+            return jsonify(result), status_code
+        leader_id = result['attached_to']
         
         return jsonify({
             'success': True,
             'task_id': task_id,
-            'message': '任务已提交，正在后台处理',
-            'original_filename': original_filename  # 返回原始文件名供前端使用
+            'attached_to': leader_id,
+            'message': '相同的文档正在处理中，已合并到该任务，将共享处理结果' if leader_id else '任务已提交，正在后台处理',
+            'original_filename': original_filename,  # 返回原始文件名供前端使用
+            'file_hash': file_hash,
+            'deduplicated': deduplicated,
+            'priority': priority,
+            'document_profile': document_profile,
+            'estimate': estimate
         })
+    except UploadRejected as e:
+        if upload_stream is not None:
+            upload_stream.discard()
+        log_info(f"拒绝上传的文件: {str(e)}")
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
+        if isinstance(upload_stream, HashingUploadStream):
+            upload_stream.discard()
         # 记录异常
         temp_task_id = str(uuid.uuid4())
         log_error(f"上传过程中发生错误 {temp_task_id}: {str(e)}")
@@ -495,7 +1320,7 @@ def get_task_status(task_id):
     """获取特定任务的状态"""
     try:
         if task_id in task_status:
-            status_info = task_status[task_id].copy()
+            status_info = get_task_view(task_id)
             # 保留input_filename用于前端显示，但仍然不暴露其他内部路径信息
             # 保留处理用时、token用量和输出字数等信息
             return jsonify(status_info)
@@ -506,6 +1331,144 @@ def get_task_status(task_id):
         log_error(f"获取任务状态时发生错误 {temp_task_id}: {str(e)}")
         return jsonify({'error': f'获取任务状态时发生错误: {str(e)}'}), 500
 
+@app.route('/cancel/<task_id>', methods=['POST'])
+@scheduler_route
+def cancel_task(task_id):
+    """取消任务：排队中的任务直接标记为已取消，处理中的任务在下一个工作单元边界停止"""
+    try:
+        if task_id not in task_status:
+            return jsonify({'error': '任务不存在'}), 404
+        
+        status = task_status[task_id].get('status')
+        if status in ('completed', 'failed', 'cancelled'):
+            return jsonify({'error': f'任务已结束，无法取消 (状态: {status})'}), 400
+        
+        # 跟随任务只解除合并，不影响主任务的执行
+        leader_id = task_status[task_id].get('attached_to')
+        if leader_id and status in ('pending', 'processing'):
+            leader = task_status.get(leader_id, {})
+            if task_id in leader.get('followers', []):
+                leader['followers'].remove(task_id)
+            task_status[task_id].update({
+                'status': 'cancelled',
+                'attached_to': None,
+                'result': {'message': '任务已取消'},
+                'end_time': time.time()
+            })
+            save_task_status(task_id)  # 保存状态到文件
+            log_info(f"任务 {task_id} 已取消，解除与任务 {leader_id} 的合并")
+            return jsonify({'success': True, 'message': '任务已取消'})
+        
+        task_status[task_id]['cancel_requested'] = True
+        if task_status[task_id].get('batch'):
+            # 等待批量结果的任务没有子进程，直接取消；已提交的请求结果返回后忽略
+            batch_executor.discard(task_id)
+            task_status[task_id].update({
+                'status': 'cancelled',
+                'batch': None,
+                'result': {'message': '任务已取消'},
+                'end_time': time.time()
+            })
+            save_task_status(task_id)  # 保存状态到文件
+            finish_singleflight(task_id)
+            token_budget.release(task_id)
+            log_info(f"任务 {task_id} 在等待批量结果时被取消")
+            return jsonify({'success': True, 'message': '任务已取消'})
+        if status == 'pending':
+            token_budget.discard(task_id)
+            task_status[task_id]['admission'] = None
+            task_status[task_id]['status'] = 'cancelled'
+            task_status[task_id]['result'] = {'message': '任务已取消'}
+            task_status[task_id]['end_time'] = time.time()
+            save_task_status(task_id)  # 保存状态到文件
+            # 排队中的任务不会进入process_task，在此同步给跟随任务
+            finish_singleflight(task_id)
+            log_info(f"任务 {task_id} 在排队中被取消")
+            return jsonify({'success': True, 'message': '任务已取消'})
+        
+        # 处理中：写入取消标记，子进程检查到后退出并释放处理线程
+        with open(get_cancel_file(task_id), 'w', encoding='utf-8') as f:
+            f.write(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        save_task_status(task_id)  # 保存状态到文件
+        
+        # 子进程长时间停留在单个工作单元中时强制终止
+        def force_kill():
+            with running_processes_lock:
+                process = running_processes.get(task_id)
+            if process and process.poll() is None:
+                log_info(f"任务 {task_id} 未在{CANCEL_GRACE_SECONDS}秒内停止，强制终止")
+                process.kill()
+        kill_timer = threading.Timer(CANCEL_GRACE_SECONDS, force_kill)
+        kill_timer.daemon = True
+        kill_timer.start()
+        
+        log_info(f"任务 {task_id} 已请求取消")
+        return jsonify({'success': True, 'message': '已请求取消，任务将在当前步骤完成后停止'})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"取消任务时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'取消任务时发生错误: {str(e)}'}), 500
+
+@app.route('/retry/<task_id>', methods=['POST'])
+@scheduler_route
+def retry_task(task_id):
+    """重试失败或已取消的任务，已完成的工作从检查点继续"""
+    try:
+        if task_id not in task_status:
+            return jsonify({'error': '任务不存在'}), 404
+        
+        status = task_status[task_id].get('status')
+        if status not in ('failed', 'cancelled'):
+            return jsonify({'error': f'只能重试失败或已取消的任务 (状态: {status})'}), 400
+        
+        file_path, output_path = build_task_paths(
+            task_id, task_status[task_id]['input_filename'], task_status[task_id].get('file_hash')
+        )
+        if not os.path.exists(file_path):
+            return jsonify({'error': '上传的原始文件已不存在，无法重试'}), 400
+        
+        config = config_manager.load_config()
+        api_key = config.get('api_key', '') or config.get('app_key', '')
+        if not api_key:
+            return jsonify({'error': 'API Key未配置，请在配置中心设置'}), 400
+        
+        # 清理上次残留的取消标记
+        cancel_file = get_cancel_file(task_id)
+        if os.path.exists(cancel_file):
+            os.remove(cancel_file)
+        
+        task_status[task_id].update({
+            'status': 'pending',
+            'progress': 0,
+            'eta_seconds': None,
+            'start_time': time.time(),
+            'end_time': None,
+            'result': None,
+            'error': None,
+            'cancel_requested': False,
+            'attached_to': None,
+            'followers': [],
+            'batch': None,
+            'admission': None,
+            'retry_count': task_status[task_id].get('retry_count', 0) + 1
+        })
+        save_task_status(task_id)  # 保存状态到文件
+        
+        submit_task(task_id, {
+            'task_id': task_id,
+            'file_path': file_path,
+            'api_key': api_key,
+            'prompt': task_status[task_id].get('prompt', ''),
+            'output_path': output_path
+        })
+        
+        log_info(f"任务 {task_id} 已重新提交 (第{task_status[task_id]['retry_count']}次重试)")
+        return jsonify({'success': True, 'task_id': task_id, 'message': '任务已重新提交，将从已完成的部分继续处理'})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"重试任务时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'重试任务时发生错误: {str(e)}'}), 500
+
 @app.route('/get_config')
 def get_config():
     """
@@ -594,22 +1557,206 @@ def update_config():
         log_error(f"更新配置时出错: {str(e)}")
         return jsonify({'error': f'系统错误: {str(e)}'}), 500
 
+# /tasks分页参数
+DEFAULT_TASK_PAGE_SIZE = 50
+MAX_TASK_PAGE_SIZE = 200
+
 @app.route('/tasks')
 def get_all_tasks():
-    """获取所有任务的状态"""
-    try:
-        tasks = {}
-        for task_id, status_info in task_status.items():
-            task_copy = status_info.copy()
-            # 保留input_filename、processing_time和其他相关信息用于前端显示
-            # 转换用时等信息已经在task_status中，这里不再需要额外处理
-            tasks[task_id] = task_copy
-        return jsonify(tasks)
+    """
+    获取任务状态
+
+    不带参数时返回全部任务（兼容旧版本）；带参数时：
+    - limit/cursor: 按创建时间倒序分页，cursor为上一页返回的next_cursor
+    - since: 只返回版本号大于since的任务（增量轮询），不再匹配status的任务放在removed中
+    - status: 按状态过滤，多个状态用逗号分隔
+    """
+    try:
+        if not any(name in request.args for name in ('limit', 'cursor', 'since', 'status')):
+            tasks = {}
+            for task_id in list(task_status.keys()):
+                task_copy = get_task_view(task_id)
+                # 保留input_filename、processing_time和其他相关信息用于前端显示
+                # 转换用时等信息已经在task_status中，这里不再需要额外处理
+                tasks[task_id] = task_copy
+            return jsonify(tasks)
+        
+        try:
+            limit = min(max(int(request.args.get('limit', DEFAULT_TASK_PAGE_SIZE)), 1), MAX_TASK_PAGE_SIZE)
+            cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+            since = int(request.args['since']) if request.args.get('since') else None
+        except ValueError:
+            return jsonify({'error': 'limit、cursor和since必须是整数'}), 400
+        statuses = set(filter(None, request.args.get('status', '').split(',')))
+        
+        def matches(task):
+            return not statuses or task.get('status') in statuses
+        
+        tasks = []
+        removed = []
+        if since is not None:
+            # 增量模式：从最新的变更向前遍历，开销与变更数成正比
+            with task_version_lock:
+                current_version = task_version
+                changed = []
+                for task_id in reversed(task_changes):
+                    if task_changes[task_id] <= since:
+                        break
+                    changed.append(task_id)
+                for task_id in reversed(task_removals):
+                    if task_removals[task_id] <= since:
+                        break
+                    removed.append(task_id)
+            changed.reverse()
+            # 变更过多时只返回最早的limit个，客户端以返回的version继续拉取
+            has_more = len(changed) > limit
+            changed = changed[:limit]
+            for task_id in changed:
+                task = get_task_view(task_id)
+                if matches(task):
+                    tasks.append({'task_id': task_id, **task})
+                else:
+                    removed.append(task_id)
+            if has_more:
+                current_version = task_status[changed[-1]]['version']
+            return jsonify({'tasks': tasks, 'removed': removed, 'version': current_version, 'has_more': has_more})
+        
+        # 分页模式：按创建顺序倒序，从游标（上一页最后一个任务的创建序号）向前查找；
+        # 每次在锁内取一段索引，锁外读取任务记录
+        with task_version_lock:
+            current_version = task_version
+        next_cursor = None
+        while len(tasks) < limit:
+            with task_version_lock:
+                end = len(task_order) if cursor is None else bisect.bisect_left(task_order, (cursor,))
+                chunk = task_order[max(end - limit, 0):end]
+            if not chunk:
+                break
+            for seq, task_id in reversed(chunk):
+                cursor = seq
+                if task_id not in task_status:
+                    continue
+                task = get_task_view(task_id)
+                if not matches(task):
+                    continue
+                tasks.append({'task_id': task_id, **task})
+                if len(tasks) >= limit:
+                    break
+        if len(tasks) >= limit:
+            with task_version_lock:
+                if bisect.bisect_left(task_order, (cursor,)) > 0:
+                    next_cursor = cursor
+        return jsonify({'tasks': tasks, 'version': current_version, 'next_cursor': next_cursor})
     except Exception as e:
         temp_task_id = str(uuid.uuid4())
         log_error(f"获取任务列表时发生错误 {temp_task_id}: {str(e)}")
         return jsonify({'error': f'获取任务列表时发生错误: {str(e)}'}), 500
 
+@app.route('/retention')
+@scheduler_route
+def get_retention():
+    """获取当前保留策略和最近一次执行报告"""
+    try:
+        return jsonify({
+            'policy': load_policy(config_manager.load_config()),
+            'last_report': retention_manager.last_report
+        })
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"获取保留策略时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'获取保留策略时发生错误: {str(e)}'}), 500
+
+@app.route('/estimate', methods=['POST'])
+def estimate_upload():
+    """
+    不创建任务，估算上传文档的token用量、费用（按模型的input_price/output_price）和处理耗时
+    """
+    tmp_path = None
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': '没有文件'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': '没有选择文件'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': '不支持的文件格式'}), 400
+        
+        ext = get_file_ext(file.filename)
+        fd, tmp_path = tempfile.mkstemp(suffix=f'.{ext}')
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(file.stream, f)
+        
+        profile = validate_document(tmp_path, ext)
+        estimate = estimate_document(tmp_path, ext, profile, config_manager.load_config(), request.form.get('prompt', ''))
+        return jsonify({'success': True, 'document_profile': profile, 'estimate': estimate})
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"估算文档时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'估算文档时发生错误: {str(e)}'}), 500
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@app.route('/startup_report')
+def get_startup_report():
+    """获取服务启动各步骤的耗时"""
+    return jsonify(startup_report.as_dict())
+
+@app.route('/token_budget')
+@scheduler_route
+def get_token_budget():
+    """获取token预算、各API Key（哈希）和提交者的用量以及等待额度的任务"""
+    try:
+        return jsonify(token_budget.status())
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"获取token预算时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'获取token预算时发生错误: {str(e)}'}), 500
+
+@app.route('/workers')
+@scheduler_route
+def get_workers():
+    """获取工作池参数、服务进程和运行中任务的内存占用"""
+    try:
+        return jsonify(worker_pool.status())
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"获取工作池状态时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'获取工作池状态时发生错误: {str(e)}'}), 500
+
+@app.route('/batches')
+@scheduler_route
+def get_batches():
+    """获取批量执行参数、等待提交的任务和最近的批量任务"""
+    try:
+        return jsonify({'options': load_batch_mode(config_manager.load_config()), **batch_executor.status()})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"获取批量任务时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'获取批量任务时发生错误: {str(e)}'}), 500
+
+@app.route('/batches/run', methods=['POST'])
+@scheduler_route
+def run_batches():
+    """立即提交全部等待中的请求并查询批量任务状态"""
+    try:
+        return jsonify({'success': True, **batch_executor.run_once(force=True)})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"执行批量任务时发生错误 {temp_task_id}: {str(e)}")
+        return jsonify({'error': f'执行批量任务时发生错误: {str(e)}'}), 500
+
+@app.route('/retention/run', methods=['POST'])
+@scheduler_route
+def run_retention():
+    """立即在后台执行一次保留策略"""
+    retention_manager.run_in_background()
+    return jsonify({'success': True, 'message': '已开始执行保留策略'}), 202
+
 @app.route('/knowledge_base')
 def knowledge_base():
     try:
@@ -636,10 +1783,84 @@ def knowledge_base():
         log_error(f"获取知识库记录时发生错误 {temp_task_id}: {str(e)}")
         return jsonify({'error': f'获取知识库记录时发生错误: {str(e)}'}), 500
 
+@app.route('/search')
+def search_knowledge():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '请输入搜索关键词'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'limit和offset必须是整数'}), 400
+    try:
+        started = time.perf_counter()
+        results = get_search_index().search(query, limit=limit, offset=offset)
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+        return jsonify({'query': query, 'results': results, 'took_ms': took_ms})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"搜索知识库时发生错误 {temp_task_id} (关键词: {query}): {str(e)}")
+        return jsonify({'error': f'搜索知识库时发生错误: {str(e)}'}), 500
+
+@app.route('/query')
+@scheduler_route
+def query_knowledge():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '请输入查询内容'}), 400
+    try:
+        k = min(max(int(request.args.get('k', 5)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'k必须是整数'}), 400
+    try:
+        started = time.perf_counter()
+        results = get_vector_index(config_manager.load_config()).query(query, k=k)
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+        return jsonify({'query': query, 'results': results, 'took_ms': took_ms})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"语义检索知识库时发生错误 {temp_task_id} (查询: {query}): {str(e)}")
+        return jsonify({'error': f'语义检索知识库时发生错误: {str(e)}'}), 500
+
+def resolve_output_file(filename):
+    """解析输出文件路径，路径越出输出目录时返回None"""
+    # 注意：对于输出文件，我们不对文件名进行secure_filename处理，以支持中文文件名
+    # 但我们仍然需要防止路径遍历攻击
+    output_folder_realpath = os.path.realpath(app.config['OUTPUT_FOLDER'])
+    file_realpath = os.path.realpath(os.path.join(app.config['OUTPUT_FOLDER'], filename))
+    if not file_realpath.startswith(output_folder_realpath + os.sep):
+        return None
+    return file_realpath
+
+def send_output_file(file_path, as_attachment=False):
+    """
+    发送输出文件：客户端接受压缩且不是Range请求时发送预压缩文件，否则分块流式发送原文件
+    （支持Range请求和条件请求，不把整个文件读入内存）
+    """
+    encoding = None if request.range else choose_encoding()
+    sidecar = find_sidecar(file_path, encoding) if encoding else None
+    response = send_file(
+        sidecar or file_path,
+        mimetype='text/markdown' if as_attachment else 'text/plain',
+        as_attachment=as_attachment,
+        download_name=os.path.basename(file_path),
+        conditional=True
+    )
+    if sidecar:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        return send_from_directory(app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
+        file_path = resolve_output_file(filename)
+        if file_path is None:
+            return "非法文件路径", 403
+        if not os.path.exists(file_path):
+            return f"文件不存在: {filename}", 404
+        return send_output_file(file_path, as_attachment=True)
     except Exception as e:
         temp_task_id = str(uuid.uuid4())
         log_error(f"下载文件时发生错误 {temp_task_id} (文件: {filename}): {str(e)}")
@@ -648,28 +1869,75 @@ def download_file(filename):
 @app.route('/view/<filename>')
 def view_file(filename):
     try:
-        # 注意：对于输出文件，我们不对文件名进行secure_filename处理，以支持中文文件名
-        # 但我们仍然需要防止路径遍历攻击
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-        
-        # 确保文件在正确的目录下（防止路径遍历）
-        output_folder_realpath = os.path.realpath(app.config['OUTPUT_FOLDER'])
-        file_realpath = os.path.realpath(file_path)
-        if not file_realpath.startswith(output_folder_realpath):
+        file_path = resolve_output_file(filename)
+        if file_path is None:
             return "非法文件路径", 403
         
         # 检查文件是否存在
         if not os.path.exists(file_path):
             return f"文件不存在: {filename}", 404
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content
+        return send_output_file(file_path)
     except Exception as e:
         temp_task_id = str(uuid.uuid4())
         log_error(f"无法读取文件错误 {temp_task_id} (文件: {filename}): {str(e)}")
         return f"无法读取文件: {str(e)}", 500
 
+@app.route('/sections/<filename>')
+def get_sections(filename):
+    """获取输出文档的目录（各小节的标题和字节区间）"""
+    try:
+        file_path = resolve_output_file(filename)
+        if file_path is None:
+            return jsonify({'error': '非法文件路径'}), 403
+        if not os.path.exists(file_path):
+            return jsonify({'error': f'文件不存在: {filename}'}), 404
+        
+        index = get_section_index(file_path)
+        return jsonify({'output_file': filename, 'size': index['size'], 'sections': index['sections']})
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"获取文档目录时发生错误 {temp_task_id} (文件: {filename}): {str(e)}")
+        return jsonify({'error': f'获取文档目录时发生错误: {str(e)}'}), 500
+
+@app.route('/sections/<filename>/<int:index>')
+def get_section_content(filename, index):
+    """分页读取输出文档：从第index个小节开始返回最多count个小节的内容"""
+    try:
+        count = min(max(int(request.args.get('count', 1)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'count必须是整数'}), 400
+    try:
+        file_path = resolve_output_file(filename)
+        if file_path is None:
+            return jsonify({'error': '非法文件路径'}), 403
+        if not os.path.exists(file_path):
+            return jsonify({'error': f'文件不存在: {filename}'}), 404
+        
+        sections = get_section_index(file_path)['sections']
+        if index >= len(sections):
+            return jsonify({'error': f'小节不存在: {index}'}), 404
+        
+        # 单次返回的内容不超过一个小节的最大字节数（至少返回一个小节）
+        selected = [sections[index]]
+        for section in sections[index + 1:index + count]:
+            if section['end'] - selected[0]['start'] > MAX_SECTION_BYTES:
+                break
+            selected.append(section)
+        content = read_range(file_path, selected[0]['start'], selected[-1]['end'])
+        next_index = selected[-1]['index'] + 1
+        return jsonify({
+            'output_file': filename,
+            'start_index': index,
+            'end_index': selected[-1]['index'],
+            'next_index': next_index if next_index < len(sections) else None,
+            'content': content
+        })
+    except Exception as e:
+        temp_task_id = str(uuid.uuid4())
+        log_error(f"读取文档小节时发生错误 {temp_task_id} (文件: {filename}): {str(e)}")
+        return jsonify({'error': f'读取文档小节时发生错误: {str(e)}'}), 500
+
 
 @app.route('/error_logs')
 def get_error_logs():
@@ -738,6 +2006,9 @@ def handle_exception(e):
     log_error(f"未处理的异常 {temp_task_id}: {str(e)}")
     return jsonify({'error': f'发生未处理的异常: {str(e)}'}), 500
 
+startup_report.mark('register_routes')
+startup_report.finish()
+
 if __name__ == '__main__':
     # 修复路径中的空格问题
     # import sys
@@ -0,0 +1,290 @@
+import os
+import re
+import sys
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 默认参数，可通过配置项worker_pool覆盖其中任意一项（0表示不限制）
+DEFAULT_WORKER_POOL = {
+    'max_workers': 2,  # 同时运行的处理子进程数
+    'soft_memory_mb': 0,  # 服务进程和处理子进程的总RSS超过该值时暂缓启动新任务（至少保留一个任务运行）
+    'task_memory_mb': 0,  # 单个处理子进程的RSS上限，超出时终止该任务
+    'recycle_after_tasks': 0,  # 服务进程处理该数量的任务后回收
+    'recycle_after_mb': 0  # 服务进程自身RSS超过该值时回收
+}
+
+# 服务进程由serve.py等进程管理器启动时设置该环境变量，回收时以RECYCLE_EXIT_CODE退出并由管理器重新启动
+SUPERVISED_ENV = 'WUCAI_SUPERVISED'
+RECYCLE_EXIT_CODE = 75
+
+# 子进程退出前上报的峰值RSS（字节）
+PEAK_RSS_PATTERN = re.compile(r'^PEAK_RSS:(\d+)\s*$')
+
+# 内存采样间隔
+MONITOR_INTERVAL = 1.0
+
+MB = 1024 * 1024
+
+
+class MemoryLimitExceeded(Exception):
+    """处理子进程的RSS超出task_memory_mb，已被终止"""
+
+    def __init__(self, peak_bytes, limit_mb):
+        super().__init__(f"内存占用 {peak_bytes / MB:.0f}MB 超出上限 {limit_mb}MB")
+        self.peak_bytes = peak_bytes
+        self.limit_mb = limit_mb
+
+
+def load_pool_options(config):
+    """
+    合并配置中的工作池参数和默认值
+    """
+    options = DEFAULT_WORKER_POOL.copy()
+    options.update({k: v for k, v in (config.get('worker_pool') or {}).items() if k in DEFAULT_WORKER_POOL})
+    return options
+
+
+def read_process_memory(pid):
+    """
+    读取进程当前RSS和峰值RSS（字节）；Linux读取/proc，其他平台安装了psutil时使用psutil（峰值取当前值）
+
+    Returns:
+        (rss, peak)，进程不存在或无法读取时返回(None, None)
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            values = {}
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    values[key] = int(value.split()[0]) * 1024
+        return values.get('VmRSS'), values.get('VmHWM', values.get('VmRSS'))
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        rss = psutil.Process(pid).memory_info().rss
+        return rss, rss
+    except Exception:
+        return None, None
+
+
+def get_self_peak_rss():
+    """
+    当前进程的峰值RSS（字节），无法获取时返回None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_peak_marker():
+    """
+    子进程退出前输出的峰值RSS标记，无法获取时返回None
+    """
+    peak = get_self_peak_rss()
+    return f"PEAK_RSS:{peak}" if peak else None
+
+
+def parse_peak_line(line):
+    """
+    解析子进程输出的峰值RSS行，不是该行时返回None
+    """
+    match = PEAK_RSS_PATTERN.match(line)
+    return int(match.group(1)) if match else None
+
+
+class WorkerPool:
+    """
+    处理子进程的有界工作池
+
+    每个任务在独立的子进程中解析文档和调用模型，子进程退出后内存随即归还系统；工作池限制同时运行的
+    子进程数，定期采样各子进程的RSS并记录峰值，单个子进程超出上限时终止该任务，总RSS超出软上限时
+    暂缓启动新任务。服务进程自身也会因索引、缓存和内存碎片缓慢增长，处理的任务数或自身RSS达到阈值后
+    不再启动新任务，等运行中的任务结束后调用on_recycle回收。
+    """
+
+    def __init__(self, load_config, on_recycle=None):
+        """
+        Args:
+            load_config: 返回当前配置的函数
+            on_recycle: on_recycle(原因)，服务进程需要回收且已没有运行中的任务时调用
+        """
+        self.load_config = load_config
+        self.on_recycle = on_recycle
+        self.condition = threading.Condition()
+        self.slots = set()  # 已占用工作槽位的任务ID
+        self.tasks = {}  # {task_id: {'process', 'started_at', 'rss', 'peak', 'exceeded'}}
+        self.completed = 0
+        self.started_at = time.time()
+        self.recycle_reason = None
+        self.deferred_reason = None
+
+    def memory_in_use(self):
+        """
+        服务进程和运行中子进程的当前RSS之和（字节）
+        """
+        own, _ = read_process_memory(os.getpid())
+        return (own or 0) + sum(item['rss'] or 0 for item in self.tasks.values())
+
+    def defer_reason(self, options):
+        """
+        返回暂缓启动新任务的原因，可以启动时返回None
+        """
+        if self.recycle_reason:
+            return f"服务进程等待回收: {self.recycle_reason}"
+        if options['max_workers'] and len(self.slots) >= options['max_workers']:
+            return f"已有 {len(self.slots)} 个任务在运行"
+        if options['soft_memory_mb'] and self.slots:
+            used = self.memory_in_use()
+            if used >= options['soft_memory_mb'] * MB:
+                return f"内存占用 {used / MB:.0f}MB 超出软上限 {options['soft_memory_mb']}MB"
+        return None
+
+    def acquire(self, task_id):
+        """
+        为任务申请工作槽位，没有空闲槽位、内存超出软上限或等待回收时阻塞
+        """
+        with self.condition:
+            while True:
+                reason = self.defer_reason(load_pool_options(self.load_config()))
+                if not reason:
+                    break
+                if reason != self.deferred_reason:
+                    logger.info(f"暂缓启动任务 {task_id}: {reason}")
+                self.deferred_reason = reason
+                self.condition.wait(MONITOR_INTERVAL)
+            self.deferred_reason = None
+            self.slots.add(task_id)
+
+    def track(self, task_id, process):
+        """
+        登记任务的处理子进程，开始采样内存
+        """
+        with self.condition:
+            self.tasks[task_id] = {'process': process, 'started_at': time.time(), 'rss': None, 'peak': 0, 'exceeded': None}
+
+    def untrack(self, task_id, reported_peak=None):
+        """
+        子进程退出后停止采样
+
+        Args:
+            reported_peak: 子进程自己上报的峰值RSS（采样可能错过退出前的峰值）
+
+        Returns:
+            峰值RSS（字节），没有采样到时为None
+
+        Raises:
+            MemoryLimitExceeded: 子进程因超出内存上限被终止
+        """
+        with self.condition:
+            item = self.tasks.pop(task_id, None)
+            self.condition.notify_all()
+        if not item:
+            return reported_peak
+        peak = max(item['peak'], reported_peak or 0) or None
+        if item['exceeded']:
+            raise MemoryLimitExceeded(peak or 0, item['exceeded'])
+        return peak
+
+    def release(self, task_id):
+        """
+        任务结束后释放工作槽位
+        """
+        with self.condition:
+            if task_id not in self.slots:
+                return
+            self.slots.discard(task_id)
+            self.tasks.pop(task_id, None)
+            self.completed += 1
+            self.condition.notify_all()
+
+    def sample(self):
+        """
+        采样运行中子进程的内存，终止超出上限的子进程，并检查服务进程是否需要回收
+        """
+        options = load_pool_options(self.load_config())
+        with self.condition:
+            items = list(self.tasks.items())
+        for task_id, item in items:
+            rss, peak = read_process_memory(item['process'].pid)
+            if rss is None:
+                continue
+            item['rss'] = rss
+            item['peak'] = max(item['peak'], peak or rss)
+            if options['task_memory_mb'] and rss > options['task_memory_mb'] * MB and not item['exceeded']:
+                item['exceeded'] = options['task_memory_mb']
+                logger.error(f"任务 {task_id} 内存占用 {rss / MB:.0f}MB 超出上限 {options['task_memory_mb']}MB，终止处理")
+                try:
+                    item['process'].terminate()
+                except OSError:
+                    pass
+
+        recycle = None
+        with self.condition:
+            if not self.recycle_reason:
+                own, _ = read_process_memory(os.getpid())
+                if options['recycle_after_tasks'] and self.completed >= options['recycle_after_tasks']:
+                    self.recycle_reason = f"已处理 {self.completed} 个任务"
+                elif options['recycle_after_mb'] and own and own >= options['recycle_after_mb'] * MB:
+                    self.recycle_reason = f"服务进程内存占用 {own / MB:.0f}MB"
+                if self.recycle_reason:
+                    logger.info(f"服务进程需要回收（{self.recycle_reason}），运行中的任务结束后不再启动新任务")
+            if self.recycle_reason and not self.slots:
+                recycle = self.recycle_reason
+            self.condition.notify_all()
+        if recycle and self.on_recycle:
+            self.on_recycle(recycle)
+
+    def reset_recycle(self):
+        """
+        放弃本次回收（如没有进程管理器可以重新启动服务进程时），重新开始计数
+        """
+        with self.condition:
+            self.recycle_reason = None
+            self.completed = 0
+            self.started_at = time.time()
+            self.condition.notify_all()
+
+    def status(self):
+        """
+        返回工作池参数、服务进程和运行中任务的内存占用
+        """
+        own, own_peak = read_process_memory(os.getpid())
+        with self.condition:
+            running = [
+                {'task_id': task_id, 'pid': item['process'].pid, 'rss_mb': round((item['rss'] or 0) / MB, 1),
+                 'peak_rss_mb': round(item['peak'] / MB, 1), 'started_at': item['started_at']}
+                for task_id, item in self.tasks.items()
+            ]
+            return {
+                'options': load_pool_options(self.load_config()),
+                'slots': len(self.slots),
+                'running': running,
+                'completed': self.completed,
+                'server_rss_mb': round(own / MB, 1) if own else None,
+                'server_peak_rss_mb': round(own_peak / MB, 1) if own_peak else None,
+                'uptime_seconds': round(time.time() - self.started_at),
+                'deferred_reason': self.deferred_reason,
+                'recycle_reason': self.recycle_reason
+            }
+
+    def loop(self):
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"采样处理子进程内存时出错: {str(e)}")
+
+    def start(self):
+        thread = threading.Thread(target=self.loop, daemon=True)
+        thread.start()
+        return thread